@@ -0,0 +1,460 @@
+"""Анализ транскриптов с помощью ChatGPT."""
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import time
+from typing import AsyncIterator, Dict, List, Optional
+
+import metrics
+from config import ANALYSIS_MODE
+from analysis_cache import analysis_cache, make_key
+from llm import llm_gateway
+from prompts import (
+    get_categories, prompt_builder, json_prompt_builder, tag_prompt_builder,
+    SYSTEM_PROMPT, JSON_SYSTEM_PROMPT, CATEGORIES_PROMPT, ANALYSIS_PROMPT
+)
+
+logger = logging.getLogger(__name__)
+
+MODEL = "gpt-4-turbo-preview"
+
+# Длинные транскрипты режем на части и анализируем параллельно
+CHUNK_THRESHOLD = 6000
+CHUNK_SIZE = 5000
+MAX_CONCURRENT_CHUNKS = 4
+
+# Разделы ответа в порядке из SYSTEM_PROMPT
+SECTION_TITLES = (
+    'Хронология',
+    'Добыча и анализ (с тегами)',
+    'Фолоуп',
+    'Мета-анализ',
+)
+SECTION_HEADER = re.compile(
+    r'^[\s#*]*([1-4])[.)]\s*\**\s*(хронология|добыча|фолоуп|мета)', re.IGNORECASE
+)
+TIME_MARK = re.compile(r'(?=\b\d{1,2}[:.]\d{2}\b)')
+SENTENCE_END = re.compile(r'(?<=[.!?…])\s+')
+LIST_MARKER = re.compile(r'^\s*(?:[-*•]|\d+[.)])\s*')
+
+# Разделы справочника, которыми размечаются поля активности
+TAG_FIELDS = {
+    'contexts': 'КОНТЕКСТЫ',
+    'roles': 'РОЛИ',
+    'skills': 'СКИЛЫ',
+}
+
+
+def _prompt_digest(system_prompt: str) -> str:
+    return hashlib.sha256(
+        (system_prompt + CATEGORIES_PROMPT + ANALYSIS_PROMPT).encode('utf-8')
+    ).hexdigest()
+
+
+# Хэш шаблонов промпта, чтобы их правка не отдавала старые ответы из кэша
+PROMPT_DIGESTS = {
+    'text': _prompt_digest(SYSTEM_PROMPT),
+    'json': _prompt_digest(JSON_SYSTEM_PROMPT),
+}
+
+
+def _structured() -> bool:
+    return ANALYSIS_MODE == 'json'
+
+
+def _request_options() -> Dict:
+    if _structured():
+        return {'response_format': {'type': 'json_object'}}
+    return {}
+
+
+def _split_long(text: str, size: int) -> List[str]:
+    """Разбиение абзаца длиннее size по отметкам времени, затем по предложениям."""
+    if len(text) <= size:
+        return [text]
+    for pattern in (TIME_MARK, SENTENCE_END):
+        parts = [part for part in pattern.split(text) if part.strip()]
+        if len(parts) > 1:
+            return [piece for part in parts for piece in _split_long(part, size)]
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def split_transcript(text: str, size: int = CHUNK_SIZE) -> List[str]:
+    """Разбиение транскрипта на части не длиннее size по границам абзацев."""
+    pieces = []
+    for paragraph in re.split(r'\n\s*\n', text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        pieces.extend(_split_long(paragraph, size))
+
+    chunks = []
+    current = ''
+    for piece in pieces:
+        if current and len(current) + len(piece) + 2 > size:
+            chunks.append(current)
+            current = ''
+        current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _split_sections(response: str) -> List[List[str]]:
+    """Разбор ответа на четыре раздела, каждый раздел - список блоков."""
+    sections: List[List[str]] = [[] for _ in SECTION_TITLES]
+    # Текст без заголовков считаем разметкой активностей
+    current = 1
+    block: List[str] = []
+
+    def flush():
+        if block:
+            sections[current].append('\n'.join(block))
+            block.clear()
+
+    for line in response.splitlines():
+        header = SECTION_HEADER.match(line)
+        if header:
+            flush()
+            current = int(header.group(1)) - 1
+        elif not line.strip():
+            flush()
+        else:
+            block.append(line.rstrip())
+    flush()
+    return sections
+
+
+def _block_key(block: str) -> str:
+    return ' '.join(LIST_MARKER.sub('', block).lower().split())
+
+
+def merge_analyses(responses: List[str]) -> str:
+    """Объединение ответов по частям в один ответ формата SYSTEM_PROMPT.
+
+    Повторяющиеся блоки (одна и та же активность на стыке частей)
+    остаются в единственном экземпляре.
+    """
+    merged: List[List[str]] = [[] for _ in SECTION_TITLES]
+    seen = set()
+    for response in responses:
+        for index, blocks in enumerate(_split_sections(response)):
+            for block in blocks:
+                key = (index, _block_key(block))
+                if key not in seen:
+                    seen.add(key)
+                    merged[index].append(block)
+
+    parts = []
+    for number, (title, blocks) in enumerate(zip(SECTION_TITLES, merged), start=1):
+        parts.append(f"{number}. {title}")
+        parts.extend(blocks)
+    return '\n\n'.join(parts)
+
+
+def merge_structured_analyses(responses: List[str]) -> str:
+    """Объединение JSON-ответов по частям в один JSON-ответ."""
+    merged = {'chronology': [], 'activities': [], 'followup': [], 'meta': []}
+    seen = set()
+    for response in responses:
+        try:
+            data = json.loads(response)
+        except ValueError:
+            data = {'activities': [
+                {'text': activity['text']} for activity in parse_chatgpt_response(response)
+            ]}
+        if not isinstance(data, dict):
+            logger.warning(f"Ответ по части транскрипта не JSON-объект, пропускаем: {response[:100]!r}")
+            continue
+        for field in ('chronology', 'followup'):
+            items = data.get(field) or []
+            # Модель может вернуть строку вместо списка, её нельзя перебирать по символам
+            if isinstance(items, str):
+                items = [items]
+            merged[field].extend(item for item in items if item)
+        activities = data.get('activities')
+        for item in activities if isinstance(activities, list) else []:
+            if not isinstance(item, dict):
+                continue
+            key = _block_key(str(item.get('text', '')))
+            if key and key not in seen:
+                seen.add(key)
+                merged['activities'].append(item)
+        if data.get('meta'):
+            merged['meta'].append(str(data['meta']))
+    merged['meta'] = '\n'.join(merged['meta'])
+    return json.dumps(merged, ensure_ascii=False)
+
+
+def _build_messages(text: str, categories, builder=None) -> List[Dict]:
+    start = time.perf_counter()
+    builder = builder or (json_prompt_builder if _structured() else prompt_builder)
+    messages, tokens = builder.build(text, categories)
+    elapsed = time.perf_counter() - start
+    metrics.observe('prompt_build', elapsed)
+    metrics.inc('prompt_tokens', tokens)
+    logger.info(f"Промпт собран: ~{tokens} токенов, {elapsed * 1000:.2f} мс")
+    return messages
+
+
+async def _request_analysis(text: str) -> str:
+    """Анализ одного фрагмента текста с использованием кэша."""
+    # Загружаем категории
+    categories = get_categories()
+
+    cache_key = make_key(text, categories.digest, MODEL, PROMPT_DIGESTS[ANALYSIS_MODE])
+    cached = analysis_cache.get(cache_key)
+    if cached is not None:
+        logger.info("Анализ транскрипта взят из кэша")
+        return cached
+
+    content = await llm_gateway.complete(
+        MODEL, _build_messages(text, categories), **_request_options()
+    )
+    analysis_cache.put(cache_key, content)
+    return content
+
+
+async def analyze_with_chatgpt(text: str, max_concurrency: Optional[int] = None) -> str:
+    """Отправка текста в ChatGPT и получение анализа
+
+    Транскрипты длиннее CHUNK_THRESHOLD анализируются по частям
+    параллельно, а результаты сводятся в один ответ.
+    """
+    try:
+        if len(text) <= CHUNK_THRESHOLD:
+            return await _request_analysis(text)
+
+        chunks = split_transcript(text)
+        logger.info(f"Длинный транскрипт ({len(text)} символов) разбит на {len(chunks)} частей")
+        semaphore = asyncio.Semaphore(max_concurrency or MAX_CONCURRENT_CHUNKS)
+
+        async def analyze_chunk(chunk: str) -> str:
+            async with semaphore:
+                return await _request_analysis(chunk)
+
+        responses = await asyncio.gather(*(analyze_chunk(chunk) for chunk in chunks))
+        if _structured():
+            return merge_structured_analyses(list(responses))
+        return merge_analyses(list(responses))
+    except Exception as e:
+        logger.error(f"Ошибка при работе с ChatGPT: {e}")
+        raise
+
+
+async def tag_with_chatgpt(texts: List[str]) -> List[Optional[Dict]]:
+    """Разметка нескольких активностей тегами одним запросом.
+
+    Для каждого текста возвращает активность с полями тегов или None,
+    если модель его пропустила.
+    """
+    numbered = '\n'.join(f"{index}. {text}" for index, text in enumerate(texts))
+    response = await llm_gateway.complete(
+        MODEL,
+        _build_messages(numbered, get_categories(), tag_prompt_builder),
+        response_format={'type': 'json_object'}
+    )
+    data = json.loads(response)
+    known = known_tags()
+    tagged: List[Optional[Dict]] = [None] * len(texts)
+    for item in data.get('activities') or []:
+        if not isinstance(item, dict):
+            continue
+        index = item.get('index')
+        if isinstance(index, int) and 0 <= index < len(texts):
+            tagged[index] = make_activity({**item, 'text': texts[index]}, known)
+    return tagged
+
+
+async def stream_analysis(text: str) -> AsyncIterator[str]:
+    """Анализ с потоковой выдачей: отдаёт накопленный на данный момент ответ.
+
+    Ответ из кэша и сводный ответ по частям длинного транскрипта
+    отдаются одним куском.
+    """
+    if len(text) > CHUNK_THRESHOLD:
+        yield await analyze_with_chatgpt(text)
+        return
+
+    categories = get_categories()
+    cache_key = make_key(text, categories.digest, MODEL, PROMPT_DIGESTS[ANALYSIS_MODE])
+    cached = analysis_cache.get(cache_key)
+    if cached is not None:
+        logger.info("Анализ транскрипта взят из кэша")
+        yield cached
+        return
+
+    try:
+        content = ''
+        async for delta in llm_gateway.stream(
+            MODEL, _build_messages(text, categories), **_request_options()
+        ):
+            content += delta
+            yield content
+    except Exception as e:
+        logger.error(f"Ошибка при работе с ChatGPT: {e}")
+        raise
+    analysis_cache.put(cache_key, content)
+
+
+def parse_chatgpt_response(response: str) -> List[Dict]:
+    """Парсинг ответа от ChatGPT в структурированный формат"""
+    activities = []
+
+    # Разбиваем ответ на секции
+    sections = response.split('\n\n')
+
+    for section in sections:
+        # Ищем строки с тегами
+        if '[' in section and ']' in section:
+            # Парсим теги и текст
+            tags = re.findall(r'\[(.*?)\]', section)
+            text = section.split('|')[-1].strip() if '|' in section else section
+
+            activities.append({
+                'text': text,
+                'tags': tags,
+                'raw_section': section  # сохраняем оригинальную секцию для отладки
+            })
+
+    return activities
+
+
+def _collect_names(value, nested: bool = False) -> List[str]:
+    """Все значения раздела справочника, без названий подразделов."""
+    if isinstance(value, list):
+        return [str(item) for item in value]
+    names = []
+    for name, child in value.items():
+        if nested:
+            names.append(name)
+        names.extend(_collect_names(child, nested=True))
+    return names
+
+
+_known_tags: Dict[str, Dict[str, str]] = {}
+_known_tags_version = None
+
+
+def known_tags() -> Dict[str, Dict[str, str]]:
+    """Допустимые значения полей активности: поле -> {нижний регистр: название}."""
+    global _known_tags, _known_tags_version
+    categories = get_categories()
+    if _known_tags_version != categories.version:
+        _known_tags = {
+            field: {
+                name.lower(): name
+                for name in _collect_names(categories.data.get(section, []))
+            }
+            for field, section in TAG_FIELDS.items()
+        }
+        _known_tags_version = categories.version
+    return _known_tags
+
+
+def make_activity(item: Dict, known: Dict[str, Dict[str, str]]) -> Optional[Dict]:
+    """Активность из элемента JSON-ответа, теги не из справочника отбрасываются."""
+    if not isinstance(item, dict):
+        return None
+    text = str(item.get('text') or '').strip()
+    if not text:
+        return None
+
+    activity = {'text': text, 'tags': []}
+    for field, names in known.items():
+        values = item.get(field) or []
+        if isinstance(values, str):
+            values = [values]
+        tags = []
+        for value in values:
+            name = names.get(str(value).strip().lower())
+            if name is None:
+                logger.debug(f"Тег {value!r} не найден в справочнике ({field})")
+            elif name not in tags:
+                tags.append(name)
+        activity[field] = ', '.join(tags)
+        activity['tags'].extend(tags)
+
+    try:
+        energy = max(-2, min(2, int(item.get('energy', 0))))
+    except (TypeError, ValueError):
+        energy = 0
+    activity['energy'] = str(energy)
+    activity['summary'] = str(item.get('summary') or '').strip()
+    return activity
+
+
+def _make_activities(items) -> List[Dict]:
+    known = known_tags()
+    activities = (make_activity(item, known) for item in items)
+    return [activity for activity in activities if activity is not None]
+
+
+def parse_structured_response(response: str) -> List[Dict]:
+    """Разбор JSON-ответа; ValueError, если ответ не соответствует схеме."""
+    data = json.loads(response)
+    if not isinstance(data, dict) or not isinstance(data.get('activities'), list):
+        raise ValueError("В ответе нет списка activities")
+    return _make_activities(data['activities'])
+
+
+def parse_analysis(response: str) -> List[Dict]:
+    """Разбор ответа ChatGPT: JSON, а если не получилось - разделы с тегами."""
+    if response.lstrip().startswith('{'):
+        try:
+            return parse_structured_response(response)
+        except ValueError as e:
+            logger.warning(f"Ответ не разобран как JSON, используем текстовый парсер: {e}")
+            metrics.inc('analysis_legacy_fallbacks')
+    return parse_chatgpt_response(response)
+
+
+def _complete_objects(response: str) -> List[str]:
+    """Полностью полученные объекты массива activities в недописанном JSON."""
+    start = response.find('"activities"')
+    start = response.find('[', start) if start != -1 else -1
+    if start == -1:
+        return []
+
+    objects = []
+    depth = 0
+    object_start = 0
+    in_string = escaped = False
+    for index in range(start + 1, len(response)):
+        char = response[index]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char == '{':
+            if depth == 0:
+                object_start = index
+            depth += 1
+        elif char == '}':
+            depth -= 1
+            if depth == 0:
+                objects.append(response[object_start:index + 1])
+        elif char == ']' and depth == 0:
+            break
+    return objects
+
+
+def parse_partial_analysis(response: str) -> List[Dict]:
+    """Активности из ещё не дописанного ответа, для показа по ходу анализа."""
+    if response.lstrip().startswith('{'):
+        items = []
+        for raw in _complete_objects(response):
+            try:
+                items.append(json.loads(raw))
+            except ValueError:
+                continue
+        return _make_activities(items)
+    # Последний блок может быть ещё не дописан
+    return parse_chatgpt_response(response[:max(response.rfind('\n\n'), 0)])
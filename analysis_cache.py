@@ -0,0 +1,103 @@
+"""Кэш ответов ChatGPT по содержимому транскрипта."""
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+import unicodedata
+from typing import Optional
+
+import metrics
+from config import ANALYSIS_CACHE_PATH
+from storage import connect
+
+logger = logging.getLogger(__name__)
+
+# Записи старше TTL не используются, при переполнении удаляются самые давно прочитанные
+CACHE_TTL = 30 * 24 * 3600
+CACHE_MAX_ENTRIES = 5000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS analyses (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS analyses_accessed ON analyses (accessed_at);
+"""
+
+
+def normalize_transcript(text: str) -> str:
+    """Приведение транскрипта к виду, не зависящему от пробелов и переносов."""
+    text = unicodedata.normalize('NFC', text)
+    lines = (' '.join(line.split()) for line in text.strip().splitlines())
+    return '\n'.join(line for line in lines if line)
+
+
+def make_key(text: str, categories_digest: str, model: str, template_digest: str) -> str:
+    """Ключ кэша: хэш транскрипта, справочника, модели и шаблона промпта."""
+    payload = json.dumps(
+        [normalize_transcript(text), categories_digest, model, template_digest],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class AnalysisCache:
+    """Постоянный кэш анализов с вытеснением по TTL и размеру."""
+
+    def __init__(self, path: str, ttl: float = CACHE_TTL,
+                 max_entries: int = CACHE_MAX_ENTRIES):
+        self._path = path
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._db: Optional[sqlite3.Connection] = None
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = connect(self._path)
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def get(self, key: str) -> Optional[str]:
+        """Ответ из кэша или None."""
+        now = time.time()
+        row = self.db.execute(
+            'SELECT response, created_at FROM analyses WHERE key = ?', (key,)
+        ).fetchone()
+        if row is not None and row[1] + self._ttl < now:
+            with self.db:
+                self.db.execute('DELETE FROM analyses WHERE key = ?', (key,))
+            row = None
+        if row is None:
+            self.misses += 1
+            metrics.inc('analysis_cache_misses')
+            return None
+        with self.db:
+            self.db.execute('UPDATE analyses SET accessed_at = ? WHERE key = ?', (now, key))
+        self.hits += 1
+        metrics.inc('analysis_cache_hits')
+        return row[0]
+
+    def put(self, key: str, response: str) -> None:
+        """Сохранение ответа с вытеснением лишних записей."""
+        now = time.time()
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO analyses (key, response, created_at, accessed_at) '
+                'VALUES (?, ?, ?, ?)',
+                (key, response, now, now)
+            )
+            self.db.execute('DELETE FROM analyses WHERE created_at < ?', (now - self._ttl,))
+            self.db.execute(
+                'DELETE FROM analyses WHERE key IN ('
+                'SELECT key FROM analyses ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (self._max_entries,)
+            )
+
+
+analysis_cache = AnalysisCache(ANALYSIS_CACHE_PATH)
@@ -0,0 +1,221 @@
+"""Статистика энергии по ролям, навыкам и контекстам из локального журнала.
+
+numpy импортируется при первом отчёте, чтобы не замедлять запуск бота.
+"""
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+import pytz
+
+import metrics
+from journal import ActivityJournal, activity_journal
+
+if TYPE_CHECKING:
+    import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Поля с тегами в порядке вывода
+STAT_FIELDS = ('roles', 'skills', 'contexts')
+
+# Окна отчёта в днях, None - вся история
+WINDOWS = {
+    'week': 7,
+    'month': 30,
+    'year': 365,
+    'all': None,
+}
+DEFAULT_WINDOW = 'month'
+
+# Сколько пользователей держим в памяти
+MAX_USERS = 1000
+
+TIMEZONE = 'Europe/Paris'
+
+# Ответы на вопрос об энергии словами, как их принимает ENERGY_STATUS
+ENERGY_WORDS = {
+    'даёт': 1.0,
+    'дает': 1.0,
+    'забирает': -1.0,
+    'нейтрально': 0.0,
+}
+
+
+def parse_energy(value: Optional[str]) -> float:
+    """Энергия из журнала числом, NaN если не удалось понять."""
+    text = str(value or '').strip().lower()
+    try:
+        return float(text.replace(',', '.'))
+    except ValueError:
+        pass
+    for word, energy in ENERGY_WORDS.items():
+        if word in text:
+            return energy
+    return float('nan')
+
+
+def parse_dates(values: List[str]) -> 'np.ndarray':
+    """Даты 'YYYY-MM-DD' в datetime64[D], непонятные - NaT."""
+    import numpy as np
+    try:
+        return np.array(values, dtype='datetime64[D]')
+    except ValueError:
+        parsed = []
+        for value in values:
+            try:
+                parsed.append(np.datetime64(value, 'D'))
+            except ValueError:
+                parsed.append(np.datetime64('NaT'))
+        return np.array(parsed, dtype='datetime64[D]')
+
+
+def split_tags(value: Optional[str]) -> List[str]:
+    return [tag.strip() for tag in (value or '').split(',') if tag.strip()]
+
+
+class TagColumn:
+    """Теги одного поля в виде пар (строка, номер тега)."""
+
+    def __init__(self):
+        import numpy as np
+        self.names: List[str] = []
+        self._ids: Dict[str, int] = {}
+        self.rows = np.empty(0, dtype=np.int64)
+        self.ids = np.empty(0, dtype=np.int64)
+
+    def _tag_id(self, tag: str) -> int:
+        tag_id = self._ids.get(tag)
+        if tag_id is None:
+            tag_id = self._ids[tag] = len(self.names)
+            self.names.append(tag)
+        return tag_id
+
+    def extend(self, offset: int, values: List[Optional[str]]) -> None:
+        import numpy as np
+        rows, ids = [], []
+        # Одни и те же наборы тегов повторяются, разбираем каждый один раз
+        parsed: Dict[Optional[str], List[int]] = {}
+        for position, value in enumerate(values):
+            tag_ids = parsed.get(value)
+            if tag_ids is None:
+                tag_ids = parsed[value] = [self._tag_id(tag) for tag in split_tags(value)]
+            rows.extend([offset + position] * len(tag_ids))
+            ids.extend(tag_ids)
+        if rows:
+            self.rows = np.concatenate((self.rows, np.array(rows, dtype=np.int64)))
+            self.ids = np.concatenate((self.ids, np.array(ids, dtype=np.int64)))
+
+
+class UserActivities:
+    """Колонки активностей одного пользователя, дополняемые новыми строками."""
+
+    def __init__(self):
+        import numpy as np
+        self.last_id = 0
+        self.dates = np.empty(0, dtype='datetime64[D]')
+        self.energy = np.empty(0, dtype=np.float64)
+        self.tags = {field: TagColumn() for field in STAT_FIELDS}
+
+    def extend(self, rows: List[Tuple]) -> None:
+        import numpy as np
+        if not rows:
+            return
+        ids, dates, energy, roles, skills, contexts = zip(*rows)
+        offset = len(self.dates)
+        self.dates = np.concatenate((self.dates, parse_dates(list(dates))))
+        self.energy = np.concatenate(
+            (self.energy, np.array([parse_energy(value) for value in energy]))
+        )
+        for field, values in zip(STAT_FIELDS, (roles, skills, contexts)):
+            self.tags[field].extend(offset, list(values))
+        self.last_id = ids[-1]
+
+
+def aggregate(data: UserActivities, since: Optional['np.datetime64']) -> Dict:
+    """Число активностей и средняя энергия по каждому тегу за окно."""
+    import numpy as np
+    in_window = np.ones(len(data.dates), dtype=bool) if since is None else data.dates >= since
+    has_energy = in_window & ~np.isnan(data.energy)
+    energy = np.where(has_energy, data.energy, 0.0)
+
+    report = {
+        'activities': int(in_window.sum()),
+        'energy': float(energy.sum() / has_energy.sum()) if has_energy.any() else None,
+    }
+    for field, column in data.tags.items():
+        size = len(column.names)
+        selected = in_window[column.rows]
+        ids = column.ids[selected]
+        rows = column.rows[selected]
+        counts = np.bincount(ids, minlength=size)
+        rated = np.bincount(ids, weights=has_energy[rows], minlength=size)
+        sums = np.bincount(ids, weights=energy[rows], minlength=size)
+        stats = [
+            (column.names[tag_id], int(counts[tag_id]), float(sums[tag_id] / rated[tag_id]))
+            for tag_id in np.flatnonzero(rated)
+        ]
+        # От самых заряжающих к самым выматывающим
+        stats.sort(key=lambda item: (-item[2], -item[1]))
+        report[field] = stats
+    return report
+
+
+class ActivityStats:
+    """Отчёты /stats с кэшем на пользователя.
+
+    Колонки пользователя дочитываются из журнала только новыми строками,
+    а готовые отчёты хранятся, пока у пользователя не появились новые
+    активности.
+    """
+
+    def __init__(self, journal: ActivityJournal, max_users: int = MAX_USERS):
+        self._journal = journal
+        self._max_users = max_users
+        self._users: 'OrderedDict[int, UserActivities]' = OrderedDict()
+        # (пользователь, окно) -> (последняя строка, дата, отчёт)
+        self._reports: Dict[Tuple[int, str], Tuple[int, str, Dict]] = {}
+
+    def _user(self, chat_id: int) -> UserActivities:
+        data = self._users.get(chat_id)
+        if data is None:
+            data = self._users[chat_id] = UserActivities()
+            if len(self._users) > self._max_users:
+                evicted, _ = self._users.popitem(last=False)
+                self.invalidate(evicted)
+        else:
+            self._users.move_to_end(chat_id)
+        return data
+
+    def invalidate(self, chat_id: int) -> None:
+        """Сброс кэша пользователя, если его строки изменились, а не только добавились."""
+        self._users.pop(chat_id, None)
+        for key in [key for key in self._reports if key[0] == chat_id]:
+            del self._reports[key]
+
+    def report(self, chat_id: int, window: str = DEFAULT_WINDOW) -> Dict:
+        """Отчёт за окно из WINDOWS."""
+        start = time.perf_counter()
+        today = datetime.now(pytz.timezone(TIMEZONE)).strftime('%Y-%m-%d')
+        last_id = self._journal.last_id(chat_id)
+        cached = self._reports.get((chat_id, window))
+        if cached is not None and cached[:2] == (last_id, today):
+            metrics.inc('stats_cache_hits')
+            return cached[2]
+
+        data = self._user(chat_id)
+        if data.last_id < last_id:
+            data.extend(self._journal.chat_activities(chat_id, data.last_id))
+        import numpy as np
+        days = WINDOWS[window]
+        since = None if days is None else np.datetime64(today, 'D') - (days - 1)
+        report = aggregate(data, since)
+        report['window'] = window
+        self._reports[(chat_id, window)] = (last_id, today, report)
+        metrics.observe('stats_report', time.perf_counter() - start)
+        return report
+
+
+activity_stats = ActivityStats(activity_journal)
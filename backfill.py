@@ -0,0 +1,278 @@
+"""Массовый импорт старых транскриптов.
+
+Транскрипты читаются потоком из каталога (по файлу на день, дата берётся
+из имени файла вида 2024-03-05.txt, иначе из времени изменения) или из
+JSONL со строками {"id": ..., "text": ..., "date": "ГГГГ-ММ-ДД", "chat_id": ...}.
+Анализ идёт через тот же шлюз и кэш, что и /analyze, не больше
+--concurrency транскриптов одновременно. Активности пишутся в журнал с
+ключами, зависящими только от транскрипта, а в таблицу уходят пачками
+append_rows через очередь записи. Готовые транскрипты отмечаются в
+журнале, поэтому после падения импорт продолжается с того же места без
+дублей.
+
+    python backfill.py notes/ --chat-id 123456789
+    python backfill.py export.jsonl --concurrency 8 --limit 100
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from datetime import date, datetime
+from typing import Dict, Iterator, List, NamedTuple, Optional, Set
+
+from analysis import analyze_with_chatgpt, parse_analysis
+from analysis_cache import analysis_cache
+from config import LLM_MAX_CONCURRENCY
+from journal import ActivityJournal, activity_journal, journal_syncer, save_rows
+from llm import llm_gateway
+from sheets import sheets_client
+from write_queue import write_queue
+
+logger = logging.getLogger(__name__)
+
+BACKFILL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS backfill_done (
+    source TEXT PRIMARY KEY,
+    activities INTEGER NOT NULL,
+    done_at REAL NOT NULL
+);
+"""
+
+TRANSCRIPT_SUFFIXES = ('.txt', '.md')
+DATE_IN_NAME = re.compile(r'(\d{4}-\d{2}-\d{2})')
+
+# Как часто писать прогресс в лог, секунды
+PROGRESS_INTERVAL = 30
+# Сколько ждать записи остатка строк в таблицу после анализа, секунды
+DRAIN_TIMEOUT = 300
+
+
+class Transcript(NamedTuple):
+    source: str
+    text: str
+    date: str
+    chat_id: Optional[int]
+
+
+def parse_date(value: Optional[str]) -> Optional[str]:
+    """Дата 'ГГГГ-ММ-ДД' или None, если значение не похоже на дату."""
+    try:
+        return datetime.strptime(str(value)[:10], '%Y-%m-%d').strftime('%Y-%m-%d')
+    except ValueError:
+        return None
+
+
+def read_directory(path: str, chat_id: Optional[int], done: Set[str]) -> Iterator[Transcript]:
+    """Файлы транскриптов каталога по порядку имён; готовые не читаются."""
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.endswith(TRANSCRIPT_SUFFIXES):
+                continue
+            file_path = os.path.join(root, name)
+            source = os.path.relpath(file_path, path)
+            if source in done:
+                continue
+            match = DATE_IN_NAME.search(name)
+            day = parse_date(match.group(1)) if match else None
+            if day is None:
+                day = date.fromtimestamp(os.path.getmtime(file_path)).isoformat()
+            with open(file_path, encoding='utf-8') as file:
+                yield Transcript(source, file.read(), day, chat_id)
+
+
+def read_jsonl(path: str, chat_id: Optional[int], done: Set[str]) -> Iterator[Transcript]:
+    """Транскрипты из JSONL; без id источником считается номер строки."""
+    name = os.path.basename(path)
+    with open(path, encoding='utf-8') as file:
+        for number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError as e:
+                logger.error(f"Строка {number} не разобрана: {e}")
+                continue
+            source = str(record.get('id') or f'{name}:{number}')
+            if source in done:
+                continue
+            day = parse_date(record.get('date'))
+            if day is None:
+                logger.warning(f"У транскрипта {source} нет даты, ставим сегодняшнюю")
+                day = date.today().isoformat()
+            yield Transcript(source, record.get('text', ''), day, record.get('chat_id', chat_id))
+
+
+def read_transcripts(path: str, chat_id: Optional[int], done: Set[str]) -> Iterator[Transcript]:
+    if os.path.isdir(path):
+        return read_directory(path, chat_id, done)
+    return read_jsonl(path, chat_id, done)
+
+
+def activity_key(source: str, index: int) -> str:
+    """Ключ строки, одинаковый при повторном импорте того же транскрипта."""
+    return hashlib.sha256(f'{source}\n{index}'.encode('utf-8')).hexdigest()[:32]
+
+
+def make_rows(activities: List[Dict], day: str) -> List[List]:
+    """Строки таблицы в порядке journal.ROW_COLUMNS с датой транскрипта."""
+    return [
+        [
+            day,
+            activity['text'],
+            activity.get('energy', '0'),
+            activity.get('roles', ''),
+            activity.get('skills', ''),
+            activity.get('summary', ''),
+        ]
+        for activity in activities
+    ]
+
+
+class Backfill:
+    """Импорт транскриптов с отметкой готовых в журнале."""
+
+    def __init__(self, journal: ActivityJournal, concurrency: int = LLM_MAX_CONCURRENCY):
+        self._journal = journal
+        self._concurrency = concurrency
+        self._journal.db.executescript(BACKFILL_SCHEMA)
+        self.done = 0
+        self.failed = 0
+        self.empty = 0
+        self.activities = 0
+        self.skipped = 0
+        self._started = time.perf_counter()
+        self._reported = self._started
+
+    def finished_sources(self) -> Set[str]:
+        return {row[0] for row in self._journal.db.execute('SELECT source FROM backfill_done')}
+
+    def _mark_done(self, source: str, activities: int) -> None:
+        with self._journal.db:
+            self._journal.db.execute(
+                'INSERT OR REPLACE INTO backfill_done (source, activities, done_at) VALUES (?, ?, ?)',
+                (source, activities, time.time())
+            )
+
+    def per_minute(self) -> float:
+        elapsed = time.perf_counter() - self._started
+        return self.done / elapsed * 60 if elapsed else 0.0
+
+    async def import_one(self, transcript: Transcript) -> None:
+        try:
+            response = await analyze_with_chatgpt(transcript.text)
+            activities = parse_analysis(response)
+        except Exception as e:
+            # Транскрипт не отмечается готовым и будет повторён при следующем запуске
+            self.failed += 1
+            logger.error(f"Транскрипт {transcript.source} не разобран: {e}")
+            return
+        if activities:
+            save_rows(
+                transcript.chat_id, make_rows(activities, transcript.date),
+                contexts=[activity.get('contexts', '') for activity in activities],
+                keys=[activity_key(transcript.source, index) for index in range(len(activities))]
+            )
+        else:
+            self.empty += 1
+            logger.warning(f"В транскрипте {transcript.source} не найдено активностей")
+        # Строки уже в журнале: после падения они допишутся в таблицу и без повторного анализа
+        self._mark_done(transcript.source, len(activities))
+        self.done += 1
+        self.activities += len(activities)
+        now = time.perf_counter()
+        if now - self._reported >= PROGRESS_INTERVAL:
+            self._reported = now
+            logger.info(
+                f"Импортировано транскриптов: {self.done}, ошибок: {self.failed}, "
+                f"{self.per_minute():.1f} в минуту"
+            )
+
+    async def run(self, transcripts: Iterator[Transcript], limit: Optional[int] = None) -> None:
+        """Анализ потока транскриптов, не больше concurrency одновременно."""
+        semaphore = asyncio.Semaphore(self._concurrency)
+        tasks = set()
+
+        async def worker(transcript: Transcript) -> None:
+            try:
+                await self.import_one(transcript)
+            finally:
+                semaphore.release()
+
+        started = 0
+        for transcript in transcripts:
+            if limit is not None and started >= limit:
+                break
+            if not transcript.text.strip():
+                self.skipped += 1
+                continue
+            await semaphore.acquire()
+            task = asyncio.create_task(worker(transcript))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            started += 1
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    def report(self, drained: bool) -> Dict:
+        return {
+            'transcripts': self.done,
+            'failed': self.failed,
+            'without_activities': self.empty,
+            'skipped_empty': self.skipped,
+            'activities': self.activities,
+            'seconds': round(time.perf_counter() - self._started, 1),
+            'transcripts_per_minute': round(self.per_minute(), 1),
+            'analysis_cache_hits': analysis_cache.hits,
+            'rows_waiting_for_sheets': self._journal.unsynced_count(),
+            'sheets_drained': drained,
+        }
+
+
+async def drain(journal: ActivityJournal, timeout: float) -> bool:
+    """Ожидание записи строк журнала в таблицу."""
+    deadline = time.monotonic() + timeout
+    while journal.unsynced_count():
+        if time.monotonic() >= deadline:
+            return False
+        await asyncio.sleep(1)
+    return True
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path', help='каталог с транскриптами или файл JSONL')
+    parser.add_argument('--chat-id', type=int, help='пользователь, если не указан в записи')
+    parser.add_argument('--concurrency', type=int, default=LLM_MAX_CONCURRENCY,
+                        help='транскриптов в анализе одновременно')
+    parser.add_argument('--limit', type=int, help='импортировать не больше стольких транскриптов')
+    parser.add_argument('--drain-timeout', type=float, default=DRAIN_TIMEOUT,
+                        help='сколько ждать записи остатка строк в таблицу, секунды')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    backfill = Backfill(activity_journal, args.concurrency)
+    done = backfill.finished_sources()
+    if done:
+        logger.info(f"Продолжаем импорт, уже готово транскриптов: {len(done)}")
+
+    sheets_client.start()
+    write_queue.start()
+    journal_syncer.start()
+    try:
+        await backfill.run(read_transcripts(args.path, args.chat_id, done), args.limit)
+        drained = await drain(activity_journal, args.drain_timeout)
+    finally:
+        await journal_syncer.stop()
+        await write_queue.stop()
+        await sheets_client.stop()
+        await llm_gateway.close()
+    print(json.dumps(backfill.report(drained), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,443 @@
+"""Сквозной бенчмарк обработчиков бота без сети.
+
+Настоящее приложение из bot.build_application() получает синтетические
+обновления от N одновременных пользователей: запись активностей вручную
+(/start, активности, энергия, «Закончить», время напоминания) и разбор
+транскрипта (/analyze, «Всё верно»). Telegram, Google Sheets и OpenAI
+заменены локальными имитациями с настраиваемыми задержкой и долей
+ошибок. Результат - JSON с p50/p95/p99 по обработчикам и пропускной
+способностью; с --baseline прогон сравнивается с сохранённым.
+
+    python benchmark.py --users 50 --openai-latency 0.5 --sheets-latency 0.3 --output bench.json
+    python benchmark.py --users 50 --baseline bench.json --max-regression 0.2
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+import gspread
+import httpx
+import numpy as np
+import requests
+from telegram.ext import BaseRateLimiter
+
+from fake_openai import completion, fake_analysis, stream_body
+
+ACTIVITIES = (
+    'Писал код для проекта',
+    'Созвон с командой по планированию',
+    'Гулял с собакой в парке',
+    'Читал книгу по архитектуре',
+    'Готовил ужин для семьи',
+    'Тренировка в зале',
+    'Разбирал почту',
+)
+
+RANGE = re.compile(r"^'?(.*?)'?(?:!([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?)?$")
+# Диапазон без имени листа, он относится к первому листу
+CELLS = re.compile(r'^[A-Z]+\d*(?::[A-Z]+\d*)?$')
+
+
+def api_error(code: int, message: str, status: str) -> gspread.exceptions.APIError:
+    response = requests.Response()
+    response.status_code = code
+    response._content = json.dumps({'error': {
+        'code': code, 'message': message, 'status': status
+    }}).encode()
+    return gspread.exceptions.APIError(response)
+
+
+def quota_error() -> gspread.exceptions.APIError:
+    return api_error(429, 'Quota exceeded', 'RESOURCE_EXHAUSTED')
+
+
+class FakeSpreadsheet:
+    """Таблица в памяти на месте gspread.Spreadsheet.
+
+    Настоящие gspread.Worksheet, которые создаёт SheetsClient, ходят в
+    неё через values_* методы. Каждый вызов ждёт latency секунд (из
+    потока asyncio.to_thread, как настоящий HTTP-запрос), а доля
+    error_rate записей и чтений отклоняется с 429. Сигнатуры методов
+    повторяют gspread 5.12, запрос без тела отклоняется с 400, как это
+    сделал бы Sheets API.
+    """
+
+    client = None
+
+    def __init__(self, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.sheets: Dict[str, List[List[str]]] = {}
+        self.properties: Dict[str, Dict] = {}
+        self.modified = 0
+        self.requests = 0
+        self.rejected = 0
+        self._add('Sheet1')
+
+    def _add(self, title: str) -> Dict:
+        self.sheets[title] = []
+        self.properties[title] = {
+            'sheetId': len(self.properties), 'title': title, 'index': len(self.properties),
+            'gridProperties': {'rowCount': 1, 'columnCount': 7},
+        }
+        return self.properties[title]
+
+    def _request(self, may_fail: bool = False) -> None:
+        self.requests += 1
+        time.sleep(self.latency)
+        if may_fail and random.random() < self.error_rate:
+            self.rejected += 1
+            raise quota_error()
+
+    @staticmethod
+    def _parse(range_name: str):
+        if CELLS.match(range_name):
+            range_name = f"'Sheet1'!{range_name}"
+        title, first_col, first_row, last_col, last_row = RANGE.match(range_name).groups()
+        return title, first_col, int(first_row or 1), int(last_row) if last_row else None
+
+    @staticmethod
+    def _check_body(body: Optional[Dict], *fields: str) -> None:
+        missing = [field for field in fields if not (body or {}).get(field)]
+        if missing:
+            raise api_error(400, f"Missing required field: {', '.join(missing)}", 'INVALID_ARGUMENT')
+
+    @property
+    def sheet1(self) -> gspread.Worksheet:
+        return gspread.Worksheet(self, self.properties['Sheet1'])
+
+    def fetch_sheet_metadata(self, params=None) -> Dict:
+        self._request()
+        return {'sheets': [{'properties': properties} for properties in self.properties.values()]}
+
+    def add_worksheet(self, title: str, rows: int, cols: int,
+                      index: Optional[int] = None) -> gspread.Worksheet:
+        self._request()
+        return gspread.Worksheet(self, self._add(title))
+
+    def get_lastUpdateTime(self) -> str:
+        self._request()
+        return str(self.modified)
+
+    def values_append(self, range: str, params: Dict, body: Dict) -> Dict:
+        self._request(may_fail=True)
+        self._check_body(body, 'values')
+        title = self._parse(range)[0]
+        self.sheets[title].extend([str(value) for value in row] for row in body['values'])
+        self.modified += 1
+        return {}
+
+    def values_get(self, range: str, params: Optional[Dict] = None) -> Dict:
+        self._request(may_fail=True)
+        title, column, _, _ = self._parse(range)
+        index = gspread.utils.a1_to_rowcol(f'{column}1')[1] - 1
+        return {'values': [[row[index] if index < len(row) else '' for row in self.sheets[title]]]}
+
+    def values_batch_get(self, ranges: List[str], params: Optional[Dict] = None) -> Dict:
+        self._request(may_fail=True)
+        value_ranges = []
+        for range_name in ranges:
+            title, _, first, last = self._parse(range_name)
+            value_ranges.append({'range': range_name, 'values': self.sheets[title][first - 1:last]})
+        return {'valueRanges': value_ranges}
+
+    def values_batch_update(self, params: Optional[Dict] = None, body: Optional[Dict] = None) -> Dict:
+        self._request(may_fail=True)
+        self._check_body(body, 'valueInputOption', 'data')
+        for data in body['data']:
+            title, column, row, _ = self._parse(data['range'])
+            index = gspread.utils.a1_to_rowcol(f'{column}1')[1] - 1
+            cells = self.sheets[title][row - 1]
+            cells.extend([''] * (index + 1 - len(cells)))
+            cells[index] = data['values'][0][0]
+        self.modified += 1
+        return {}
+
+    def data_rows(self) -> int:
+        return sum(len([row for row in rows if row and row[0][:1].isdigit()])
+                   for rows in self.sheets.values())
+
+
+class FakeCredentials:
+    """Действующий токен, чтобы фоновое обновление токена спало."""
+
+    valid = True
+
+    def __init__(self):
+        self.expiry = datetime.utcnow() + timedelta(days=1)
+
+
+class NoRateLimit(BaseRateLimiter):
+    """Отправка без лимитов Telegram, чтобы мерить сами обработчики."""
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        return await callback(*args, **kwargs)
+
+
+def openai_transport(latency: float, error_rate: float, stats: Dict) -> httpx.MockTransport:
+    """Ответы OpenAI без сети для httpx-клиента шлюза llm.py."""
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        stats['requests'] += 1
+        await asyncio.sleep(latency)
+        if random.random() < error_rate:
+            stats['rejected'] += 1
+            return httpx.Response(
+                429, headers={'retry-after': '0.5'},
+                json={'error': {'message': 'Rate limit reached', 'type': 'requests'}}
+            )
+        body = json.loads(request.content)
+        model = body.get('model', 'fake')
+        completion_id = f"chatcmpl-bench{stats['requests']}"
+        content = json.dumps(fake_analysis(body.get('messages', [])), ensure_ascii=False)
+        if body.get('stream'):
+            return httpx.Response(
+                200, headers={'content-type': 'text/event-stream'},
+                content=b''.join(stream_body(content, model, completion_id, 10))
+            )
+        return httpx.Response(200, json=completion(content, model, completion_id))
+
+    return httpx.MockTransport(handler)
+
+
+def manual_steps(user: int, activities: int) -> List[str]:
+    steps = ['/start']
+    for index in range(activities):
+        steps += [f'{random.choice(ACTIVITIES)} ({user}-{index})', random.choice(('-1', '0', '1', '2'))]
+    return steps + ['Закончить', f'{random.randint(0, 23):02d}:{random.randint(0, 59):02d}']
+
+
+def transcript_steps(user: int, lines: int) -> List[str]:
+    # Уникальный текст, чтобы не попадать в кэш анализа
+    text = '\n'.join(f'{9 + index}:00 {random.choice(ACTIVITIES)} #{user}' for index in range(lines))
+    return [f'/analyze {text}', 'Всё верно']
+
+
+def summarize(samples: List[float]) -> Dict:
+    values = np.array(samples) * 1000
+    return {
+        'count': len(samples),
+        'p50_ms': round(float(np.percentile(values, 50)), 2),
+        'p95_ms': round(float(np.percentile(values, 95)), 2),
+        'p99_ms': round(float(np.percentile(values, 99)), 2),
+        'max_ms': round(float(values.max()), 2),
+    }
+
+
+def prepare_environment(workdir: str) -> None:
+    """Отдельные базы для прогона.
+
+    Вызывается до импорта модулей бота, включая loadgen: config читает
+    окружение один раз при первом импорте.
+    """
+    for name in ('JOURNAL_PATH', 'PERSISTENCE_PATH', 'REMINDERS_PATH', 'ANALYSIS_CACHE_PATH'):
+        os.environ[name] = os.path.join(workdir, name.lower().replace('_path', '.db'))
+    os.environ.setdefault('OPENAI_API_KEY', 'benchmark')
+
+
+async def run(args: argparse.Namespace) -> Dict:
+    import bot
+    from loadgen import FAKE_TOKEN, FakeTelegramRequest, make_update
+    from openai import AsyncOpenAI
+    from telegram import Update
+    from telegram.ext import Application, ConversationHandler, TypeHandler
+
+    random.seed(args.seed)
+    spreadsheet = FakeSpreadsheet(args.sheets_latency, args.sheets_error_rate)
+    openai_stats = {'requests': 0, 'rejected': 0}
+
+    # Имитации вместо внешних сервисов
+    bot.sheets_client._spreadsheet = spreadsheet
+    bot.sheets_client._credentials = FakeCredentials()
+    bot.sheets_client._connect = lambda: setattr(bot.sheets_client, '_spreadsheet', spreadsheet)
+    bot.llm_gateway._client = AsyncOpenAI(
+        api_key='benchmark', base_url='http://openai.benchmark/v1', max_retries=0,
+        http_client=httpx.AsyncClient(
+            transport=openai_transport(args.openai_latency, args.openai_error_rate, openai_stats)
+        )
+    )
+
+    builder = (
+        Application.builder()
+        .token(FAKE_TOKEN)
+        .request(FakeTelegramRequest())
+        .get_updates_request(FakeTelegramRequest())
+        .updater(None)
+    )
+    rate_limiter = None if args.telegram_limits else NoRateLimit()
+    application = bot.build_application(builder, rate_limiter)
+
+    handler_latency: Dict[str, List[float]] = {}
+    step_latency: Dict[str, List[float]] = {}
+    pending: Dict[int, asyncio.Future] = {}
+    errors = 0
+
+    def instrument(handler) -> None:
+        callback = handler.callback
+        name = callback.__name__
+
+        async def timed(update, context):
+            start = time.perf_counter()
+            try:
+                return await callback(update, context)
+            finally:
+                handler_latency.setdefault(name, []).append(time.perf_counter() - start)
+
+        handler.callback = timed
+
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, ConversationHandler):
+                for inner in (*handler.entry_points, *handler.fallbacks,
+                              *[item for items in handler.states.values() for item in items]):
+                    instrument(inner)
+            else:
+                instrument(handler)
+
+    async def processed(update: Update, context) -> None:
+        future = pending.pop(update.update_id, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def on_error(update, context) -> None:
+        nonlocal errors
+        errors += 1
+        await processed(update, context)
+
+    # Группа 1 выполняется после всех обработчиков группы 0
+    application.add_handler(TypeHandler(Update, processed), group=1)
+    application.add_error_handler(on_error)
+
+    update_ids = iter(range(1, 10 ** 9))
+
+    async def session(user_id: int, steps: List[str]) -> None:
+        for text in steps:
+            update_id = next(update_ids)
+            future = asyncio.get_running_loop().create_future()
+            pending[update_id] = future
+            step = text.split()[0] if text.startswith('/') else 'message'
+            start = time.perf_counter()
+            await application.update_queue.put(
+                Update.de_json(make_update(update_id, user_id, text), application.bot)
+            )
+            await future
+            step_latency.setdefault(step, []).append(time.perf_counter() - start)
+            if args.think:
+                await asyncio.sleep(args.think)
+
+    sessions = []
+    for index in range(args.users):
+        user_id = 100000 + index
+        if random.random() < args.transcript_share:
+            sessions.append((user_id, transcript_steps(user_id, args.transcript_lines)))
+        else:
+            sessions.append((user_id, manual_steps(user_id, args.activities)))
+    total_updates = sum(len(steps) for _, steps in sessions)
+
+    async with application:
+        await bot.post_init(application)
+        await application.start()
+        start = time.perf_counter()
+        await asyncio.gather(*(session(user_id, steps) for user_id, steps in sessions))
+        elapsed = time.perf_counter() - start
+        await application.stop()
+        # Остановка фоновых задач дописывает очередь строк в таблицу
+        await bot.post_shutdown(application)
+    drained = time.perf_counter() - start
+
+    counters = bot.metrics.snapshot()['counters']
+    return {
+        'config': {key: value for key, value in vars(args).items()
+                   if key not in ('output', 'baseline', 'max_regression', 'min_delta_ms')},
+        'updates': total_updates,
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(total_updates / elapsed, 1),
+        'seconds_until_sheets_drained': round(drained, 3),
+        'handlers': {name: summarize(samples) for name, samples in sorted(handler_latency.items())},
+        'steps': {name: summarize(samples) for name, samples in sorted(step_latency.items())},
+        'sheets': {
+            'requests': spreadsheet.requests,
+            'rejected': spreadsheet.rejected,
+            'rows_written': spreadsheet.data_rows(),
+            'worksheets': len(spreadsheet.sheets),
+        },
+        'openai': openai_stats,
+        'counters': {name: value for name, value in sorted(counters.items())},
+    }
+
+
+def compare(result: Dict, baseline: Dict, max_regression: float,
+            min_delta_ms: float) -> List[str]:
+    """Обработчики, у которых p95 вырос больше чем на max_regression.
+
+    Рост меньше min_delta_ms не считается: у быстрых обработчиков это шум.
+    """
+    regressions = []
+    for name, stats in result['handlers'].items():
+        previous = baseline.get('handlers', {}).get(name)
+        if not previous or not previous['p95_ms']:
+            continue
+        ratio = stats['p95_ms'] / previous['p95_ms']
+        if ratio > 1 + max_regression and stats['p95_ms'] - previous['p95_ms'] > min_delta_ms:
+            regressions.append(f"{name}: p95 {previous['p95_ms']} -> {stats['p95_ms']} мс")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=20, help='одновременных пользователей')
+    parser.add_argument('--activities', type=int, default=3, help='активностей в ручной записи')
+    parser.add_argument('--transcript-share', type=float, default=0.3,
+                        help='доля пользователей, присылающих транскрипт')
+    parser.add_argument('--transcript-lines', type=int, default=8)
+    parser.add_argument('--think', type=float, default=0.0, help='пауза пользователя между сообщениями')
+    parser.add_argument('--openai-latency', type=float, default=0.3)
+    parser.add_argument('--openai-error-rate', type=float, default=0.0)
+    parser.add_argument('--sheets-latency', type=float, default=0.2)
+    parser.add_argument('--sheets-error-rate', type=float, default=0.0)
+    parser.add_argument('--telegram-limits', action='store_true',
+                        help='включить лимиты Telegram (PriorityRateLimiter)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='куда сохранить JSON с результатом')
+    parser.add_argument('--baseline', help='JSON прошлого прогона для сравнения')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='допустимый рост p95 относительно --baseline')
+    parser.add_argument('--min-delta-ms', type=float, default=5.0,
+                        help='рост p95 меньше этого не считается регрессией')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        prepare_environment(workdir)
+        result = asyncio.run(run(args))
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            result['regressions'] = compare(
+                result, json.load(file), args.max_regression, args.min_delta_ms
+            )
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(output)
+    if result.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,17 @@
-from config import BOT_TOKEN, SPREADSHEET_ID
-import os
+import time
+# Начало отсчёта времени запуска: всё, что ниже, входит в холодный старт
+STARTED = time.perf_counter()
+
+from config import (
+    ConfigError, validate, BOT_TOKEN, BOT_MODE, MAX_CONCURRENT_UPDATES, PERSISTENCE_PATH,
+    WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET
+)
 import logging
-from datetime import datetime, timedelta, time
+from datetime import datetime
 import pytz
 import asyncio
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram.error import Forbidden, NetworkError
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -13,16 +20,22 @@ from telegram.ext import (
     ContextTypes,
     filters
 )
-import gspread
-from google.oauth2.service_account import Credentials
-from prompts import Categories, SYSTEM_PROMPT, ANALYSIS_PROMPT
-import json
-import re
-import openai
-from typing import Dict, List
-
-# Установка ключа OpenAI
-openai.api_key = os.getenv('OPENAI_API_KEY')
+import metrics
+from metrics_server import metrics_server
+from prompts import get_categories
+from typing import Dict, List, Set
+from analysis import parse_analysis, parse_partial_analysis, stream_analysis
+from sheets import sheets_client
+from write_queue import write_queue
+from journal import journal_syncer, save_rows
+from sheets_sync import sheets_mirror
+from tagger import needs_llm, tag_activities, tag_activity
+from update_processor import PerChatUpdateProcessor
+from persistence import SQLitePersistence
+from reminders import reminder_scheduler
+from llm import llm_gateway
+from analytics import STAT_FIELDS, WINDOWS, DEFAULT_WINDOW, activity_stats
+from rate_limiter import PRIORITY_BULK, PriorityRateLimiter
 
 # Логирование
 logging.basicConfig(
@@ -34,48 +47,66 @@ logger = logging.getLogger(__name__)
 # Состояния диалога
 ACTIVITY, ENERGY_STATUS, SET_TIME, TRANSCRIPT_REVIEW = range(4)
 
-def setup_google_sheets():
-    """Настройка подключения к Google Sheets."""
-    try:
-        logger.info("Начинаем подключение к Google Sheets")
-        
-        google_creds_str = os.getenv('GOOGLE_CREDENTIALS')
-        if not google_creds_str:
-            logger.error("Переменная GOOGLE_CREDENTIALS не найдена")
-            return None
-            
-        try:
-            temp_creds_path = '/tmp/temp_credentials.json'
-            with open(temp_creds_path, 'w') as f:
-                f.write(google_creds_str)
-            logger.info("Временный файл credentials создан успешно")
-            
-            credentials = Credentials.from_service_account_file(
-                temp_creds_path,
-                scopes=['https://www.googleapis.com/auth/spreadsheets',
-                       'https://www.googleapis.com/auth/drive']
-            )
-            
-            os.remove(temp_creds_path)
-            logger.info("Временный файл credentials удален")
-            
-            client = gspread.authorize(credentials)
-            logger.info("Авторизация с Google выполнена успешно")
-            
-            sheet = client.open_by_key(SPREADSHEET_ID).sheet1
-            logger.info(f"Подключение к таблице {SPREADSHEET_ID} выполнено успешно")
-            
-            return sheet
-            
-        except Exception as e:
-            logger.error(f"Ошибка при работе с credentials: {str(e)}")
-            if os.path.exists(temp_creds_path):
-                os.remove(temp_creds_path)
-            return None
-            
-    except Exception as e:
-        logger.error(f"Ошибка подключения к Google Sheets: {str(e)}")
-        return None
+# Не чаще одного редактирования сообщения за столько секунд
+EDIT_INTERVAL = 1.5
+MAX_MESSAGE_LENGTH = 4096
+
+REMINDER_TEXT = "Привет! Расскажи, что ты делал сегодня. Используй /start для начала записи."
+STAT_TITLES = {'roles': 'Роли', 'skills': 'Навыки', 'contexts': 'Контексты'}
+WINDOW_TITLES = {'week': 'неделю', 'month': 'месяц', 'year': 'год', 'all': 'всё время'}
+# Сколько самых заряжающих и самых выматывающих тегов показывать
+STATS_TOP = 3
+
+# Сколько напоминаний одновременно ждут отправки; темп задаёт PriorityRateLimiter
+REMINDER_CONCURRENCY = 100
+REMINDER_RETRIES = 3
+
+# Фоновая разметка активностей через ChatGPT по чатам
+_tagging: Dict[int, Set[asyncio.Task]] = {}
+
+def start_llm_tagging(chat_id: int, activity: Dict) -> None:
+    """Доразметка активности через ChatGPT, пока пользователь продолжает диалог."""
+    tasks = _tagging.setdefault(chat_id, set())
+    task = asyncio.create_task(tag_activities([activity]))
+    tasks.add(task)
+
+    def forget(task: asyncio.Task) -> None:
+        tasks.discard(task)
+        if not tasks and _tagging.get(chat_id) is tasks:
+            del _tagging[chat_id]
+
+    task.add_done_callback(forget)
+
+def cancel_llm_tagging(chat_id: int) -> None:
+    """Отмена разметки, не успевшей до сохранения: строки уже ушли с локальными тегами."""
+    tasks = [task for task in _tagging.pop(chat_id, ()) if not task.done()]
+    for task in tasks:
+        task.cancel()
+    if tasks:
+        metrics.inc('llm_tagging_cancelled', len(tasks))
+
+def save_activities(chat_id: int, activities: List[Dict]) -> None:
+    """Запись активностей в журнал, откуда они уходят в таблицу."""
+    save_rows(
+        chat_id, build_rows(activities),
+        contexts=[activity.get('contexts', '') for activity in activities]
+    )
+
+def build_rows(activities: List[Dict]) -> List[List]:
+    """Формирование строк таблицы из активностей."""
+    cet_tz = pytz.timezone('Europe/Paris')
+    date = datetime.now(cet_tz).strftime('%Y-%m-%d')
+    return [
+        [
+            date,
+            activity['text'],
+            activity.get('energy', '0'),  # Нейтральная энергия по умолчанию
+            activity.get('roles', ''),    # Роли из ChatGPT
+            activity.get('skills', ''),   # Скилы из ChatGPT
+            activity.get('summary', '')   # Конспект из ChatGPT
+        ]
+        for activity in activities
+    ]
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начало диалога."""
@@ -84,54 +115,48 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         "Привет! Расскажи, что ты делал сегодня. Пиши по одному сообщению на каждую активность.\nКогда закончишь, нажми 'Закончить'.",
         reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
     )
+    cancel_llm_tagging(update.effective_chat.id)
     context.user_data['activities'] = []
     return ACTIVITY
 
-async def analyze_with_chatgpt(text: str) -> str:
-    """Отправка текста в ChatGPT и получение анализа"""
-    try:
-        # Загружаем категории
-        categories = Categories()
-        
-        # Формируем промпт
-        prompt = ANALYSIS_PROMPT.format(
-            справочник_категорий=json.dumps(categories._data, ensure_ascii=False, indent=2),
-            текст=text
-        )
-        
-        response = await openai.ChatCompletion.acreate(
-            model="gpt-4-turbo-preview",
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": prompt}
-            ]
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        logger.error(f"Ошибка при работе с ChatGPT: {e}")
-        raise
+def format_transcript_summary(activities: List[Dict], done: bool = True) -> str:
+    """Текст со списком активностей, найденных в транскрипте."""
+    if not activities and not done:
+        return ''
+    summary = "Вот что я понял из транскрипта:\n\n"
+    for activity in activities:
+        summary += f"- {activity['text']}\n"
+        if activity.get('tags'):
+            summary += f"  Теги: {', '.join(activity['tags'])}\n"
+    if not done:
+        summary += "\nАнализирую дальше..."
+    if len(summary) > MAX_MESSAGE_LENGTH:
+        summary = summary[:MAX_MESSAGE_LENGTH - 1] + '…'
+    return summary
 
-def parse_chatgpt_response(response: str) -> List[Dict]:
-    """Парсинг ответа от ChatGPT в структурированный формат"""
-    activities = []
-    
-    # Разбиваем ответ на секции
-    sections = response.split('\n\n')
-    
-    for section in sections:
-        # Ищем строки с тегами
-        if '[' in section and ']' in section:
-            # Парсим теги и текст
-            tags = re.findall(r'\[(.*?)\]', section)
-            text = section.split('|')[-1].strip() if '|' in section else section
-            
-            activities.append({
-                'text': text,
-                'tags': tags,
-                'raw_section': section  # сохраняем оригинальную секцию для отладки
-            })
-    
-    return activities
+def format_stats(report: Dict) -> str:
+    """Текст отчёта /stats."""
+    title = f"Статистика за {WINDOW_TITLES[report['window']]}"
+    if not report['activities']:
+        return f"{title}: активностей пока нет."
+    lines = [f"{title}: активностей {report['activities']}"]
+    if report['energy'] is not None:
+        lines.append(f"Средняя энергия: {report['energy']:+.1f}")
+    for field in STAT_FIELDS:
+        stats = report[field]
+        if not stats:
+            continue
+        charging = [item for item in stats[:STATS_TOP] if item[2] > 0]
+        draining = [item for item in reversed(stats[-STATS_TOP:]) if item[2] < 0]
+        if not charging and not draining:
+            continue
+        lines.append(f"\n{STAT_TITLES[field]}:")
+        for caption, items in (("Заряжают", charging), ("Забирают энергию", draining)):
+            if items:
+                lines.append(f"  {caption}: " + ', '.join(
+                    f"{name} ({energy:+.1f}, {count} раз)" for name, count, energy in items
+                ))
+    return '\n'.join(lines)
 
 async def process_transcript(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработка транскрипта"""
@@ -140,28 +165,37 @@ async def process_transcript(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if len(text) < 100:  # Минимальная длина для транскрипта
         return ACTIVITY
         
-    await update.message.reply_text("Получил транскрипт. Анализирую...")
+    message = await update.message.reply_text("Получил транскрипт. Анализирую...")
     
     try:
-        # Отправляем в ChatGPT
-        response = await analyze_with_chatgpt(text)
+        # Отправляем в ChatGPT и по мере ответа показываем найденные активности
+        response = ''
+        shown = message.text
+        last_edit = 0.0
+        async for response in stream_analysis(text):
+            now = asyncio.get_running_loop().time()
+            if now - last_edit < EDIT_INTERVAL:
+                continue
+            preview = format_transcript_summary(parse_partial_analysis(response), done=False)
+            if preview and preview != shown:
+                await message.edit_text(preview)
+                shown = preview
+                last_edit = now
         
         # Парсим ответ
-        activities = parse_chatgpt_response(response)
+        activities = parse_analysis(response)
         
         # Сохраняем в контекст для последующей записи
         context.user_data['activities'] = activities
         
         # Показываем результат пользователю
-        summary = "Вот что я понял из транскрипта:\n\n"
-        for activity in activities:
-            summary += f"- {activity['text']}\n"
-            if activity.get('tags'):
-                summary += f"  Теги: {', '.join(activity['tags'])}\n"
+        summary = format_transcript_summary(activities)
+        if summary != shown:
+            await message.edit_text(summary)
         
         keyboard = [['Всё верно', 'Нужны правки']]
         await update.message.reply_text(
-            summary,
+            "Всё верно?",
             reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
         )
         
@@ -179,41 +213,12 @@ async def handle_transcript_review(update: Update, context: ContextTypes.DEFAULT
     answer = update.message.text
     
     if answer == 'Всё верно':
-        # Записываем в таблицу
-        sheet = setup_google_sheets()
-        if not sheet:
-            await update.message.reply_text("Ошибка подключения к таблице.")
-            return ConversationHandler.END
-            
-        cet_tz = pytz.timezone('Europe/Paris')
-        date = datetime.now(cet_tz).strftime('%Y-%m-%d')
-        
-        success = True
-        try:
-            for activity in context.user_data['activities']:
-                sheet.append_row([
-                    date,
-                    activity['text'],
-                    activity.get('energy', '0'),  # Нейтральная энергия по умолчанию
-                    activity.get('roles', ''),    # Роли из ChatGPT
-                    activity.get('skills', ''),   # Скилы из ChatGPT
-                    activity.get('summary', '')   # Конспект из ChatGPT
-                ])
-                await asyncio.sleep(1)
-        except Exception as e:
-            logger.error(f"Ошибка при записи данных: {e}")
-            success = False
-            
-        if success:
-            await update.message.reply_text(
-                "Отлично! Все активности сохранены.",
-                reply_markup=ReplyKeyboardRemove()
-            )
-        else:
-            await update.message.reply_text(
-                "Произошла ошибка при сохранении. Попробуйте позже.",
-                reply_markup=ReplyKeyboardRemove()
-            )
+        # Сохраняем в журнал, в таблицу строки уйдут в фоне
+        save_activities(update.effective_chat.id, context.user_data['activities'])
+        await update.message.reply_text(
+            "Отлично! Все активности сохранены.",
+            reply_markup=ReplyKeyboardRemove()
+        )
         return ConversationHandler.END
         
     else:  # Нужны правки
@@ -232,47 +237,22 @@ async def record_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await update.message.reply_text("Ты не указал ни одной активности. Расскажи, что делал сегодня?")
             return ACTIVITY
 
-        sheet = setup_google_sheets()
-        if not sheet:
-            logger.error("Не удалось получить объект sheet")
-            await update.message.reply_text("Ошибка подключения к таблице. Пожалуйста, попробуйте позже.")
-            return ConversationHandler.END
-
-        cet_tz = pytz.timezone('Europe/Paris')
-        date = datetime.now(cet_tz).strftime('%Y-%m-%d')
-
-        success = True
-        try:
-            for activity in context.user_data['activities']:
-                logger.info(f"Попытка записи активности: {activity}")
-                sheet.append_row([
-                    date, 
-                    activity['text'], 
-                    activity['energy'],
-                    activity.get('roles', ''),  # Роли из ChatGPT
-                    activity.get('skills', ''),  # Скилы из ChatGPT
-                    activity.get('summary', '')  # Конспект из ChatGPT
-                ])
-                logger.info(f"Активность успешно записана: {date}, {activity['text']}, {activity['energy']}")
-                await asyncio.sleep(1)
-        except Exception as e:
-            logger.error(f"Ошибка при записи данных: {str(e)}")
-            success = False
-
-        if success:
-            await update.message.reply_text(
-                "Спасибо! Все данные сохранены. Теперь давай настроим время для ежедневных напоминаний.",
-                reply_markup=ReplyKeyboardRemove()
-            )
-            return SET_TIME
-        else:
-            await update.message.reply_text(
-                "Произошла ошибка при сохранении данных. Пожалуйста, попробуйте позже.",
-                reply_markup=ReplyKeyboardRemove()
-            )
-            return ConversationHandler.END
+        # Сохраняем сразу, с тегами, которые успели прийти; ChatGPT сохранение не задерживает
+        save_activities(update.effective_chat.id, context.user_data['activities'])
+        cancel_llm_tagging(update.effective_chat.id)
+        logger.info(f"В журнал записано активностей: {len(context.user_data['activities'])}")
 
+        await update.message.reply_text(
+            "Спасибо! Все данные сохранены. Теперь давай настроим время для ежедневных напоминаний.",
+            reply_markup=ReplyKeyboardRemove()
+        )
+        return SET_TIME
 
+    activity = {'text': text}
+    tag_activity(activity)
+    if needs_llm(activity):
+        start_llm_tagging(update.effective_chat.id, activity)
+    context.user_data.setdefault('activities', []).append(activity)
     return ENERGY_STATUS
 
 async def record_energy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -315,8 +295,7 @@ async def add_category(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         return
     
     # Добавляем категорию
-    categories = Categories()
-    if categories.add_category(category_type, value):
+    if await get_categories().add(category_type, value):
         await update.message.reply_text(f"Добавлено в {category_type}: {value}")
         
         # Если есть активная активность, добавляем тег к ней
@@ -338,55 +317,52 @@ async def set_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     )
     return SET_TIME
 
-async def daily_reminder(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Сохранение времени уведомлений."""
-    try:
-        user_time = datetime.strptime(update.message.text, '%H:%M').time()
-        context.user_data['reminder_time'] = user_time
-        
-        # Отменяем существующее напоминание, если оно есть
-        if 'reminder_job' in context.user_data:
-            context.user_data['reminder_job'].schedule_removal()
-        
-        # Устанавливаем новое напоминание
-        chat_id = update.effective_chat.id
-        cet_tz = pytz.timezone('Europe/Paris')
-        now = datetime.now(cet_tz)
-        
-        # Вычисляем время до следующего напоминания
-        reminder_time = cet_tz.localize(datetime.combine(now.date(), user_time))
-        if reminder_time < now:
-            reminder_time += timedelta(days=1)
-        
-        # Планируем ежедневное напоминание
-        job = context.job_queue.run_daily(
-            daily_reminder,
-            time=user_time,
-            chat_id=chat_id,
-            name=str(chat_id)
-        )
-        context.user_data['reminder_job'] = job
-        
-        await update.message.reply_text(
-            f"Отлично! Буду напоминать тебе каждый день в {user_time.strftime('%H:%M')}.",
-            reply_markup=ReplyKeyboardRemove()
-        )
-        return ConversationHandler.END
-    except ValueError:
-        await update.message.reply_text(
-            "Неверный формат! Используй два числа и двоеточие, например: 09:00, 14:30, 21:45\n\n" +
-            "Часы должны быть от 00 до 23\n" +
-            "Минуты должны быть от 00 до 59"
-        )
-        return SET_TIME
+async def send_reminder(bot, chat_id: int) -> None:
+    """Отправка одного напоминания с повтором при сетевых ошибках."""
+    for attempt in range(REMINDER_RETRIES):
+        try:
+            await bot.send_message(chat_id, text=REMINDER_TEXT, rate_limit_args=PRIORITY_BULK)
+            metrics.inc('reminders_sent')
+            return
+        except Forbidden as e:
+            # Пользователь заблокировал бота
+            logger.info(f"Отключаем напоминания для {chat_id}: {e}")
+            reminder_scheduler.cancel(chat_id)
+            return
+        except NetworkError as e:
+            if attempt == REMINDER_RETRIES - 1:
+                metrics.inc('reminders_failed')
+                logger.error(f"Не удалось отправить напоминание {chat_id}: {e}")
+                return
+            await asyncio.sleep(2 ** attempt)
+        except Exception as e:
+            metrics.inc('reminders_failed')
+            logger.error(f"Не удалось отправить напоминание {chat_id}: {e}")
+            return
 
-async def daily_reminder(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Ежедневное напоминание."""
-    job = context.job
-    await context.bot.send_message(
-        job.chat_id,
-        text="Привет! Расскажи, что ты делал сегодня. Используй /start для начала записи."
-    )
+async def send_reminders(bot, chat_ids) -> None:
+    """Рассылка ежедневных напоминаний.
+
+    Все напоминания минуты ставятся в очередь с низким приоритетом, не
+    больше REMINDER_CONCURRENCY одновременно, чтобы ответы пользователям
+    уходили раньше рассылки.
+    """
+    semaphore = asyncio.Semaphore(REMINDER_CONCURRENCY)
+    tasks = set()
+
+    async def send(chat_id: int) -> None:
+        try:
+            await send_reminder(bot, chat_id)
+        finally:
+            semaphore.release()
+
+    for chat_id in chat_ids:
+        await semaphore.acquire()
+        task = asyncio.create_task(send(chat_id))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.gather(*tasks)
 
 async def save_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Сохранение времени уведомлений."""
@@ -396,35 +372,14 @@ async def save_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         
         logger.info(f"Устанавливаем напоминание на {user_time}")
         
-        # Отменяем существующее напоминание, если оно есть
-        if 'reminder_job' in context.user_data:
-            logger.info("Удаляем существующее напоминание")
-            context.user_data['reminder_job'].schedule_removal()
-        
-        # Устанавливаем новое напоминание
+        # Новое время заменяет предыдущее напоминание
         chat_id = update.effective_chat.id
-        cet_tz = pytz.timezone('Europe/Paris')
-        now = datetime.now(cet_tz)
-        
-        # Вычисляем время до следующего напоминания
-        reminder_time = cet_tz.localize(datetime.combine(now.date(), user_time))
-        if reminder_time < now:
-            reminder_time += timedelta(days=1)
-        
-        logger.info(f"Следующее напоминание запланировано на {reminder_time}")
-        
-        # Планируем ежедневное напоминание
-        job = context.job_queue.run_daily(
-            daily_reminder,
-            time=user_time,
-            chat_id=chat_id,
-            name=str(chat_id)
-        )
-        context.user_data['reminder_job'] = job
+        tz = reminder_scheduler.set_time(chat_id, user_time.hour * 60 + user_time.minute)
         logger.info("Напоминание успешно запланировано")
         
         await update.message.reply_text(
-            f"Отлично! Буду напоминать тебе каждый день в {user_time.strftime('%H:%M')}.",
+            f"Отлично! Буду напоминать тебе каждый день в {user_time.strftime('%H:%M')} ({tz}).\n"
+            "Сменить часовой пояс: /timezone Europe/Moscow",
             reply_markup=ReplyKeyboardRemove()
         )
         return ConversationHandler.END
@@ -436,9 +391,76 @@ async def save_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         )
         return SET_TIME
 
-def main():
-    """Запуск бота."""
-    application = Application.builder().token(BOT_TOKEN).build()
+async def set_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Смена часового пояса напоминаний."""
+    if not context.args:
+        await update.message.reply_text("Укажи часовой пояс, например: /timezone Europe/Moscow")
+        return
+    tz = context.args[0]
+    try:
+        reminder_scheduler.set_timezone(update.effective_chat.id, tz)
+    except pytz.UnknownTimeZoneError:
+        await update.message.reply_text(f"Не знаю часовой пояс {tz}. Пример: Europe/Moscow, Asia/Almaty")
+        return
+    await update.message.reply_text(f"Часовой пояс напоминаний: {tz}")
+
+async def show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Статистика энергии по ролям, навыкам и контекстам: /stats [week|month|year|all]."""
+    window = context.args[0].lower() if context.args else DEFAULT_WINDOW
+    if window not in WINDOWS:
+        await update.message.reply_text("Используй: /stats week, /stats month, /stats year или /stats all")
+        return
+    report = activity_stats.report(update.effective_chat.id, window)
+    await update.message.reply_text(format_stats(report))
+
+async def post_init(application: Application) -> None:
+    """Запуск фоновых задач после инициализации бота."""
+    sheets_client.start()
+    write_queue.start()
+    journal_syncer.start()
+    sheets_mirror.start()
+    reminder_scheduler.start(lambda chat_ids: send_reminders(application.bot, chat_ids))
+    metrics_server.start()
+    startup = time.perf_counter() - STARTED
+    metrics.gauge('startup_seconds', startup)
+    logger.info(f"Бот запущен за {startup:.2f} с")
+
+async def post_shutdown(application: Application) -> None:
+    """Остановка фоновых задач."""
+    await reminder_scheduler.stop()
+    for chat_id in list(_tagging):
+        cancel_llm_tagging(chat_id)
+    await sheets_mirror.stop()
+    await journal_syncer.stop()
+    await write_queue.stop()
+    await sheets_client.stop()
+    await llm_gateway.close()
+    await metrics_server.stop()
+
+def instrument_handlers(handlers) -> None:
+    """Гистограмма времени каждого обработчика, включая состояния диалога."""
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            instrument_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                instrument_handlers(state_handlers)
+            instrument_handlers(handler.fallbacks)
+        else:
+            name = handler.callback.__name__
+            handler.callback = metrics.timed('handler_latency', handler=name)(handler.callback)
+
+def build_application(builder=None, rate_limiter=None) -> Application:
+    """Создание бота со всеми обработчиками."""
+    builder = builder or Application.builder().token(BOT_TOKEN)
+    application = (
+        builder
+        .concurrent_updates(PerChatUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .rate_limiter(rate_limiter or PriorityRateLimiter())
+        .persistence(SQLitePersistence(PERSISTENCE_PATH))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Основной обработчик диалога
     conv_handler = ConversationHandler(
@@ -463,6 +485,7 @@ def main():
             SET_TIME: [
                 MessageHandler(
                     filters.TEXT & ~filters.COMMAND,
+                    save_time
                 )
             ],
             TRANSCRIPT_REVIEW: [
@@ -473,7 +496,9 @@ def main():
             ],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
-        allow_reentry=True
+        allow_reentry=True,
+        name='activity',
+        persistent=True
     )
 
     # Добавляем обработчики
@@ -487,8 +512,35 @@ def main():
     
     # Отдельный обработчик для изменения времени
     application.add_handler(CommandHandler('change_time', set_time))
-    
-    application.run_polling()
+    application.add_handler(CommandHandler('timezone', set_timezone))
+    application.add_handler(CommandHandler('stats', show_stats))
+
+    for handlers in application.handlers.values():
+        instrument_handlers(handlers)
+    return application
+
+def main():
+    """Запуск бота."""
+    try:
+        warnings = validate()
+    except ConfigError as e:
+        logger.error(f"Ошибка настроек: {e}")
+        raise SystemExit(1)
+    for warning in warnings:
+        logger.warning(warning)
+    application = build_application()
+
+    if BOT_MODE == 'webhook':
+        logger.info(f"Запуск в режиме webhook на порту {WEBHOOK_PORT}")
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET
+        )
+    else:
+        application.run_polling()
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
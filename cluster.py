@@ -0,0 +1,421 @@
+"""Запуск бота несколькими процессами-обработчиками.
+
+Передний процесс принимает обновления (webhook или, для локальной
+отладки, getUpdates) и по согласованному хэшу chat_id отправляет каждое
+в очередь одного из N процессов-обработчиков. Обработчик - обычный бот
+из bot.build_application без updater; свои журнал, состояние диалогов и
+напоминания он держит в отдельных файлах activities-w2.db и т.п., так
+что данные пользователя живут только в его процессе. Справочник
+категорий общий: после добавления категории обработчик сообщает об этом
+переднему процессу, а тот рассылает уведомление остальным. Упавший
+обработчик перезапускается, очередь его обновлений сохраняется.
+
+Обработчики запускаются через spawn и заново импортируют этот модуль,
+поэтому здесь на верхнем уровне нет config и модулей бота: настройки
+процесса-обработчика должны попасть в окружение до их импорта.
+
+    python cluster.py --workers 4
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+from typing import Callable, Dict, Iterable, List, Optional
+
+from tornado.httpserver import HTTPServer
+from tornado.web import Application as WebApplication, HTTPError, RequestHandler
+
+logger = logging.getLogger(__name__)
+
+# Сколько точек на кольце у каждого обработчика
+RING_REPLICAS = 256
+# Сколько обновлений ждут в очереди одного обработчика; дальше webhook отвечает 503
+QUEUE_SIZE = 10000
+# Сколько обновлений обработчик забирает из очереди за раз
+RECEIVE_BATCH = 100
+# Как долго обработчик ждёт обновление, прежде чем проверить остановку, секунды
+RECEIVE_TIMEOUT = 1.0
+# Как часто проверяется, живы ли обработчики, секунды
+MONITOR_INTERVAL = 2.0
+# Сколько ждать остановки обработчика, прежде чем завершить его принудительно, секунды
+STOP_TIMEOUT = 30.0
+# Таймаут long polling в режиме polling, секунды
+POLL_TIMEOUT = 30
+
+# Файлы, у каждого обработчика свои; кэш анализа остаётся общим
+SHARDED_PATHS = ('JOURNAL_PATH', 'PERSISTENCE_PATH', 'REMINDERS_PATH')
+
+# Поля обновления, в которых chat лежит на верхнем уровне объекта
+CHAT_FIELDS = (
+    'message', 'edited_message', 'channel_post', 'edited_channel_post',
+    'my_chat_member', 'chat_member', 'chat_join_request',
+)
+# Поля обновления без чата, где маршрут задаёт пользователь
+USER_FIELDS = ('inline_query', 'chosen_inline_result', 'shipping_query', 'pre_checkout_query')
+
+
+def stable_hash(value: str) -> int:
+    """Хэш, одинаковый во всех процессах и при перезапусках, в отличие от hash()."""
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """Согласованное хэширование: при смене числа узлов переезжает около 1/N ключей."""
+
+    def __init__(self, nodes: Iterable[int], replicas: int = RING_REPLICAS):
+        points = sorted(
+            (stable_hash(f'w{node}:{replica}'), node)
+            for node in nodes
+            for replica in range(replicas)
+        )
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node(self, key) -> int:
+        index = bisect.bisect(self._hashes, stable_hash(str(key)))
+        return self._nodes[index % len(self._nodes)]
+
+
+def update_chat_id(data: Dict) -> Optional[int]:
+    """chat_id обновления Bot API без разбора в объекты telegram."""
+    for field in CHAT_FIELDS:
+        if field in data:
+            return data[field].get('chat', {}).get('id')
+    if 'callback_query' in data:
+        query = data['callback_query']
+        message = query.get('message')
+        if message:
+            return message['chat']['id']
+        return query['from']['id']
+    for field in USER_FIELDS:
+        if field in data:
+            return data[field]['from']['id']
+    if 'poll_answer' in data:
+        user = data['poll_answer'].get('user')
+        return user['id'] if user else None
+    return None
+
+
+def shard_path(path: str, index: int) -> str:
+    """activities.db -> activities-w2.db"""
+    root, extension = os.path.splitext(path)
+    return f'{root}-w{index}{extension}'
+
+
+def run_worker(index: int, env: Dict[str, str], updates, events,
+               builder_factory: Optional[Callable] = None) -> None:
+    """Точка входа процесса-обработчика."""
+    os.environ.update(env)
+    # Ctrl+C получает вся группа процессов; останавливает обработчики передний процесс
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_worker(index, updates, events, builder_factory))
+
+
+async def serve_worker(index: int, updates, events, builder_factory: Optional[Callable]) -> None:
+    import bot
+    from telegram import Update
+    from telegram.ext import Application
+    from config import BOT_TOKEN, WORKERS
+    from prompts import get_categories
+    from rate_limiter import GLOBAL_RATE, PriorityRateLimiter
+
+    if builder_factory is not None:
+        builder = builder_factory(index)
+    else:
+        builder = Application.builder().token(BOT_TOKEN).updater(None)
+    # Лимит Telegram общий на бота, поэтому делится между обработчиками
+    application = bot.build_application(builder, PriorityRateLimiter(global_rate=GLOBAL_RATE / WORKERS))
+    get_categories().listeners.append(lambda: events.put(('categories', index)))
+
+    def receive() -> List:
+        try:
+            batch = [updates.get(timeout=RECEIVE_TIMEOUT)]
+        except queue.Empty:
+            return []
+        while len(batch) < RECEIVE_BATCH:
+            try:
+                batch.append(updates.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    await bot.post_init(application)
+    await application.start()
+    logger.info(f"Обработчик {index} запущен")
+    try:
+        running = True
+        while running:
+            for kind, payload in await loop.run_in_executor(None, receive):
+                if kind == 'update':
+                    await application.update_queue.put(Update.de_json(payload, application.bot))
+                elif kind == 'categories':
+                    get_categories()
+                elif kind == 'stop':
+                    running = False
+        # Дожидаемся обновлений, уже переданных приложению
+        await application.update_queue.join()
+    finally:
+        await application.stop()
+        await bot.post_shutdown(application)
+        await application.shutdown()
+        logger.info(f"Обработчик {index} остановлен")
+
+
+class Cluster:
+    """Процессы-обработчики, их очереди и маршрутизация обновлений."""
+
+    def __init__(self, workers: int, env: Dict[str, str],
+                 builder_factory: Optional[Callable] = None, queue_size: int = QUEUE_SIZE):
+        import metrics
+        self._metrics = metrics
+        self._context = multiprocessing.get_context('spawn')
+        self._workers = workers
+        self._env = env
+        self._builder_factory = builder_factory
+        self._ring = HashRing(range(workers))
+        self._queues = [self._context.Queue(queue_size) for _ in range(workers)]
+        self._events = self._context.Queue()
+        self._processes: List = [None] * workers
+        self._events_thread: Optional[threading.Thread] = None
+        self._stopping = False
+
+    @property
+    def workers(self) -> int:
+        return self._workers
+
+    def worker_env(self, index: int) -> Dict[str, str]:
+        """Окружение обработчика: свои файлы данных и порт метрик."""
+        env = dict(self._env)
+        for name in SHARDED_PATHS:
+            env[name] = shard_path(self._env[name], index)
+        env['WORKERS'] = str(self._workers)
+        env['WORKER_INDEX'] = str(index)
+        metrics_port = int(self._env.get('METRICS_PORT') or 0)
+        env['METRICS_PORT'] = str(metrics_port + 1 + index if metrics_port else 0)
+        return env
+
+    def _spawn(self, index: int) -> None:
+        process = self._context.Process(
+            target=run_worker,
+            args=(index, self.worker_env(index), self._queues[index], self._events,
+                  self._builder_factory),
+            name=f'bot-worker-{index}',
+        )
+        process.start()
+        self._processes[index] = process
+
+    def start(self) -> None:
+        for index in range(self._workers):
+            self._spawn(index)
+        self._events_thread = threading.Thread(target=self._forward_events, daemon=True)
+        self._events_thread.start()
+        logger.info(f"Запущено обработчиков: {self._workers}")
+
+    def worker_for(self, data: Dict) -> int:
+        chat_id = update_chat_id(data)
+        # Обновления без чата редки и не связаны с состоянием пользователя
+        return 0 if chat_id is None else self._ring.node(chat_id)
+
+    def route(self, data: Dict) -> bool:
+        """Отправка обновления своему обработчику; False, если его очередь полна."""
+        index = self.worker_for(data)
+        try:
+            self._queues[index].put_nowait(('update', data))
+        except queue.Full:
+            self._metrics.inc('cluster_updates_rejected', worker=index)
+            return False
+        self._metrics.inc('cluster_updates_routed', worker=index)
+        return True
+
+    def _forward_events(self) -> None:
+        """Рассылка уведомлений об изменении категорий остальным обработчикам."""
+        while True:
+            event = self._events.get()
+            if event is None:
+                return
+            kind, source = event
+            for index, updates in enumerate(self._queues):
+                if index == source:
+                    continue
+                try:
+                    updates.put_nowait((kind, None))
+                except queue.Full:
+                    # Справочник всё равно перечитается по mtime при следующем обращении
+                    logger.warning(f"Обработчик {index} не получил уведомление {kind}")
+
+    def check_workers(self) -> None:
+        """Перезапуск упавших обработчиков и метрика длины очередей."""
+        for index, process in enumerate(self._processes):
+            try:
+                self._metrics.gauge('cluster_queue_depth', self._queues[index].qsize(), worker=index)
+            except NotImplementedError:
+                # qsize недоступен на macOS
+                pass
+            if self._stopping or process is None or process.is_alive():
+                continue
+            logger.error(f"Обработчик {index} завершился с кодом {process.exitcode}, перезапускаем")
+            self._metrics.inc('cluster_worker_restarts', worker=index)
+            self._spawn(index)
+
+    def stop(self, timeout: float = STOP_TIMEOUT) -> None:
+        """Остановка обработчиков после разбора уже принятых обновлений."""
+        self._stopping = True
+        for updates in self._queues:
+            updates.put(('stop', None))
+        for index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                logger.error(f"Обработчик {index} не остановился за {timeout} с, завершаем")
+                process.terminate()
+                process.join()
+        self._events.put(None)
+        if self._events_thread is not None:
+            self._events_thread.join()
+
+
+class WebhookHandler(RequestHandler):
+    """Приём обновлений от Telegram и передача их обработчикам."""
+
+    def initialize(self, cluster: Cluster, secret: Optional[str]) -> None:
+        self._cluster = cluster
+        self._secret = secret
+
+    def post(self) -> None:
+        if self._secret and self.request.headers.get('X-Telegram-Bot-Api-Secret-Token') != self._secret:
+            raise HTTPError(403)
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            raise HTTPError(400)
+        if not isinstance(data, dict):
+            raise HTTPError(400)
+        # Telegram повторит обновление позже
+        if not self._cluster.route(data):
+            raise HTTPError(503)
+
+
+async def poll_updates(cluster: Cluster, token: str, stopping: asyncio.Event) -> None:
+    """Получение обновлений через getUpdates, для запуска без webhook."""
+    from telegram import Bot
+    from telegram.error import TelegramError
+
+    async with Bot(token) as api:
+        await api.delete_webhook()
+        offset = None
+        while not stopping.is_set():
+            try:
+                updates = await api.get_updates(offset=offset, timeout=POLL_TIMEOUT)
+            except TelegramError as e:
+                logger.warning(f"Ошибка getUpdates: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                while not cluster.route(update.to_dict()):
+                    await asyncio.sleep(0.1)
+                offset = update.update_id + 1
+
+
+async def serve(cluster: Cluster) -> None:
+    """Передний процесс: приём обновлений, присмотр за обработчиками, метрики."""
+    from config import (
+        BOT_MODE, BOT_TOKEN, WEBHOOK_LISTEN, WEBHOOK_PATH, WEBHOOK_PORT, WEBHOOK_SECRET, WEBHOOK_URL
+    )
+    from metrics_server import metrics_server
+    from telegram import Bot
+
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+
+    cluster.start()
+    metrics_server.start()
+    server: Optional[HTTPServer] = None
+    poller: Optional[asyncio.Task] = None
+    if BOT_MODE == 'webhook':
+        server = WebApplication([
+            (rf'/{WEBHOOK_PATH}/?', WebhookHandler, {'cluster': cluster, 'secret': WEBHOOK_SECRET})
+        ]).listen(WEBHOOK_PORT, WEBHOOK_LISTEN)
+        async with Bot(BOT_TOKEN) as api:
+            await api.set_webhook(
+                f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET
+            )
+        logger.info(f"Webhook принимается на порту {WEBHOOK_PORT}")
+    else:
+        poller = asyncio.create_task(poll_updates(cluster, BOT_TOKEN, stopping))
+
+    try:
+        while not stopping.is_set():
+            cluster.check_workers()
+            try:
+                await asyncio.wait_for(stopping.wait(), MONITOR_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        logger.info("Останавливаем обработчики")
+        if server is not None:
+            server.stop()
+        if poller is not None:
+            poller.cancel()
+            try:
+                await poller
+            except asyncio.CancelledError:
+                pass
+        await loop.run_in_executor(None, cluster.stop)
+        await metrics_server.stop()
+
+
+def base_environment() -> Dict[str, str]:
+    """Окружение для обработчиков с путями данных из настроек."""
+    from config import ANALYSIS_CACHE_PATH, JOURNAL_PATH, METRICS_PORT, PERSISTENCE_PATH, REMINDERS_PATH
+
+    env = dict(os.environ)
+    env.update({
+        'JOURNAL_PATH': JOURNAL_PATH,
+        'PERSISTENCE_PATH': PERSISTENCE_PATH,
+        'REMINDERS_PATH': REMINDERS_PATH,
+        'ANALYSIS_CACHE_PATH': ANALYSIS_CACHE_PATH,
+        'METRICS_PORT': str(METRICS_PORT),
+    })
+    return env
+
+
+def main() -> None:
+    from config import ConfigError, WORKERS, validate
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=WORKERS or os.cpu_count() or 1,
+                        help='число процессов-обработчиков, по умолчанию WORKERS или число ядер')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format='%(asctime)s - %(processName)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    try:
+        warnings = validate()
+    except ConfigError as e:
+        logger.error(f"Ошибка настроек: {e}")
+        raise SystemExit(1)
+    for warning in warnings:
+        logger.warning(warning)
+    if args.workers < 1:
+        logger.error("Нужен хотя бы один обработчик")
+        raise SystemExit(1)
+
+    asyncio.run(serve(Cluster(args.workers, base_environment())))
+
+
+if __name__ == '__main__':
+    main()
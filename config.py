@@ -4,9 +4,103 @@ import os
 # Загружаем переменные окружения из .env файла
 load_dotenv()
 
+# Ошибки разбора числовых настроек; сообщаются в validate()
+_errors = []
+
+
+def _number(name: str, default: str, kind=int):
+    value = os.getenv(name, default)
+    try:
+        return kind(value)
+    except ValueError:
+        _errors.append(f"{name} должен быть числом")
+        return kind(default)
+
+
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
 
-# Для отладки: убедитесь, что переменные загружены корректно
-print("BOT_TOKEN:", BOT_TOKEN)
-print("SPREADSHEET_ID:", SPREADSHEET_ID)
\ No newline at end of file
+# Куда пишутся строки: shared - всё в sheet1, user - лист на пользователя,
+# user_month - лист на пользователя и месяц
+WORKSHEET_ROUTING = os.getenv("WORKSHEET_ROUTING", "user")
+# Сколько открытых листов держим в памяти
+WORKSHEET_CACHE_SIZE = _number("WORKSHEET_CACHE_SIZE", "256")
+
+# Локальный журнал активностей
+JOURNAL_PATH = os.getenv("JOURNAL_PATH", "activities.db")
+
+# Состояние диалогов и user_data
+PERSISTENCE_PATH = os.getenv("PERSISTENCE_PATH", "conversations.db")
+
+# Расписания ежедневных напоминаний
+REMINDERS_PATH = os.getenv("REMINDERS_PATH", "reminders.db")
+
+# Кэш результатов анализа транскриптов
+ANALYSIS_CACHE_PATH = os.getenv("ANALYSIS_CACHE_PATH", "analysis_cache.db")
+
+# Формат ответа ChatGPT: json (структурированный) или text (разделы с тегами)
+ANALYSIS_MODE = os.getenv("ANALYSIS_MODE", "json")
+
+# OpenAI; OPENAI_BASE_URL позволяет направить запросы на локальный fake_openai.py
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
+# Сколько запросов к OpenAI идёт одновременно и таймаут одного запроса, секунды
+LLM_MAX_CONCURRENCY = _number("LLM_MAX_CONCURRENCY", "8")
+LLM_TIMEOUT = _number("LLM_TIMEOUT", "120", float)
+
+# Режим работы: polling или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = _number("PORT", "8443")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+
+# Сколько обновлений обрабатывается одновременно (в разных чатах)
+MAX_CONCURRENT_UPDATES = _number("MAX_CONCURRENT_UPDATES", "64")
+
+# Многопроцессный режим cluster.py: число процессов-обработчиков, 0 - по числу ядер
+WORKERS = _number("WORKERS", "0")
+# Номер процесса-обработчика; выставляет cluster.py, у одиночного бота 0
+WORKER_INDEX = _number("WORKER_INDEX", "0")
+
+# Метрики: при false счётчики и замеры не ведутся
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+# Порт для /metrics в формате Prometheus, 0 - не поднимать
+METRICS_PORT = _number("METRICS_PORT", "0")
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "0.0.0.0")
+
+
+class ConfigError(Exception):
+    """Настройки не позволяют запустить бота."""
+
+
+def validate() -> list:
+    """Проверка настроек перед запуском.
+
+    Значения настроек, в том числе секреты, никуда не выводятся.
+    Ошибки, с которыми бот не запустится, поднимаются одним ConfigError,
+    а список предупреждений о неработающих функциях возвращается.
+    """
+    errors = list(_errors)
+    if not BOT_TOKEN:
+        errors.append("не задан BOT_TOKEN")
+    if BOT_MODE not in ("polling", "webhook"):
+        errors.append("BOT_MODE должен быть polling или webhook")
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        errors.append("для BOT_MODE=webhook нужен WEBHOOK_URL")
+    if WORKSHEET_ROUTING not in ("shared", "user", "user_month"):
+        errors.append("WORKSHEET_ROUTING должен быть shared, user или user_month")
+    if WORKERS < 0:
+        errors.append("WORKERS не может быть отрицательным")
+    if ANALYSIS_MODE not in ("json", "text"):
+        errors.append("ANALYSIS_MODE должен быть json или text")
+    if errors:
+        raise ConfigError("; ".join(errors))
+
+    warnings = []
+    if not SPREADSHEET_ID or not os.getenv("GOOGLE_CREDENTIALS"):
+        warnings.append("не заданы SPREADSHEET_ID или GOOGLE_CREDENTIALS, строки останутся в журнале")
+    if not OPENAI_API_KEY:
+        warnings.append("не задан OPENAI_API_KEY, анализ транскриптов работать не будет")
+    return warnings
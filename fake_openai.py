@@ -0,0 +1,166 @@
+"""Локальная имитация OpenAI Chat Completions для проверки бота без сети.
+
+Отвечает с заданной задержкой, часть запросов отклоняет с 429 и
+заголовком retry-after, умеет потоковые ответы. Для JSON-режима
+возвращает анализ, в котором каждая строка последнего сообщения
+пользователя становится активностью.
+
+    python fake_openai.py --port 8089 --latency 0.5 --error-rate 0.1
+    OPENAI_BASE_URL=http://127.0.0.1:8089/v1 OPENAI_API_KEY=fake python bot.py
+
+GET /stats отдаёт число полученных запросов и отклонённых с 429.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Dict, List, Optional
+
+from tornado.web import Application, RequestHandler
+
+
+def fake_analysis(messages: List[Dict]) -> Dict:
+    """Ответ в формате JSON_SYSTEM_PROMPT и TAG_SYSTEM_PROMPT одновременно."""
+    text = next(
+        (message['content'] for message in reversed(messages) if message.get('role') == 'user'), ''
+    )
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    return {
+        'chronology': lines[:3],
+        'activities': [
+            {
+                'index': index,
+                'text': line,
+                'contexts': [],
+                'roles': [],
+                'skills': [],
+                'energy': 0,
+                'summary': line[:50],
+            }
+            for index, line in enumerate(lines)
+        ],
+        'followup': [],
+        'meta': '',
+    }
+
+
+def completion(content: str, model: str, completion_id: str) -> Dict:
+    """Ответ chat.completions без потоковой выдачи."""
+    return {
+        'id': completion_id,
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': content},
+            'finish_reason': 'stop',
+        }],
+        'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+    }
+
+
+def completion_chunk(delta: Dict, model: str, completion_id: str,
+                     finish_reason: Optional[str] = None) -> bytes:
+    """Одно событие потокового ответа в формате server-sent events."""
+    chunk = {
+        'id': completion_id,
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+    }
+    return f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'.encode('utf-8')
+
+
+def stream_body(content: str, model: str, completion_id: str, chunks: int) -> List[bytes]:
+    """События потокового ответа, на которые разбит content, с завершающим [DONE]."""
+    size = max(1, len(content) // chunks + 1)
+    events = [
+        completion_chunk({'content': content[start:start + size]}, model, completion_id)
+        for start in range(0, len(content), size)
+    ]
+    events.append(completion_chunk({}, model, completion_id, 'stop'))
+    events.append(b'data: [DONE]\n\n')
+    return events
+
+
+class FakeOpenAI:
+    """Состояние имитации: задержка, доля ошибок и счётчики запросов."""
+
+    def __init__(self, latency: float = 0.2, error_rate: float = 0.0, retry_after: float = 1.0,
+                 chunks: int = 10):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.chunks = chunks
+        self.requests = 0
+        self.rejected = 0
+
+    def make_app(self) -> Application:
+        return Application([
+            (r'/v1/chat/completions', ChatCompletionsHandler, {'fake': self}),
+            (r'/stats', StatsHandler, {'fake': self}),
+        ])
+
+    def listen(self, port: int, address: str = '127.0.0.1'):
+        """Запуск сервера в текущем цикле событий, возвращает HTTPServer."""
+        return self.make_app().listen(port, address)
+
+
+class StatsHandler(RequestHandler):
+    def initialize(self, fake: FakeOpenAI) -> None:
+        self.fake = fake
+
+    def get(self) -> None:
+        self.write({'requests': self.fake.requests, 'rejected': self.fake.rejected})
+
+
+class ChatCompletionsHandler(RequestHandler):
+    def initialize(self, fake: FakeOpenAI) -> None:
+        self.fake = fake
+
+    async def post(self) -> None:
+        fake = self.fake
+        fake.requests += 1
+        if random.random() < fake.error_rate:
+            fake.rejected += 1
+            self.set_status(429)
+            self.set_header('retry-after', str(fake.retry_after))
+            self.write({'error': {'message': 'Rate limit reached', 'type': 'requests',
+                                  'code': 'rate_limit_exceeded'}})
+            return
+
+        body = json.loads(self.request.body)
+        model = body.get('model', 'fake')
+        completion_id = f'chatcmpl-fake{fake.requests}'
+        content = json.dumps(fake_analysis(body.get('messages', [])), ensure_ascii=False)
+
+        if not body.get('stream'):
+            await asyncio.sleep(fake.latency)
+            self.write(completion(content, model, completion_id))
+            return
+
+        self.set_header('Content-Type', 'text/event-stream')
+        for event in stream_body(content, model, completion_id, fake.chunks):
+            await asyncio.sleep(fake.latency / fake.chunks)
+            self.write(event)
+            await self.flush()
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.2, help='время ответа, секунды')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 429')
+    parser.add_argument('--retry-after', type=float, default=1.0)
+    args = parser.parse_args()
+
+    FakeOpenAI(args.latency, args.error_rate, args.retry_after).listen(args.port)
+    print(f"Fake OpenAI: http://127.0.0.1:{args.port}/v1")
+    await asyncio.Event().wait()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,302 @@
+"""Локальный журнал активностей с фоновой синхронизацией в Google Sheets."""
+import asyncio
+import logging
+import sqlite3
+import time
+import uuid
+from typing import Dict, List, Optional, Set, Tuple
+
+import metrics
+from config import JOURNAL_PATH
+from sheets import SheetsClient, sheets_client, worksheet_chat, worksheet_title
+from storage import connect
+from write_queue import SheetsWriteQueue, write_queue
+
+logger = logging.getLogger(__name__)
+
+# Колонки строки в таблице, ключ строки пишется последним
+ROW_COLUMNS = ('date', 'text', 'energy', 'roles', 'skills', 'summary')
+KEY_COLUMN = len(ROW_COLUMNS) + 1
+
+# Сколько строк за раз передаём из журнала в очередь записи
+SYNC_BATCH = 500
+SYNC_INTERVAL = 5.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS activities (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL UNIQUE,
+    chat_id INTEGER,
+    worksheet TEXT,
+    date TEXT NOT NULL,
+    text TEXT NOT NULL,
+    energy TEXT,
+    roles TEXT,
+    skills TEXT,
+    summary TEXT,
+    contexts TEXT,
+    created_at REAL NOT NULL,
+    synced_at REAL
+);
+CREATE INDEX IF NOT EXISTS activities_unsynced
+    ON activities (id) WHERE synced_at IS NULL;
+CREATE INDEX IF NOT EXISTS activities_chat ON activities (chat_id, id);
+"""
+
+# Колонки, которых не было в первых версиях журнала, для уже созданных баз
+MIGRATIONS = {
+    'contexts': 'ALTER TABLE activities ADD COLUMN contexts TEXT',
+}
+
+
+class ActivityJournal:
+    """Журнал подтверждённых активностей, только на добавление.
+
+    Каждая строка получает ключ идемпотентности, который пишется в
+    таблицу последней колонкой и позволяет не задублировать строку после
+    перезапуска. Контексты в таблицу не пишутся и хранятся только в
+    журнале для /stats.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._db: Optional[sqlite3.Connection] = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = connect(self._path)
+            self._db.executescript(SCHEMA)
+            columns = {row[1] for row in self._db.execute('PRAGMA table_info(activities)')}
+            for column, statement in MIGRATIONS.items():
+                if column not in columns:
+                    self._db.execute(statement)
+        return self._db
+
+    def record(self, chat_id: Optional[int], rows: List[List],
+               worksheet: Optional[str] = None,
+               keys: Optional[List[str]] = None,
+               contexts: Optional[List[str]] = None) -> List[str]:
+        """Запись строк в журнал одной транзакцией."""
+        keys = keys or [uuid.uuid4().hex for _ in rows]
+        contexts = contexts or [''] * len(rows)
+        now = time.time()
+        with metrics.timer('journal_write'), self.db:
+            self.db.executemany(
+                'INSERT OR IGNORE INTO activities '
+                '(key, chat_id, worksheet, date, text, energy, roles, skills, summary, '
+                'contexts, created_at) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                [
+                    (key, chat_id, worksheet, *[str(value) for value in row], context, now)
+                    for key, row, context in zip(keys, rows, contexts)
+                ]
+            )
+        return keys
+
+    def last_id(self, chat_id: int) -> int:
+        """Номер последней строки пользователя, 0 если строк нет."""
+        row = self.db.execute(
+            'SELECT MAX(id) FROM activities WHERE chat_id = ?', (chat_id,)
+        ).fetchone()
+        return row[0] or 0
+
+    def chat_activities(self, chat_id: int, after_id: int = 0) -> List[Tuple]:
+        """Строки пользователя для аналитики: (id, дата, энергия, роли, навыки, контексты)."""
+        return self.db.execute(
+            'SELECT id, date, energy, roles, skills, contexts FROM activities '
+            'WHERE chat_id = ? AND id > ? ORDER BY id',
+            (chat_id, after_id)
+        ).fetchall()
+
+    def pending(self, after_id: int = 0, limit: int = SYNC_BATCH) -> List[Tuple]:
+        """Несинхронизированные строки: (id, ключ, лист, строка таблицы)."""
+        cursor = self.db.execute(
+            'SELECT id, key, worksheet, date, text, energy, roles, skills, summary '
+            'FROM activities WHERE synced_at IS NULL AND id > ? ORDER BY id LIMIT ?',
+            (after_id, limit)
+        )
+        return [
+            (row_id, key, worksheet, [*values, key])
+            for row_id, key, worksheet, *values in cursor
+        ]
+
+    def mark_synced(self, keys: List[str]) -> None:
+        """Отметка строк, записанных в таблицу."""
+        with self.db:
+            self.db.executemany(
+                'UPDATE activities SET synced_at = ? WHERE key = ?',
+                [(time.time(), key) for key in keys]
+            )
+
+    def apply_sheet_rows(self, worksheet: Optional[str],
+                         rows: List[Tuple[str, List[str]]]) -> Set[Optional[int]]:
+        """Применение строк, прочитанных из таблицы: (ключ, значения колонок ROW_COLUMNS).
+
+        Новые ключи добавляются как уже синхронизированные, у известных
+        обновляются изменившиеся значения. Пользователь новой строки берётся
+        только из названия листа u<chat_id>; строки общего sheet1 остаются
+        без пользователя и в /stats не попадают. Возвращает пользователей, у
+        которых изменились существующие строки.
+        """
+        changed: Set[Optional[int]] = set()
+        now = time.time()
+        chat_id = worksheet_chat(worksheet)
+        with metrics.timer('journal_apply_sheet'), self.db:
+            for key, values in rows:
+                existing = self.db.execute(
+                    'SELECT chat_id, date, text, energy, roles, skills, summary '
+                    'FROM activities WHERE key = ?', (key,)
+                ).fetchone()
+                if existing is None:
+                    self.db.execute(
+                        'INSERT INTO activities '
+                        '(key, chat_id, worksheet, date, text, energy, roles, skills, summary, '
+                        'created_at, synced_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (key, chat_id, worksheet, *values, now, now)
+                    )
+                    metrics.inc('journal_sheet_rows_added')
+                elif list(existing[1:]) != list(values):
+                    self.db.execute(
+                        'UPDATE activities SET date = ?, text = ?, energy = ?, roles = ?, '
+                        'skills = ?, summary = ? WHERE key = ?',
+                        (*values, key)
+                    )
+                    changed.add(existing[0])
+                    metrics.inc('journal_sheet_rows_updated')
+        return changed
+
+    def move_to_worksheet(self, keys: List[str], worksheet: Optional[str]) -> None:
+        """Перенос строк на другой лист, например после migrate_sheets.py."""
+        with self.db:
+            self.db.executemany(
+                'UPDATE activities SET worksheet = ? WHERE key = ?',
+                [(worksheet, key) for key in keys]
+            )
+
+    def chats_by_key(self, keys: List[str]) -> Dict[str, Optional[int]]:
+        """Пользователи строк по их ключам; неизвестных ключей в ответе нет."""
+        found: Dict[str, Optional[int]] = {}
+        for index in range(0, len(keys), SYNC_BATCH):
+            batch = keys[index:index + SYNC_BATCH]
+            found.update(self.db.execute(
+                f'SELECT key, chat_id FROM activities WHERE key IN ({",".join("?" * len(batch))})',
+                batch
+            ).fetchall())
+        return found
+
+    def unsynced_count(self) -> int:
+        """Количество строк, ещё не записанных в таблицу."""
+        return self.db.execute(
+            'SELECT COUNT(*) FROM activities WHERE synced_at IS NULL'
+        ).fetchone()[0]
+
+
+class JournalSyncer:
+    """Фоновая передача строк из журнала в очередь записи Google Sheets."""
+
+    def __init__(self, journal: ActivityJournal, queue: SheetsWriteQueue,
+                 client: SheetsClient):
+        self._journal = journal
+        self._queue = queue
+        self._client = client
+        self._last_id = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        queue.on_flushed = self._on_flushed
+
+    def _on_flushed(self, keys: List[str]) -> None:
+        self._journal.mark_synced(keys)
+        metrics.inc('journal_rows_synced', len(keys))
+
+    def notify(self) -> None:
+        """Сигнал о новых строках в журнале."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _skip_already_written(self) -> None:
+        """Отметка строк, попавших в таблицу до падения процесса."""
+        pending: Dict[Optional[str], set] = {}
+        for _, key, worksheet, _ in self._journal.pending(limit=-1):
+            pending.setdefault(worksheet, set()).add(key)
+        for worksheet, keys in pending.items():
+            sheet = await self._client.get_worksheet(worksheet)
+            written = await asyncio.to_thread(sheet.col_values, KEY_COLUMN)
+            found = keys.intersection(written)
+            if found:
+                logger.info(f"Уже записано в таблицу до перезапуска: {len(found)} строк")
+                self._journal.mark_synced(list(found))
+
+    def _enqueue_pending(self) -> None:
+        while True:
+            batch = self._journal.pending(self._last_id)
+            if not batch:
+                return
+            by_worksheet: Dict[Optional[str], Tuple[List, List]] = {}
+            for row_id, key, worksheet, row in batch:
+                keys, rows = by_worksheet.setdefault(worksheet, ([], []))
+                keys.append(key)
+                rows.append(row)
+                self._last_id = row_id
+            for worksheet, (keys, rows) in by_worksheet.items():
+                self._queue.put(rows, worksheet, keys)
+
+    async def _run(self) -> None:
+        if self._journal.unsynced_count():
+            try:
+                await self._skip_already_written()
+            except Exception as e:
+                # Лучше возможный дубль, чем потерянная строка
+                logger.error(f"Не удалось проверить записанные строки: {e}")
+        while True:
+            self._enqueue_pending()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), SYNC_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    def start(self) -> None:
+        """Запуск синхронизации, включая строки, оставшиеся с прошлого запуска."""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Остановка синхронизации."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+activity_journal = ActivityJournal(JOURNAL_PATH)
+journal_syncer = JournalSyncer(activity_journal, write_queue, sheets_client)
+
+
+def save_rows(chat_id: Optional[int], rows: List[List],
+              worksheet: Optional[str] = None,
+              contexts: Optional[List[str]] = None,
+              keys: Optional[List[str]] = None) -> List[str]:
+    """Сохранение строк в журнал и запуск их синхронизации.
+
+    Без явного worksheet строки раскладываются по листам пользователя
+    согласно WORKSHEET_ROUTING. Строки с уже известными ключами
+    повторно не записываются.
+    """
+    contexts = contexts or [''] * len(rows)
+    keys = keys or [uuid.uuid4().hex for _ in rows]
+    groups: Dict[Optional[str], Tuple[List, List, List]] = {}
+    for row, context, key in zip(rows, contexts, keys):
+        title = worksheet or worksheet_title(chat_id, row[0])
+        group_rows, group_contexts, group_keys = groups.setdefault(title, ([], [], []))
+        group_rows.append(row)
+        group_contexts.append(context)
+        group_keys.append(key)
+    for title, (group_rows, group_contexts, group_keys) in groups.items():
+        activity_journal.record(chat_id, group_rows, title, keys=group_keys, contexts=group_contexts)
+    journal_syncer.notify()
+    return keys
@@ -0,0 +1,226 @@
+"""Шлюз к OpenAI: общий пул соединений, ограничение параллельности и повторы.
+
+Пакет openai тяжёлый, поэтому импортируется при первом запросе, а не
+при запуске бота.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import re
+import time
+from typing import TYPE_CHECKING, AsyncIterator, Dict, List, Optional, Tuple
+
+import httpx
+
+import metrics
+from config import (
+    OPENAI_API_KEY, OPENAI_BASE_URL, LLM_MAX_CONCURRENCY, LLM_TIMEOUT
+)
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI
+
+logger = logging.getLogger(__name__)
+
+MAX_RETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+# Ошибки openai, после которых запрос имеет смысл повторить
+RETRYABLE_ERRORS = ('RateLimitError', 'APITimeoutError', 'APIConnectionError', 'InternalServerError')
+
+DURATION_PART = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """Длительность из заголовков лимитов OpenAI: '20ms', '1s', '6m0s'."""
+    parts = DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+
+
+def retry_delay(error: Exception) -> Optional[float]:
+    """Сколько ждать перед повтором по заголовкам ответа, если они есть."""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    if 'retry-after-ms' in headers:
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    if 'retry-after' in headers:
+        try:
+            return float(headers['retry-after'])
+        except ValueError:
+            pass
+    resets = [
+        parse_duration(headers[name])
+        for name in ('x-ratelimit-reset-requests', 'x-ratelimit-reset-tokens')
+        if name in headers
+    ]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+def retryable_errors() -> Tuple[type, ...]:
+    import openai
+    return tuple(getattr(openai, name) for name in RETRYABLE_ERRORS)
+
+
+def backoff(attempt: int) -> float:
+    """Экспоненциальная задержка с полным случайным разбросом."""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def request_key(model: str, messages: List[Dict], options: Dict) -> str:
+    """Ключ запроса для объединения одинаковых одновременных запросов."""
+    payload = json.dumps(
+        {'model': model, 'messages': messages, 'options': options},
+        ensure_ascii=False, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class LLMGateway:
+    """Общий для процесса клиент OpenAI.
+
+    Соединения берутся из одного пула httpx, одновременно к API идёт не
+    больше max_concurrency запросов. Ошибки лимитов, таймауты и ошибки
+    сервера повторяются с экспоненциальной задержкой, а если API
+    подсказал время ожидания в заголовках, ждём столько, сколько сказано.
+    Одинаковые запросы, пришедшие одновременно, уходят в API один раз.
+    """
+
+    def __init__(self, api_key: Optional[str], base_url: Optional[str] = None,
+                 max_concurrency: int = LLM_MAX_CONCURRENCY, timeout: float = LLM_TIMEOUT,
+                 max_retries: int = MAX_RETRIES):
+        self._api_key = api_key
+        self._base_url = base_url
+        self._max_concurrency = max_concurrency
+        self._timeout = timeout
+        self._max_retries = max_retries
+        self._client: Optional['AsyncOpenAI'] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+    @property
+    def client(self) -> 'AsyncOpenAI':
+        if self._client is None:
+            from openai import AsyncOpenAI
+            limits = httpx.Limits(
+                max_connections=self._max_concurrency,
+                max_keepalive_connections=self._max_concurrency
+            )
+            self._client = AsyncOpenAI(
+                api_key=self._api_key,
+                base_url=self._base_url,
+                timeout=self._timeout,
+                # Повторы делает сам шлюз, чтобы учитывать их в метриках
+                max_retries=0,
+                http_client=httpx.AsyncClient(limits=limits, timeout=self._timeout)
+            )
+        return self._client
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        return self._semaphore
+
+    async def _with_retries(self, call, timeout: Optional[float], keep_slot: bool = False):
+        """Вызов API под семафором с повторами; паузы между повторами - вне семафора.
+
+        С keep_slot место в семафоре остаётся занятым после успешного
+        вызова, и освободить его должен вызывающий.
+        """
+        import openai
+        semaphore = self._get_semaphore()
+        retryable = retryable_errors()
+        for attempt in range(self._max_retries + 1):
+            queued_at = time.perf_counter()
+            await semaphore.acquire()
+            metrics.observe('llm_slot_wait', time.perf_counter() - queued_at)
+            try:
+                with metrics.span('llm_request'):
+                    result = await call(timeout or self._timeout)
+            except retryable as e:
+                semaphore.release()
+                if attempt == self._max_retries:
+                    metrics.inc('llm_errors')
+                    raise
+                if isinstance(e, openai.RateLimitError):
+                    metrics.inc('llm_rate_limited')
+                hinted = retry_delay(e)
+                delay = hinted + random.uniform(0, 0.5) if hinted is not None else backoff(attempt)
+                metrics.inc('llm_retries')
+                logger.warning(
+                    f"Ошибка OpenAI ({type(e).__name__}), повтор {attempt + 1} через {delay:.1f} с"
+                )
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                semaphore.release()
+                raise
+            if not keep_slot:
+                semaphore.release()
+            return result
+
+    async def _complete(self, model: str, messages: List[Dict], timeout: Optional[float],
+                        options: Dict) -> str:
+        async def call(call_timeout: float):
+            return await self.client.chat.completions.create(
+                model=model, messages=messages, timeout=call_timeout, **options
+            )
+
+        response = await self._with_retries(call, timeout)
+        return response.choices[0].message.content
+
+    async def complete(self, model: str, messages: List[Dict], timeout: Optional[float] = None,
+                       **options) -> str:
+        """Текст ответа модели; одинаковые одновременные запросы объединяются."""
+        key = request_key(model, messages, options)
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._complete(model, messages, timeout, options))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            metrics.inc('llm_coalesced')
+        # Отмена одного из ожидающих не должна отменять запрос для остальных
+        return await asyncio.shield(task)
+
+    async def stream(self, model: str, messages: List[Dict], timeout: Optional[float] = None,
+                     **options) -> AsyncIterator[str]:
+        """Потоковый ответ модели по кускам текста.
+
+        Повторяется только открытие потока: после первых кусков ответа
+        повтор отдал бы текст дважды.
+        """
+        async def call(call_timeout: float):
+            return await self.client.chat.completions.create(
+                model=model, messages=messages, timeout=call_timeout, stream=True, **options
+            )
+
+        stream = await self._with_retries(call, timeout, keep_slot=True)
+        try:
+            with metrics.timer('llm_stream'):
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+        finally:
+            await stream.close()
+            self._get_semaphore().release()
+
+    async def close(self) -> None:
+        """Закрытие пула соединений."""
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+
+llm_gateway = LLMGateway(OPENAI_API_KEY, OPENAI_BASE_URL)
@@ -0,0 +1,189 @@
+"""Генератор нагрузки для сравнения обработки обновлений.
+
+Режим inprocess (по умолчанию) прогоняет одни и те же обновления через
+последовательную обработку, как при обычном polling, и через
+PerChatUpdateProcessor, с медленным обработчиком вместо похода в
+ChatGPT и Sheets. Режим webhook шлёт обновления в webhook работающего бота.
+
+    python loadgen.py --users 50 --messages 10 --latency 0.2
+    python loadgen.py --mode webhook --url https://host/telegram --secret s
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from telegram import Update
+from telegram.ext import Application, BaseUpdateProcessor, MessageHandler, filters
+from telegram.request import BaseRequest, RequestData
+
+from update_processor import PerChatUpdateProcessor
+
+FAKE_TOKEN = '123456:loadgen'
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Ответы Bot API без сети: getMe и отправка сообщений."""
+
+    def __init__(self):
+        self._message_id = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str,
+                         request_data: Optional[RequestData] = None,
+                         *args, **kwargs) -> Tuple[int, bytes]:
+        endpoint = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if endpoint == 'getMe':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'loadgen', 'username': 'loadgen_bot'}
+        elif endpoint in ('sendMessage', 'editMessageText'):
+            self._message_id += 1
+            result = {
+                'message_id': params.get('message_id', self._message_id),
+                'date': int(time.time()),
+                'chat': {'id': params.get('chat_id', 0), 'type': 'private'},
+                'text': params.get('text', ''),
+            }
+        else:
+            result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
+
+
+def make_update(update_id: int, user_id: int, text: str) -> Dict:
+    """Синтетическое обновление с текстовым сообщением."""
+    user = {'id': user_id, 'is_bot': False, 'first_name': f'user{user_id}'}
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': user,
+        'text': text,
+    }
+    if text.startswith('/'):
+        # Без entity CommandHandler не распознает команду
+        command = text.split()[0]
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    return {'update_id': update_id, 'message': message}
+
+
+def make_updates(users: int, messages: int) -> List[Dict]:
+    """Сообщения от users пользователей вперемешку, по messages от каждого."""
+    return [
+        make_update(index * users + user + 1, 1000 + user, f'сообщение {index}')
+        for index in range(messages)
+        for user in range(users)
+    ]
+
+
+async def run_inprocess(updates: List[Dict], latency: float,
+                        processor: Optional[BaseUpdateProcessor]) -> Dict:
+    """Обработка обновлений ботом с медленным обработчиком."""
+    handled: Dict[int, List[int]] = {}
+    done = asyncio.Event()
+    total = len(updates)
+    count = 0
+
+    async def slow_handler(update: Update, context) -> None:
+        nonlocal count
+        await asyncio.sleep(latency)
+        handled.setdefault(update.effective_chat.id, []).append(update.update_id)
+        count += 1
+        if count == total:
+            done.set()
+
+    builder = (
+        Application.builder()
+        .token(FAKE_TOKEN)
+        .request(FakeTelegramRequest())
+        .get_updates_request(FakeTelegramRequest())
+        .updater(None)
+    )
+    builder = builder.concurrent_updates(processor if processor is not None else False)
+    application = builder.build()
+    application.add_handler(MessageHandler(filters.TEXT, slow_handler))
+
+    async with application:
+        await application.start()
+        start = time.perf_counter()
+        for data in updates:
+            await application.update_queue.put(Update.de_json(data, application.bot))
+        await done.wait()
+        elapsed = time.perf_counter() - start
+        await application.stop()
+
+    in_order = all(ids == sorted(ids) for ids in handled.values())
+    return {
+        'updates': total,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(total / elapsed, 1),
+        'per_chat_order_preserved': in_order,
+    }
+
+
+async def run_webhook(updates: List[Dict], url: str, secret: Optional[str],
+                      concurrency: int) -> Dict:
+    """Отправка обновлений в webhook работающего бота."""
+    headers = {'X-Telegram-Bot-Api-Secret-Token': secret} if secret else {}
+    semaphore = asyncio.Semaphore(concurrency)
+    errors = 0
+
+    async with httpx.AsyncClient(timeout=30) as client:
+        async def send(data: Dict) -> None:
+            nonlocal errors
+            async with semaphore:
+                response = await client.post(url, json=data, headers=headers)
+                if response.status_code != 200:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(send(data) for data in updates))
+        elapsed = time.perf_counter() - start
+
+    return {
+        'updates': len(updates),
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'updates_per_second': round(len(updates) / elapsed, 1),
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=('inprocess', 'webhook'), default='inprocess')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--messages', type=int, default=5)
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help='время работы обработчика в режиме inprocess, секунды')
+    parser.add_argument('--max-concurrent', type=int, default=64)
+    parser.add_argument('--url', help='адрес webhook в режиме webhook')
+    parser.add_argument('--secret', help='секрет webhook')
+    parser.add_argument('--concurrency', type=int, default=50)
+    args = parser.parse_args()
+
+    updates = make_updates(args.users, args.messages)
+    if args.mode == 'webhook':
+        if not args.url:
+            parser.error('для режима webhook нужен --url')
+        result = await run_webhook(updates, args.url, args.secret, args.concurrency)
+    else:
+        sequential = await run_inprocess(updates, args.latency, None)
+        concurrent = await run_inprocess(
+            updates, args.latency, PerChatUpdateProcessor(args.max_concurrent)
+        )
+        result = {
+            'polling_sequential': sequential,
+            'per_chat_concurrent': concurrent,
+            'speedup': round(sequential['seconds'] / concurrent['seconds'], 1),
+        }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
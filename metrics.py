@@ -0,0 +1,205 @@
+"""Метрики процесса: счётчики, текущие значения и гистограммы длительностей.
+
+Метрика может иметь метки, например handler или method. Длительности
+копятся в гистограммах с корзинами BUCKETS и отдаются в формате
+Prometheus через render(). При METRICS_ENABLED=false функции сразу
+возвращаются, а timer и span отдают общий пустой контекст, так что
+инструментирование горячего пути почти ничего не стоит.
+"""
+import bisect
+import functools
+import logging
+import time
+from contextlib import nullcontext
+from typing import Dict, List, Tuple
+
+from config import METRICS_ENABLED
+
+logger = logging.getLogger(__name__)
+
+ENABLED = METRICS_ENABLED
+
+# Префикс имён при экспорте в Prometheus
+PREFIX = 'bot_'
+
+# Верхние границы корзин гистограмм, секунды
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Имя метрики и отсортированные пары меток
+Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+_counters: Dict[Key, float] = {}
+_gauges: Dict[Key, float] = {}
+_histograms: Dict[Key, 'Histogram'] = {}
+
+_NOOP = nullcontext()
+
+
+def _key(name: str, labels: Dict) -> Key:
+    if not labels:
+        return name, ()
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+class Histogram:
+    """Число наблюдений по корзинам BUCKETS, их количество и сумма."""
+
+    __slots__ = ('buckets', 'count', 'total')
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+
+def inc(name: str, value: float = 1, **labels) -> None:
+    """Увеличение счётчика."""
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    _counters[key] = _counters.get(key, 0) + value
+
+
+def gauge(name: str, value: float, **labels) -> None:
+    """Текущее значение величины, например длины очереди."""
+    if not ENABLED:
+        return
+    _gauges[_key(name, labels)] = value
+
+
+def observe(name: str, seconds: float, **labels) -> None:
+    """Учёт длительности операции."""
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    histogram = _histograms.get(key)
+    if histogram is None:
+        histogram = _histograms[key] = Histogram()
+    histogram.observe(seconds)
+
+
+class _Timer:
+    __slots__ = ('name', 'labels', 'start')
+
+    def __init__(self, name: str, labels: Dict):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self) -> None:
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+class _Span(_Timer):
+    __slots__ = ()
+
+    def __exit__(self, exc_type, exc, traceback) -> None:
+        elapsed = time.perf_counter() - self.start
+        observe(self.name, elapsed, **self.labels)
+        error = exc_type.__name__ if exc_type is not None else None
+        if error is not None:
+            inc(f'{self.name}_failed', error=error, **self.labels)
+        if logger.isEnabledFor(logging.DEBUG):
+            fields = ' '.join(f'{label}={value}' for label, value in self.labels.items())
+            logger.debug(
+                f"span={self.name} {fields} duration_ms={elapsed * 1000:.1f} error={error}"
+            )
+
+
+def timer(name: str, **labels):
+    """Замер длительности блока кода."""
+    if not ENABLED:
+        return _NOOP
+    return _Timer(name, labels)
+
+
+def span(name: str, **labels):
+    """Замер внешнего вызова.
+
+    Кроме длительности считает сбои по типу ошибки в <name>_failed и
+    пишет строку в лог на уровне DEBUG.
+    """
+    if not ENABLED:
+        return _NOOP
+    return _Span(name, labels)
+
+
+def timed(name: str, **labels):
+    """Декоратор корутины, замеряющий её как span."""
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with _Span(name, labels):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def total(name: str) -> float:
+    """Суммарное время операции по всем меткам, в секундах."""
+    return sum(histogram.total for (metric, _), histogram in _histograms.items() if metric == name)
+
+
+def _series(key: Key, suffix: str = '', extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    name, labels = key
+    labels = labels + extra
+    if not labels:
+        return f'{name}{suffix}'
+    rendered = ','.join(
+        '{}="{}"'.format(label, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for label, value in labels
+    )
+    return f'{name}{suffix}{{{rendered}}}'
+
+
+def snapshot() -> Dict:
+    """Текущие значения всех метрик."""
+    return {
+        'counters': {_series(key): value for key, value in _counters.items()},
+        'gauges': {_series(key): value for key, value in _gauges.items()},
+        'timings': {
+            _series(key): {'count': histogram.count, 'total': histogram.total}
+            for key, histogram in _histograms.items()
+        }
+    }
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus."""
+    lines: List[str] = []
+    typed = set()
+
+    def declare(name: str, kind: str) -> None:
+        if name not in typed:
+            typed.add(name)
+            lines.append(f'# TYPE {name} {kind}')
+
+    for (name, labels), value in sorted(_counters.items()):
+        declare(f'{PREFIX}{name}_total', 'counter')
+        lines.append(f'{_series((PREFIX + name, labels), "_total")} {value}')
+    for (name, labels), value in sorted(_gauges.items()):
+        declare(f'{PREFIX}{name}', 'gauge')
+        lines.append(f'{_series((PREFIX + name, labels))} {value}')
+    for (name, labels), histogram in sorted(_histograms.items()):
+        metric = f'{PREFIX}{name}_seconds'
+        declare(metric, 'histogram')
+        cumulative = 0
+        for bound, count in zip(BUCKETS + (float('inf'),), histogram.buckets):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else f'{bound:g}'
+            lines.append(f'{_series((metric, labels), "_bucket", (("le", le),))} {cumulative}')
+        lines.append(f'{_series((metric, labels), "_sum")} {histogram.total:.6f}')
+        lines.append(f'{_series((metric, labels), "_count")} {histogram.count}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,47 @@
+"""HTTP-эндпоинт /metrics в формате Prometheus внутри процесса бота."""
+import logging
+from typing import Optional
+
+from tornado.httpserver import HTTPServer
+from tornado.web import Application, RequestHandler
+
+import metrics
+from config import METRICS_ENABLED, METRICS_LISTEN, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class MetricsHandler(RequestHandler):
+    def get(self) -> None:
+        self.set_header('Content-Type', CONTENT_TYPE)
+        self.write(metrics.render())
+
+
+class MetricsServer:
+    """Сервер метрик в цикле событий бота; без порта не запускается."""
+
+    def __init__(self, port: int, listen: str = '0.0.0.0'):
+        self._port = port
+        self._listen = listen
+        self._server: Optional[HTTPServer] = None
+
+    def start(self) -> None:
+        """Запуск сервера, если метрики включены и задан порт."""
+        if self._server is not None or not self._port or not METRICS_ENABLED:
+            return
+        self._server = Application([(r'/metrics', MetricsHandler)]).listen(
+            self._port, self._listen
+        )
+        logger.info(f"Метрики доступны на http://{self._listen}:{self._port}/metrics")
+
+    async def stop(self) -> None:
+        """Остановка сервера."""
+        if self._server is not None:
+            self._server.stop()
+            await self._server.close_all_connections()
+            self._server = None
+
+
+metrics_server = MetricsServer(METRICS_PORT, METRICS_LISTEN)
@@ -0,0 +1,157 @@
+"""Перенос строк из общего sheet1 в листы пользователей.
+
+Строки читаются из sheet1 пачками, пользователь строки находится по её
+ключу в журнале, и строки каждого листа пишутся одним append_rows на
+пачку. Прогресс хранится в журнале, поэтому прерванный перенос
+продолжается с того же места. Строки без ключа или с неизвестным
+пользователем остаются только в sheet1; сам sheet1 не очищается.
+
+    python migrate_sheets.py --batch 1000
+    python migrate_sheets.py --routing user_month --dry-run
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+from typing import Dict, List, Set, Tuple
+
+from config import WORKSHEET_ROUTING
+from journal import KEY_COLUMN, ActivityJournal, activity_journal
+from sheets import SheetsClient, sheets_client, worksheet_title
+from sheets_sync import a1_range, is_data_row
+from write_queue import BACKOFF_MAX, QUOTA_BACKOFF_MIN, is_quota_error
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sheet_migration (
+    source TEXT PRIMARY KEY,
+    next_row INTEGER NOT NULL
+);
+"""
+SOURCE = 'sheet1'
+MAX_ATTEMPTS = 5
+
+
+async def with_quota_retry(call, *args):
+    """Повтор вызова Sheets API при превышении квоты."""
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            return await call(*args)
+        except Exception as e:
+            if attempt == MAX_ATTEMPTS - 1 or not is_quota_error(e):
+                raise
+            delay = min(QUOTA_BACKOFF_MIN * 2 ** attempt, BACKOFF_MAX)
+            logger.warning(f"Квота Google Sheets исчерпана, ждём {delay:.0f} с")
+            await asyncio.sleep(delay)
+
+
+class SheetMigration:
+    """Перенос sheet1 по листам пользователей с сохранением прогресса."""
+
+    def __init__(self, journal: ActivityJournal, client: SheetsClient,
+                 routing: str = WORKSHEET_ROUTING, batch: int = 1000, dry_run: bool = False):
+        self._journal = journal
+        self._client = client
+        self._routing = routing
+        self._batch = batch
+        self._dry_run = dry_run
+        self._journal.db.executescript(MIGRATION_SCHEMA)
+        self.moved: Dict[str, int] = {}
+        self.skipped = 0
+        self.read = 0
+
+    def _next_row(self) -> int:
+        row = self._journal.db.execute(
+            'SELECT next_row FROM sheet_migration WHERE source = ?', (SOURCE,)
+        ).fetchone()
+        return row[0] if row else 1
+
+    def _save_progress(self, next_row: int) -> None:
+        with self._journal.db:
+            self._journal.db.execute(
+                'INSERT OR REPLACE INTO sheet_migration (source, next_row) VALUES (?, ?)',
+                (SOURCE, next_row)
+            )
+
+    def _route(self, rows: List[List[str]]) -> Dict[str, Tuple[List[List[str]], List[str]]]:
+        """Строки пачки по целевым листам: лист -> (строки, ключи)."""
+        rows = [(list(row) + [''] * KEY_COLUMN)[:KEY_COLUMN] for row in rows]
+        rows = [row for row in rows if is_data_row(row)]
+        chats = self._journal.chats_by_key([row[-1] for row in rows if row[-1]])
+        targets: Dict[str, Tuple[List[List[str]], List[str]]] = {}
+        for row in rows:
+            title = worksheet_title(chats.get(row[-1]), row[0], self._routing)
+            if title is None:
+                self.skipped += 1
+                continue
+            target_rows, keys = targets.setdefault(title, ([], []))
+            target_rows.append(row)
+            keys.append(row[-1])
+        return targets
+
+    async def _written_keys(self, title: str) -> Set[str]:
+        """Ключи, уже попавшие в лист до прерванного запуска."""
+        try:
+            return set(await with_quota_retry(self._client.col_values, KEY_COLUMN, title))
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать ключи листа {title}: {e}")
+            return set()
+
+    async def run(self) -> None:
+        source = (await self._client.get_worksheet(None)).title
+        next_row = self._next_row()
+        resumed = next_row > 1
+        while True:
+            a1 = a1_range(source, next_row, next_row + self._batch - 1)
+            rows = (await with_quota_retry(self._client.batch_get, [a1]))[0]
+            if not rows:
+                break
+            self.read += len(rows)
+            for title, (target_rows, keys) in self._route(rows).items():
+                if resumed:
+                    # Пачка могла быть частично записана перед остановкой
+                    written = await self._written_keys(title)
+                    target_rows = [row for row in target_rows if row[-1] not in written]
+                if not self._dry_run and target_rows:
+                    await with_quota_retry(self._client.append_rows, target_rows, title)
+                    self._journal.move_to_worksheet(keys, title)
+                self.moved[title] = self.moved.get(title, 0) + len(target_rows)
+            resumed = False
+            next_row += len(rows)
+            if not self._dry_run:
+                self._save_progress(next_row)
+            logger.info(f"Перенесено строк sheet1: {next_row - 1}")
+            if len(rows) < self._batch:
+                break
+
+    def report(self, seconds: float) -> Dict:
+        return {
+            'rows_read': self.read,
+            'rows_moved': sum(self.moved.values()),
+            'rows_left_in_sheet1': self.skipped,
+            'worksheets': len(self.moved),
+            'seconds': round(seconds, 1),
+            'dry_run': self._dry_run,
+            'sheets_timings': self._client.timings(),
+        }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--routing', choices=('user', 'user_month'),
+                        default=WORKSHEET_ROUTING if WORKSHEET_ROUTING != 'shared' else 'user')
+    parser.add_argument('--batch', type=int, default=1000, help='строк sheet1 за один проход')
+    parser.add_argument('--dry-run', action='store_true', help='только посчитать, ничего не писать')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
+    migration = SheetMigration(activity_journal, sheets_client, args.routing, args.batch, args.dry_run)
+    start = time.perf_counter()
+    await migration.run()
+    print(json.dumps(migration.report(time.perf_counter() - start), ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,194 @@
+"""Хранение состояния диалогов и user_data в локальной SQLite."""
+import asyncio
+import hashlib
+import json
+import logging
+import pickle
+import sqlite3
+from typing import Any, Dict, Optional, Set, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import metrics
+from storage import connect
+
+logger = logging.getLogger(__name__)
+
+# Как часто бот отдаёт изменения и через сколько они пишутся одной транзакцией
+UPDATE_INTERVAL = 10
+FLUSH_DELAY = 0.5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (
+    user_id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS chat_data (
+    chat_id INTEGER PRIMARY KEY,
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS bot_data (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    data BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (name, key)
+);
+"""
+
+TABLES = {'user_data': 'user_id', 'chat_data': 'chat_id', 'bot_data': 'id'}
+
+
+class SQLitePersistence(BasePersistence):
+    """Persistence для ConversationHandler и user_data на SQLite.
+
+    user_data и chat_data загружаются не при старте, а при первом
+    обновлении от пользователя, поэтому время запуска не зависит от числа
+    пользователей. Изменения помечаются как грязные, неизменившиеся
+    данные отбрасываются по хэшу, а запись идёт пачками одной транзакцией.
+    """
+
+    def __init__(self, path: str, update_interval: float = UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=True, chat_data=True, user_data=True,
+                                        callback_data=False),
+            update_interval=update_interval
+        )
+        self._path = path
+        self._db: Optional[sqlite3.Connection] = None
+        self._loaded: Dict[str, Set[int]] = {'user_data': set(), 'chat_data': set()}
+        self._digests: Dict[Tuple[str, int], bytes] = {}
+        # (таблица, id) -> сериализованные данные, None - удалить
+        self._dirty: Dict[Tuple[str, int], Optional[bytes]] = {}
+        self._dirty_conversations: Dict[Tuple[str, str], Optional[str]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = connect(self._path)
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def _load(self, table: str, item_id: int) -> Dict:
+        row = self.db.execute(
+            f'SELECT data FROM {table} WHERE {TABLES[table]} = ?', (item_id,)
+        ).fetchone()
+        self._loaded[table].add(item_id)
+        if row is None:
+            return {}
+        self._digests[(table, item_id)] = hashlib.sha1(row[0]).digest()
+        metrics.inc('persistence_lazy_loads')
+        return pickle.loads(row[0])
+
+    def _mark_dirty(self, table: str, item_id: int, data: Any) -> None:
+        blob = pickle.dumps(data, protocol=pickle.HIGHEST_PROTOCOL)
+        digest = hashlib.sha1(blob).digest()
+        if self._digests.get((table, item_id)) == digest:
+            return
+        self._digests[(table, item_id)] = digest
+        self._dirty[(table, item_id)] = blob
+        self._schedule_flush()
+
+    def _drop(self, table: str, item_id: int) -> None:
+        self._digests.pop((table, item_id), None)
+        self._dirty[(table, item_id)] = None
+        self._schedule_flush()
+
+    def _schedule_flush(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self) -> None:
+        # Все изменения одного прохода update_persistence попадают в одну транзакцию
+        await asyncio.sleep(FLUSH_DELAY)
+        self._write_dirty()
+
+    def _write_dirty(self) -> None:
+        if not self._dirty and not self._dirty_conversations:
+            return
+        dirty, self._dirty = self._dirty, {}
+        conversations, self._dirty_conversations = self._dirty_conversations, {}
+        with metrics.timer('persistence_flush'), self.db:
+            for (table, item_id), blob in dirty.items():
+                if blob is None:
+                    self.db.execute(f'DELETE FROM {table} WHERE {TABLES[table]} = ?', (item_id,))
+                else:
+                    self.db.execute(
+                        f'INSERT OR REPLACE INTO {table} ({TABLES[table]}, data) VALUES (?, ?)',
+                        (item_id, blob)
+                    )
+            for (name, key), state in conversations.items():
+                if state is None:
+                    self.db.execute(
+                        'DELETE FROM conversations WHERE name = ? AND key = ?', (name, key)
+                    )
+                else:
+                    self.db.execute(
+                        'INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)',
+                        (name, key, state)
+                    )
+        metrics.inc('persistence_rows_written', len(dirty) + len(conversations))
+
+    async def get_user_data(self) -> Dict[int, Dict]:
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, Dict]:
+        return {}
+
+    async def get_bot_data(self) -> Dict:
+        row = self.db.execute('SELECT data FROM bot_data WHERE id = 0').fetchone()
+        if row is None:
+            return {}
+        self._digests[('bot_data', 0)] = hashlib.sha1(row[0]).digest()
+        return pickle.loads(row[0])
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict:
+        cursor = self.db.execute('SELECT key, state FROM conversations WHERE name = ?', (name,))
+        return {tuple(json.loads(key)): json.loads(state) for key, state in cursor}
+
+    async def update_conversation(self, name: str, key: Tuple, new_state: Optional[object]) -> None:
+        state = None if new_state is None else json.dumps(new_state)
+        self._dirty_conversations[(name, json.dumps(list(key)))] = state
+        self._schedule_flush()
+
+    async def update_user_data(self, user_id: int, data: Dict) -> None:
+        self._mark_dirty('user_data', user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: Dict) -> None:
+        self._mark_dirty('chat_data', chat_id, data)
+
+    async def update_bot_data(self, data: Dict) -> None:
+        self._mark_dirty('bot_data', 0, data)
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._drop('user_data', user_id)
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._drop('chat_data', chat_id)
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict) -> None:
+        if user_id not in self._loaded['user_data']:
+            user_data.update(self._load('user_data', user_id))
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict) -> None:
+        if chat_id not in self._loaded['chat_data']:
+            chat_data.update(self._load('chat_data', chat_id))
+
+    async def refresh_bot_data(self, bot_data: Dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        self._write_dirty()
+        logger.info("Состояние диалогов сохранено")
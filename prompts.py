@@ -1,15 +1,74 @@
+import asyncio
+import hashlib
 import json
+import logging
 import os
+import stat
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# Кодировка tiktoken загружается при первом подсчёте токенов, False - ещё не пробовали
+_encoding = False
+
+# fcntl есть только на Unix, без него запись защищена лишь внутри процесса
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 class Categories:
-    def __init__(self):
-        self.filename = 'categories.json'
+    """Справочник категорий, общий для всего процесса.
+
+    Файл читается один раз и перечитывается только при изменении mtime.
+    Запись идёт под asyncio-блокировкой через временный файл и атомарное
+    переименование, а если справочник делят несколько процессов - ещё и
+    под flock на соседнем файле .lock. version растёт при каждом
+    изменении данных, по нему зависимые кэши понимают, что пора
+    пересчитаться. После добавления категории вызываются listeners.
+    """
+
+    def __init__(self, filename='categories.json'):
+        self.filename = filename
+        self.version = 0
+        self._digest = None
+        self._digest_version = None
+        self._mtime = None
+        self._lock = None
+        self.listeners = []
         self.load_categories()
-    
+
+    @property
+    def data(self):
+        return self._data
+
+    @property
+    def digest(self):
+        """Хэш содержимого справочника, не зависящий от перезапусков."""
+        if self._digest_version != self.version:
+            payload = json.dumps(self._data, ensure_ascii=False, sort_keys=True)
+            self._digest = hashlib.sha256(payload.encode('utf-8')).hexdigest()
+            self._digest_version = self.version
+        return self._digest
+
+    def _file_mtime(self):
+        try:
+            return os.stat(self.filename).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def refresh(self):
+        """Перечитывание файла, если он изменился на диске."""
+        if self._file_mtime() != self._mtime:
+            self.load_categories()
+        return self
+
     def load_categories(self):
         if os.path.exists(self.filename):
             with open(self.filename, 'r', encoding='utf-8') as f:
                 self._data = json.load(f)
+            self._mtime = self._file_mtime()
+            self.version += 1
         else:
             self._data = {
                 'КОНТЕКСТЫ': [],
@@ -35,9 +94,32 @@ class Categories:
             }
             self.save_categories()
     
+    def _file_mode(self):
+        """Права текущего файла, а для нового - обычные с учётом umask."""
+        try:
+            return stat.S_IMODE(os.stat(self.filename).st_mode)
+        except FileNotFoundError:
+            umask = os.umask(0)
+            os.umask(umask)
+            return 0o666 & ~umask
+
     def save_categories(self):
-        with open(self.filename, 'w', encoding='utf-8') as f:
-            json.dump(self._data, f, ensure_ascii=False, indent=2)
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.categories-', suffix='.json')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self._data, f, ensure_ascii=False, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            # mkstemp создаёт файл только для владельца, а replace сохранил бы эти права
+            os.chmod(temp_path, self._file_mode())
+            os.replace(temp_path, self.filename)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self._mtime = self._file_mtime()
+        self.version += 1
     
     def add_category(self, category_type, value, subcategory=None):
         """Добавление новой категории"""
@@ -56,6 +138,39 @@ class Categories:
         self.save_categories()
         return True
 
+    async def add(self, category_type, value, subcategory=None):
+        """Добавление категории с защитой от одновременной записи"""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if fcntl is None:
+                self.refresh()
+                added = self.add_category(category_type, value, subcategory)
+            else:
+                with open(self.filename + '.lock', 'a') as lock_file:
+                    # Другой процесс может держать блокировку, пока пишет файл
+                    await asyncio.to_thread(fcntl.flock, lock_file, fcntl.LOCK_EX)
+                    try:
+                        self.refresh()
+                        added = self.add_category(category_type, value, subcategory)
+                    finally:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        if added:
+            for listener in self.listeners:
+                listener()
+        return added
+
+
+_categories = None
+
+
+def get_categories():
+    """Общий экземпляр справочника категорий."""
+    global _categories
+    if _categories is None:
+        _categories = Categories()
+    return _categories.refresh()
+
 # Системный промпт для ChatGPT
 SYSTEM_PROMPT = """Ты помощник для анализа транскриптов и определения активностей. 
 Твоя задача - анализировать текст на основе предоставленного справочника категорий и создавать структурированный конспект.
@@ -73,13 +188,138 @@ SYSTEM_PROMPT = """Ты помощник для анализа транскри
 Используй только теги из справочника.
 """
 
-# Основной промпт для анализа
-ANALYSIS_PROMPT = """
+# Системный промпт для ответа в формате JSON
+JSON_SYSTEM_PROMPT = """Ты помощник для анализа транскриптов и определения активностей.
+Твоя задача - анализировать текст на основе предоставленного справочника категорий и создавать структурированный конспект.
+
+Ответ - строго один JSON-объект такого вида:
+{
+  "chronology": ["событие по порядку", ...],
+  "activities": [
+    {
+      "text": "действие | подробности",
+      "contexts": ["контекст"],
+      "roles": ["роль"],
+      "skills": ["навык"],
+      "energy": -2,
+      "summary": "краткий конспект активности"
+    }
+  ],
+  "followup": ["что сделать дальше", ...],
+  "meta": "мета-анализ дня"
+}
+
+energy - целое число от -2 (сильно забирает энергию) до 2 (сильно даёт энергию), 0 - нейтрально.
+В contexts, roles и skills используй только значения из справочника.
+"""
+
+# Системный промпт для разметки коротких активностей
+TAG_SYSTEM_PROMPT = """Ты размечаешь короткие записи об активностях тегами из справочника категорий.
+
+Ответ - строго один JSON-объект такого вида:
+{"activities": [{"index": 0, "contexts": ["контекст"], "roles": ["роль"], "skills": ["навык"]}]}
+
+index - номер записи из запроса. Используй только значения из справочника.
+"""
+
+# Справочник дописывается к системному промпту, чтобы начало запроса
+# не менялось между запросами и кэшировалось на стороне провайдера
+CATEGORIES_PROMPT = """
+Справочник категорий (раздел/подраздел: значения):
 {справочник_категорий}
+"""
 
-Проанализируй следующий текст, используя указанный выше справочник категорий:
+# Основной промпт для анализа
+ANALYSIS_PROMPT = """
+Проанализируй следующий текст, используя справочник категорий из системного промпта:
 
 {текст}
 
 Создай структурированный конспект, следуя формату из системного промпта.
-"""
\ No newline at end of file
+"""
+
+# Промпт для разметки активностей
+TAG_PROMPT = """
+Размечь записи тегами:
+
+{текст}
+"""
+
+def render_categories(data, path=''):
+    """Компактное представление справочника: одна строка на подраздел."""
+    lines = []
+    for name, value in data.items():
+        key = f"{path}/{name}" if path else name
+        # Верхний уровень - разделы, в словарях внутри разделов ключи - значения
+        if isinstance(value, dict) and (not path or any(value.values())):
+            lines.extend(render_categories(value, key))
+        elif value:
+            lines.append(f"{key}: {', '.join(value)}")
+    return lines
+
+
+def _get_encoding():
+    """Кодировка cl100k_base или None.
+
+    tiktoken необязателен, а при первом обращении скачивает файл
+    кодировки, поэтому без сети его ошибка не должна ломать подсчёт.
+    """
+    global _encoding
+    if _encoding is False:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding('cl100k_base')
+        except ImportError:
+            _encoding = None
+        except Exception as e:
+            logger.warning(f"Кодировка tiktoken недоступна, токены считаются по длине текста: {e}")
+            _encoding = None
+    return _encoding
+
+
+def count_tokens(text):
+    """Количество токенов в тексте, без tiktoken - приблизительно."""
+    encoding = _get_encoding()
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # Для кириллицы в среднем выходит около трёх символов на токен
+    return len(text) // 3 + 1
+
+
+class PromptBuilder:
+    """Сборка сообщений для анализа.
+
+    Системная часть со справочником рендерится один раз на версию
+    справочника и одинакова для всех запросов, меняется только текст.
+    """
+
+    def __init__(self, system_prompt=SYSTEM_PROMPT, user_prompt=None):
+        self.system_prompt = system_prompt
+        self.user_prompt = user_prompt or ANALYSIS_PROMPT
+        self._version = None
+        self._system = None
+        self._system_tokens = 0
+
+    def _system_prompt(self, categories):
+        if self._version != categories.version:
+            reference = '\n'.join(render_categories(categories.data))
+            self._system = self.system_prompt + CATEGORIES_PROMPT.format(справочник_категорий=reference)
+            self._system_tokens = count_tokens(self._system)
+            self._version = categories.version
+        return self._system
+
+    def build(self, text, categories=None):
+        """Сообщения для ChatGPT и число токенов в них."""
+        categories = categories or get_categories()
+        system = self._system_prompt(categories)
+        prompt = self.user_prompt.format(текст=text)
+        tokens = self._system_tokens + count_tokens(prompt)
+        messages = [
+            {"role": "system", "content": system},
+            {"role": "user", "content": prompt}
+        ]
+        return messages, tokens
+
+prompt_builder = PromptBuilder()
+json_prompt_builder = PromptBuilder(JSON_SYSTEM_PROMPT)
+tag_prompt_builder = PromptBuilder(TAG_SYSTEM_PROMPT, TAG_PROMPT)
@@ -0,0 +1,179 @@
+"""Ограничение частоты исходящих запросов к Bot API с приоритетами."""
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Union
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Ответы пользователю идут раньше массовых рассылок
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 10
+
+# Лимиты Telegram: около 30 сообщений в секунду всего, одно в секунду в личный
+# чат (короткие всплески допустимы) и 20 в минуту в группу
+GLOBAL_RATE = 30
+PRIVATE_RATE = 1
+PRIVATE_BURST = 3
+GROUP_RATE = 20 / 60
+GROUP_BURST = 3
+
+MAX_RETRIES = 5
+
+# Запросы, которые не отправляют сообщений и не ограничиваются
+UNLIMITED_ENDPOINTS = frozenset((
+    'getMe', 'getUpdates', 'setWebhook', 'deleteWebhook', 'getWebhookInfo',
+    'answerCallbackQuery', 'close', 'logOut',
+))
+
+# Как часто выбрасываются корзины чатов, которые давно ничего не отправляли
+PRUNE_INTERVAL = 60
+
+
+class TokenBucket:
+    """Корзина жетонов, пополняемая с постоянной скоростью.
+
+    Жетон можно взять в долг: reserve уводит счёт в минус и возвращает,
+    сколько ждать до его появления, поэтому ожидающие обслуживаются по
+    порядку обращения.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self) -> float:
+        """Взять жетон, возвращает время ожидания в секундах."""
+        self._refill()
+        self._tokens -= 1
+        return max(0.0, -self._tokens / self.rate)
+
+    def full(self) -> bool:
+        self._refill()
+        return self._tokens >= self.capacity
+
+
+class PriorityRateLimiter(BaseRateLimiter[int]):
+    """Ограничитель запросов бота с общим лимитом и лимитом на чат.
+
+    Сначала запрос ждёт жетон своего чата, затем встаёт в общую очередь
+    с приоритетом (rate_limit_args, по умолчанию PRIORITY_INTERACTIVE).
+    Один диспетчер выпускает запросы из очереди со скоростью общего
+    лимита, начиная с самого приоритетного. При RetryAfter отправка
+    приостанавливается на указанное время и запрос повторяется.
+    """
+
+    def __init__(self, global_rate: float = GLOBAL_RATE, max_retries: int = MAX_RETRIES):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._max_retries = max_retries
+        self._chats: Dict[Union[int, str], TokenBucket] = {}
+        self._pruned_at = time.monotonic()
+        self._paused_until = 0.0
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._sequence = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def initialize(self) -> None:
+        if self._task is None:
+            self._queue = asyncio.PriorityQueue()
+            self._task = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        while not self._queue.empty():
+            _, _, future = self._queue.get_nowait()
+            future.cancel()
+
+    def depth(self) -> int:
+        """Число запросов в общей очереди."""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            now = time.monotonic()
+            if now - self._pruned_at > PRUNE_INTERVAL:
+                self._pruned_at = now
+                self._chats = {key: value for key, value in self._chats.items() if not value.full()}
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = TokenBucket(GROUP_RATE, GROUP_BURST) if is_group else TokenBucket(PRIVATE_RATE, PRIVATE_BURST)
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _acquire(self, chat_id: Optional[Union[int, str]], priority: int) -> None:
+        if chat_id is not None:
+            delay = self._chat_bucket(chat_id).reserve()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        future = asyncio.get_running_loop().create_future()
+        self._sequence += 1
+        self._queue.put_nowait((priority, self._sequence, future))
+        metrics.gauge('telegram_queue_depth', self._queue.qsize())
+        await future
+
+    async def _dispatch(self) -> None:
+        while True:
+            item = await self._queue.get()
+            try:
+                pause = self._paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                delay = self._global.reserve()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            finally:
+                # Пока ждали жетон, мог прийти более срочный запрос
+                self._queue.put_nowait(item)
+            _, _, future = self._queue.get_nowait()
+            metrics.gauge('telegram_queue_depth', self._queue.qsize())
+            if not future.done():
+                future.set_result(None)
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Union[bool, Dict[str, Any], List[Dict[str, Any]], None]]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[int],
+    ) -> Union[bool, Dict[str, Any], List[Dict[str, Any]], None]:
+        if endpoint in UNLIMITED_ENDPOINTS:
+            return await callback(*args, **kwargs)
+
+        priority = PRIORITY_INTERACTIVE if rate_limit_args is None else rate_limit_args
+        chat_id = data.get('chat_id')
+        for attempt in range(self._max_retries + 1):
+            queued_at = time.perf_counter()
+            await self._acquire(chat_id, priority)
+            metrics.observe('telegram_queue_wait', time.perf_counter() - queued_at)
+            try:
+                with metrics.span('telegram_send', endpoint=endpoint):
+                    return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                metrics.inc('telegram_retry_after')
+                if attempt == self._max_retries:
+                    raise
+                logger.warning(f"Telegram просит подождать {e.retry_after} с перед {endpoint}")
+                # Останавливаем все отправки, а не только эту
+                self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after + 0.1)
+                await asyncio.sleep(e.retry_after + 0.1)
@@ -0,0 +1,179 @@
+"""Ежедневные напоминания: хранятся в SQLite, срабатывают одним таймером в минуту."""
+import asyncio
+import logging
+import sqlite3
+import time
+from array import array
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, Iterator, Optional, Set
+
+import pytz
+
+import metrics
+from config import REMINDERS_PATH
+from storage import connect
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEZONE = 'Europe/Paris'
+
+# Если таймер опоздал (например, процесс подвис), догоняем не больше стольких минут
+MAX_CATCHUP_MINUTES = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reminders (
+    chat_id INTEGER PRIMARY KEY,
+    minute INTEGER,
+    tz TEXT NOT NULL
+);
+"""
+
+Sender = Callable[[Iterator[int]], Awaitable[None]]
+
+
+def local_minute(utc_minute: int, tz: str) -> int:
+    """Минута суток в часовом поясе tz для минуты UTC с начала эпохи."""
+    moment = datetime.fromtimestamp(utc_minute * 60, timezone.utc).astimezone(pytz.timezone(tz))
+    return moment.hour * 60 + moment.minute
+
+
+class ReminderScheduler:
+    """Напоминания, сгруппированные по минутам суток в часовом поясе пользователя.
+
+    В памяти для каждого пользователя хранится только chat_id в массиве
+    своей минуты (8 байт), сами расписания лежат в SQLite и читаются при
+    старте. Раз в минуту один таймер достаёт чаты, у которых наступило
+    время напоминания, и передаёт их в send. Рассылка минуты идёт
+    отдельной задачей: большая рассылка упирается в лимит Telegram и может
+    длиться дольше минуты, а таймер не должен её ждать.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._db: Optional[sqlite3.Connection] = None
+        # Часовой пояс -> минута суток -> chat_id
+        self._buckets: Dict[str, Dict[int, array]] = {}
+        self._send: Optional[Sender] = None
+        self._task: Optional[asyncio.Task] = None
+        self._sending: Set[asyncio.Task] = set()
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = connect(self._path)
+            self._db.executescript(SCHEMA)
+        return self._db
+
+    def _add_to_bucket(self, chat_id: int, minute: Optional[int], tz: str) -> None:
+        if minute is not None:
+            self._buckets.setdefault(tz, {}).setdefault(minute, array('q')).append(chat_id)
+
+    def _remove_from_bucket(self, chat_id: int, minute: Optional[int], tz: str) -> None:
+        bucket = self._buckets.get(tz, {}).get(minute)
+        if bucket is None:
+            return
+        try:
+            bucket.remove(chat_id)
+        except ValueError:
+            return
+        if not bucket:
+            del self._buckets[tz][minute]
+            if not self._buckets[tz]:
+                del self._buckets[tz]
+
+    def load(self) -> int:
+        """Восстановление расписаний из базы, возвращает их число."""
+        self._buckets.clear()
+        count = 0
+        for chat_id, minute, tz in self.db.execute('SELECT chat_id, minute, tz FROM reminders'):
+            self._add_to_bucket(chat_id, minute, tz)
+            count += minute is not None
+        return count
+
+    def get(self, chat_id: int):
+        """(минута суток, часовой пояс) пользователя или None."""
+        return self.db.execute(
+            'SELECT minute, tz FROM reminders WHERE chat_id = ?', (chat_id,)
+        ).fetchone()
+
+    def _save(self, chat_id: int, minute: Optional[int], tz: str) -> None:
+        previous = self.get(chat_id)
+        if previous is not None:
+            self._remove_from_bucket(chat_id, *previous)
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO reminders (chat_id, minute, tz) VALUES (?, ?, ?)',
+                (chat_id, minute, tz)
+            )
+        self._add_to_bucket(chat_id, minute, tz)
+
+    def set_time(self, chat_id: int, minute: int) -> str:
+        """Установка времени напоминания, возвращает часовой пояс пользователя."""
+        previous = self.get(chat_id)
+        tz = previous[1] if previous else DEFAULT_TIMEZONE
+        self._save(chat_id, minute, tz)
+        return tz
+
+    def set_timezone(self, chat_id: int, tz: str) -> None:
+        """Смена часового пояса; pytz.UnknownTimeZoneError для неизвестного пояса."""
+        pytz.timezone(tz)
+        previous = self.get(chat_id)
+        self._save(chat_id, previous[0] if previous else None, tz)
+
+    def cancel(self, chat_id: int) -> None:
+        """Отключение напоминаний пользователя."""
+        previous = self.get(chat_id)
+        if previous is None:
+            return
+        self._remove_from_bucket(chat_id, *previous)
+        with self.db:
+            self.db.execute('DELETE FROM reminders WHERE chat_id = ?', (chat_id,))
+
+    def due(self, utc_minute: int) -> Iterator[int]:
+        """Чаты, которым пора напомнить в указанную минуту UTC."""
+        for tz, minutes in list(self._buckets.items()):
+            bucket = minutes.get(local_minute(utc_minute, tz))
+            if bucket:
+                # Копия, чтобы изменения расписаний во время рассылки её не задели
+                yield from array('q', bucket)
+
+    async def _send_minute(self, minute: int) -> None:
+        try:
+            with metrics.timer('reminders_tick'):
+                await self._send(self.due(minute))
+        except Exception as e:
+            logger.error(f"Ошибка при рассылке напоминаний: {e}")
+
+    async def _run(self) -> None:
+        last_minute = int(time.time() // 60)
+        while True:
+            await asyncio.sleep(60 - time.time() % 60)
+            current = int(time.time() // 60)
+            first = max(last_minute + 1, current - MAX_CATCHUP_MINUTES + 1)
+            for minute in range(first, current + 1):
+                task = asyncio.create_task(self._send_minute(minute))
+                self._sending.add(task)
+                task.add_done_callback(self._sending.discard)
+            metrics.gauge('reminder_minutes_sending', len(self._sending))
+            last_minute = current
+
+    def start(self, send: Sender) -> None:
+        """Загрузка расписаний и запуск таймера."""
+        if self._task is None:
+            self._send = send
+            logger.info(f"Восстановлено напоминаний: {self.load()}")
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Остановка таймера и незаконченных рассылок."""
+        tasks = list(self._sending)
+        if self._task is not None:
+            tasks.append(self._task)
+            self._task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._sending.clear()
+
+
+reminder_scheduler = ReminderScheduler(REMINDERS_PATH)
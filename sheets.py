@@ -0,0 +1,324 @@
+"""Долгоживущее подключение к Google Sheets.
+
+gspread и google-auth вместе с requests импортируются при первом
+подключении, а не при запуске бота.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+import metrics
+from config import SPREADSHEET_ID, WORKSHEET_ROUTING, WORKSHEET_CACHE_SIZE
+
+if TYPE_CHECKING:
+    import gspread
+    from google.oauth2.service_account import Credentials
+
+logger = logging.getLogger(__name__)
+
+SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    'https://www.googleapis.com/auth/drive'
+]
+
+# Обновляем токен заранее, чтобы запись не ждала обновления
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_REFRESH_RETRY = 60
+
+# Первая строка листов, которые бот создаёт сам; порядок как в journal.ROW_COLUMNS
+HEADER = ['Дата', 'Активность', 'Энергия', 'Роли', 'Скилы', 'Конспект', 'Ключ']
+
+
+def worksheet_title(chat_id: Optional[int], date: str,
+                    routing: str = WORKSHEET_ROUTING) -> Optional[str]:
+    """Лист для строки пользователя; None - общий sheet1.
+
+    routing: shared - все в sheet1, user - лист u<chat_id>,
+    user_month - лист u<chat_id>-<ГГГГ-ММ>.
+    """
+    if chat_id is None or routing == 'shared':
+        return None
+    if routing == 'user_month':
+        return f'u{chat_id}-{date[:7]}'
+    return f'u{chat_id}'
+
+
+# Листы, которые бот создаёт для пользователя: u<chat_id> и u<chat_id>-<ГГГГ-ММ>
+USER_WORKSHEET = re.compile(r'^u(-?\d+)(?:-\d{4}-\d{2})?$')
+
+
+def worksheet_chat(title: Optional[str]) -> Optional[int]:
+    """Пользователь листа по его названию; у sheet1 и чужих листов None."""
+    match = USER_WORKSHEET.match(title or '')
+    return int(match.group(1)) if match else None
+
+
+class SheetsUnavailable(Exception):
+    """Не удалось подключиться к таблице."""
+
+
+def is_auth_error(error: Exception) -> bool:
+    """Ошибка, после которой нужно пересоздать подключение."""
+    import gspread
+    from google.auth.exceptions import RefreshError, TransportError
+    if isinstance(error, (RefreshError, TransportError)):
+        return True
+    if isinstance(error, gspread.exceptions.APIError):
+        return error.response.status_code in (401, 403)
+    return False
+
+
+def is_missing_worksheet_error(error: Exception) -> bool:
+    """Лист удалён или переименован: сохранённый диапазон больше не разбирается."""
+    import gspread
+    if not isinstance(error, gspread.exceptions.APIError):
+        return False
+    status = error.response.status_code
+    return status == 404 or (status == 400 and 'Unable to parse range' in str(error))
+
+
+class SheetsClient:
+    """Общий для всего процесса клиент Google Sheets.
+
+    Credentials разбираются один раз из переменной окружения, токен
+    обновляется в фоне, а при ошибке авторизации подключение
+    пересоздаётся. Свойства всех листов читаются одним запросом
+    метаданных, открытые листы держатся в LRU на cache_size штук, а
+    недостающие листы создаются с заголовком при первой записи.
+    """
+
+    def __init__(self, spreadsheet_id: str, cache_size: int = WORKSHEET_CACHE_SIZE):
+        self._spreadsheet_id = spreadsheet_id
+        self._credentials: Optional['Credentials'] = None
+        self._client: Optional['gspread.Client'] = None
+        self._spreadsheet: Optional['gspread.Spreadsheet'] = None
+        self._cache_size = cache_size
+        self._worksheets: 'OrderedDict[Optional[str], gspread.Worksheet]' = OrderedDict()
+        # Название листа -> свойства из метаданных таблицы
+        self._properties: Optional[Dict[str, Dict]] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    def _get_lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def _load_credentials(self) -> 'Credentials':
+        if self._credentials is None:
+            from google.oauth2.service_account import Credentials
+            google_creds_str = os.getenv('GOOGLE_CREDENTIALS')
+            if not google_creds_str:
+                raise SheetsUnavailable("Переменная GOOGLE_CREDENTIALS не найдена")
+            self._credentials = Credentials.from_service_account_info(
+                json.loads(google_creds_str),
+                scopes=SCOPES
+            )
+        return self._credentials
+
+    def _connect(self) -> None:
+        import gspread
+        with metrics.timer('sheets_connect'):
+            credentials = self._load_credentials()
+            with metrics.span('sheets_authorize'):
+                self._client = gspread.authorize(credentials)
+            logger.info("Авторизация с Google выполнена успешно")
+            with metrics.span('sheets_open'):
+                self._spreadsheet = self._client.open_by_key(self._spreadsheet_id)
+            logger.info(f"Подключение к таблице {self._spreadsheet_id} выполнено успешно")
+
+    def _load_properties(self) -> Dict[str, Dict]:
+        with metrics.span('sheets_metadata'):
+            metadata = self._spreadsheet.fetch_sheet_metadata({'fields': 'sheets.properties'})
+        self._properties = {
+            sheet['properties']['title']: sheet['properties'] for sheet in metadata['sheets']
+        }
+        return self._properties
+
+    def _create_worksheet(self, title: str) -> 'gspread.Worksheet':
+        import gspread
+        try:
+            worksheet = self._spreadsheet.add_worksheet(title, rows=1, cols=len(HEADER))
+        except gspread.exceptions.APIError as e:
+            # Лист мог создать другой процесс
+            properties = self._load_properties().get(title)
+            if properties is None:
+                raise
+            logger.info(f"Лист {title} уже создан: {e}")
+            return gspread.Worksheet(self._spreadsheet, properties)
+        worksheet.append_row(HEADER)
+        self._properties[title] = worksheet._properties
+        metrics.inc('sheets_worksheets_created')
+        logger.info(f"Создан лист {title}")
+        return worksheet
+
+    def _open_worksheet(self, title: Optional[str]) -> 'gspread.Worksheet':
+        import gspread
+        with metrics.timer('sheets_connect'):
+            if title is None:
+                return self._spreadsheet.sheet1
+            properties = (self._properties or self._load_properties()).get(title)
+            if properties is None:
+                # Метаданные могли устареть, перечитываем перед созданием листа
+                properties = self._load_properties().get(title)
+            if properties is None:
+                return self._create_worksheet(title)
+            # Лист собирается из известных свойств без запроса к API
+            return gspread.Worksheet(self._spreadsheet, properties)
+
+    def reset(self) -> None:
+        """Сброс подключения, следующий вызов подключится заново."""
+        self._client = None
+        self._spreadsheet = None
+        self._properties = None
+        self._worksheets.clear()
+
+    def forget(self, title: Optional[str]) -> None:
+        """Забыть лист, чтобы следующий вызов нашёл его заново или создал."""
+        self._worksheets.pop(title, None)
+        if self._properties is not None and title is not None:
+            self._properties.pop(title, None)
+
+    def _remember(self, title: Optional[str], worksheet: 'gspread.Worksheet') -> None:
+        self._worksheets[title] = worksheet
+        if len(self._worksheets) > self._cache_size:
+            self._worksheets.popitem(last=False)
+            metrics.inc('sheets_worksheet_evictions')
+
+    async def get_worksheet(self, title: Optional[str] = None) -> 'gspread.Worksheet':
+        """Получение листа, при необходимости с подключением и созданием."""
+        worksheet = self._worksheets.get(title)
+        if worksheet is not None:
+            self._worksheets.move_to_end(title)
+            metrics.inc('sheets_worksheet_cache_hits')
+            return worksheet
+        metrics.inc('sheets_worksheet_cache_misses')
+
+        async with self._get_lock():
+            worksheet = self._worksheets.get(title)
+            if worksheet is not None:
+                return worksheet
+            try:
+                if self._spreadsheet is None:
+                    await asyncio.to_thread(self._connect)
+                worksheet = await asyncio.to_thread(self._open_worksheet, title)
+            except SheetsUnavailable:
+                raise
+            except Exception as e:
+                self.reset()
+                raise SheetsUnavailable(f"Ошибка подключения к Google Sheets: {e}") from e
+            self._remember(title, worksheet)
+            return worksheet
+
+    async def _call(self, method: str, *args, title: Optional[str] = None,
+                    spreadsheet: bool = False, timer: str = 'sheets_write'):
+        """Вызов метода листа (или всей таблицы) с одним повтором.
+
+        При ошибке авторизации подключение пересоздаётся, а пропавший
+        лист забывается и открывается (или создаётся) заново.
+        """
+        for attempt in range(2):
+            worksheet = await self.get_worksheet(title)
+            target = self._spreadsheet if spreadsheet else worksheet
+            try:
+                with metrics.span(timer, method=method):
+                    return await asyncio.to_thread(getattr(target, method), *args)
+            except Exception as e:
+                if attempt:
+                    raise
+                if is_auth_error(e):
+                    logger.warning(f"Ошибка авторизации Google Sheets, переподключаемся: {e}")
+                    metrics.inc('sheets_reconnects')
+                    self.reset()
+                elif not spreadsheet and is_missing_worksheet_error(e):
+                    logger.warning(f"Лист {title or 'sheet1'} не найден, открываем заново: {e}")
+                    metrics.inc('sheets_worksheets_reopened')
+                    self.forget(title)
+                else:
+                    raise
+
+    async def _write(self, method: str, values, title: Optional[str]):
+        return await self._call(method, values, title=title)
+
+    async def append_row(self, row: List, title: Optional[str] = None):
+        """Добавление строки в лист."""
+        return await self._write('append_row', row, title)
+
+    async def append_rows(self, rows: List[List], title: Optional[str] = None):
+        """Добавление нескольких строк в лист одним запросом."""
+        return await self._write('append_rows', rows, title)
+
+    async def col_values(self, col: int, title: Optional[str] = None) -> List[str]:
+        """Значения колонки листа."""
+        return await self._call('col_values', col, title=title, timer='sheets_read')
+
+    async def batch_get(self, ranges: List[str]) -> List[List[List[str]]]:
+        """Значения нескольких диапазонов таблицы одним запросом."""
+        response = await self._call('values_batch_get', ranges, spreadsheet=True, timer='sheets_read')
+        return [value_range.get('values', []) for value_range in response.get('valueRanges', [])]
+
+    async def batch_update(self, data: List[Dict]) -> None:
+        """Запись значений в несколько диапазонов одним запросом: [{'range', 'values'}]."""
+        body = {'valueInputOption': 'RAW', 'data': data}
+        # Сигнатура gspread: values_batch_update(params=None, body=None)
+        await self._call('values_batch_update', None, body, spreadsheet=True)
+
+    async def last_update_time(self) -> str:
+        """Время последнего изменения таблицы по данным Google Drive."""
+        return await self._call('get_lastUpdateTime', spreadsheet=True, timer='sheets_read')
+
+    def _seconds_until_refresh(self) -> float:
+        expiry = self._credentials.expiry if self._credentials else None
+        if not self._credentials or not self._credentials.valid or expiry is None:
+            return 0
+        # google-auth хранит expiry как naive UTC
+        expiry = expiry.replace(tzinfo=timezone.utc)
+        left = (expiry - datetime.now(timezone.utc)).total_seconds()
+        return max(left - TOKEN_REFRESH_MARGIN, 0)
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            try:
+                delay = self._seconds_until_refresh()
+                if delay:
+                    await asyncio.sleep(delay)
+                from google.auth.transport.requests import Request
+                credentials = self._load_credentials()
+                with metrics.span('sheets_token_refresh'):
+                    await asyncio.to_thread(credentials.refresh, Request())
+                logger.info("Токен Google обновлён")
+            except asyncio.CancelledError:
+                raise
+            except SheetsUnavailable as e:
+                logger.error(str(e))
+                return
+            except Exception as e:
+                logger.error(f"Ошибка обновления токена Google: {e}")
+                await asyncio.sleep(TOKEN_REFRESH_RETRY)
+
+    def start(self) -> None:
+        """Запуск фонового обновления токена."""
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self) -> None:
+        """Остановка фонового обновления токена."""
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            try:
+                await self._refresh_task
+            except asyncio.CancelledError:
+                pass
+            self._refresh_task = None
+
+    def timings(self) -> Dict[str, float]:
+        """Суммарное время подключения, записи и чтения, в секундах."""
+        return {name: metrics.total(f'sheets_{name}') for name in ('connect', 'write', 'read')}
+
+
+sheets_client = SheetsClient(SPREADSHEET_ID)
@@ -0,0 +1,272 @@
+"""Зеркалирование ручных правок Google Sheets в локальный журнал."""
+import asyncio
+import bisect
+import logging
+import uuid
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import metrics
+from analytics import activity_stats
+from config import WORKER_INDEX
+from journal import KEY_COLUMN, ROW_COLUMNS, ActivityJournal, activity_journal
+from sheets import SheetsClient, sheets_client
+from write_queue import SheetsWriteQueue, write_queue
+
+logger = logging.getLogger(__name__)
+
+MIRROR_INTERVAL = 60
+
+# Сколько новых строк читаем за один проход
+NEW_ROWS_BATCH = 500
+# Последние строки листа перечитываются при каждом изменении таблицы:
+# правят руками чаще всего недавние записи
+TAIL_ROWS = 200
+# Более старые строки проверяются по кругу таким блоком за проход
+SCAN_BLOCK = 500
+# Диапазонов в одном запросе values_batch_get
+MAX_RANGES = 100
+# Сколько листов, в которые бот не писал, перепроверяется по кругу за проход
+ROUND_ROBIN = 20
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sheet_watermarks (
+    worksheet TEXT PRIMARY KEY,
+    rows INTEGER NOT NULL,
+    scan_from INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sheet_mirror (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    modified TEXT
+);
+CREATE INDEX IF NOT EXISTS activities_worksheet ON activities (worksheet);
+"""
+
+# Виды читаемых диапазонов
+NEW, TAIL, SCAN = 'new', 'tail', 'scan'
+
+
+def a1_prefix(title: Optional[str]) -> str:
+    """Имя листа для диапазона A1; без имени диапазон относится к первому листу, sheet1."""
+    if title is None:
+        return ''
+    quoted = title.replace("'", "''")
+    return f"'{quoted}'!"
+
+
+def a1_range(title: Optional[str], first: int, last: int) -> str:
+    """Диапазон строк first..last листа title по всем колонкам строки."""
+    from gspread.utils import rowcol_to_a1
+    return f"{a1_prefix(title)}{rowcol_to_a1(first, 1)}:{rowcol_to_a1(last, KEY_COLUMN)}"
+
+
+def is_data_row(row: List[str]) -> bool:
+    """Строка с активностью, а не заголовок или пустая строка: дата начинается с цифры."""
+    return bool(row) and bool(row[0]) and row[0][0].isdigit()
+
+
+class SheetsMirror:
+    """Синхронизация правок из таблицы в журнал по водяным знакам.
+
+    Для каждого листа хранится число уже прочитанных строк, для таблицы -
+    время последнего изменения из Google Drive. Пока оно не меняется,
+    проход стоит один лёгкий запрос. После изменения одним запросом
+    values_batch_get читаются только новые строки за водяным знаком,
+    последние TAIL_ROWS строк и очередной блок старых строк, так что
+    стоимость прохода зависит от объёма изменений, а не от размера листа.
+    Читаются только листы, в которые с прошлого прохода писала очередь
+    записи, и ROUND_ROBIN остальных по кругу, чтобы ручные правки в них
+    тоже находились. Листы при этом не открываются и не создаются:
+    берутся только те, куда строки журнала уже записаны.
+    Строкам, добавленным вручную без ключа, ключ дописывается в таблицу.
+
+    Общий sheet1 зеркалирует только процесс с include_shared: иначе
+    обработчики cluster.py дописывали бы одной строке разные ключи.
+    """
+
+    def __init__(self, journal: ActivityJournal, client: SheetsClient,
+                 queue: Optional[SheetsWriteQueue] = None,
+                 interval: float = MIRROR_INTERVAL,
+                 on_changed: Optional[Callable[[Optional[int]], None]] = None,
+                 include_shared: bool = True):
+        self._journal = journal
+        self._client = client
+        self._queue = queue
+        # Листы, которые нужно прочитать в следующем проходе
+        self._touched: Set[Optional[str]] = set()
+        # Последний лист, проверенный по кругу
+        self._cursor = ''
+        self._interval = interval
+        self._on_changed = on_changed
+        self._include_shared = include_shared
+        self._ready = False
+        # Пока дочитываем новые строки, старые не перепроверяем
+        self._catching_up = False
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def db(self):
+        db = self._journal.db
+        if not self._ready:
+            db.executescript(SCHEMA)
+            self._ready = True
+        return db
+
+    def _existing_worksheets(self) -> List[str]:
+        """Листы пользователей, в которые уже записана хотя бы одна строка журнала."""
+        return [row[0] for row in self.db.execute(
+            'SELECT worksheet FROM (SELECT DISTINCT worksheet FROM activities '
+            'WHERE worksheet IS NOT NULL) AS sheets '
+            'WHERE EXISTS (SELECT 1 FROM activities WHERE activities.worksheet = sheets.worksheet '
+            'AND synced_at IS NOT NULL) ORDER BY worksheet'
+        )]
+
+    def _worksheets(self) -> List[Optional[str]]:
+        """Листы прохода: тронутые очередью записи, sheet1 и очередные по кругу."""
+        if self._queue is not None:
+            self._touched |= self._queue.take_flushed_titles()
+        existing = self._existing_worksheets()
+        selected: List[Optional[str]] = [title for title in existing if title in self._touched]
+        others = [title for title in existing if title not in self._touched]
+        start = bisect.bisect_right(others, self._cursor)
+        rotation = (others[start:] + others[:start])[:ROUND_ROBIN]
+        if rotation:
+            self._cursor = rotation[-1]
+        selected.extend(rotation)
+        if self._include_shared:
+            selected.insert(0, None)
+        return selected
+
+    def _watermark(self, worksheet: Optional[str]) -> Tuple[int, int]:
+        row = self.db.execute(
+            'SELECT rows, scan_from FROM sheet_watermarks WHERE worksheet = ?', (worksheet or '',)
+        ).fetchone()
+        return row if row else (0, 1)
+
+    def _modified(self) -> Optional[str]:
+        row = self.db.execute('SELECT modified FROM sheet_mirror WHERE id = 0').fetchone()
+        return row[0] if row else None
+
+    def _plan(self, recheck: bool) -> List[Tuple[Optional[str], str, int, str]]:
+        """Диапазоны для чтения: (лист, вид, первая строка, диапазон A1)."""
+        plan = []
+        for worksheet in self._worksheets():
+            rows, scan_from = self._watermark(worksheet)
+            first = rows + 1
+            plan.append((worksheet, NEW, first, a1_range(worksheet, first, rows + NEW_ROWS_BATCH)))
+            if not recheck:
+                continue
+            tail_from = max(1, rows - TAIL_ROWS + 1)
+            if rows:
+                plan.append((worksheet, TAIL, tail_from, a1_range(worksheet, tail_from, rows)))
+            if scan_from < tail_from:
+                scan_to = min(scan_from + SCAN_BLOCK, tail_from) - 1
+                plan.append((worksheet, SCAN, scan_from, a1_range(worksheet, scan_from, scan_to)))
+        return plan
+
+    async def sync(self) -> bool:
+        """Один проход синхронизации; True, если остались непрочитанные новые строки."""
+        modified = await self._client.last_update_time()
+        if modified == self._modified():
+            metrics.inc('sheets_mirror_unchanged')
+            return False
+
+        plan = self._plan(recheck=not self._catching_up)
+        values: List[List[List[str]]] = []
+        for index in range(0, len(plan), MAX_RANGES):
+            values.extend(
+                await self._client.batch_get([item[3] for item in plan[index:index + MAX_RANGES]])
+            )
+
+        from gspread.utils import rowcol_to_a1
+        parsed = []
+        new_keys: List[Dict] = []
+        for (worksheet, kind, first, a1), rows in zip(plan, values):
+            applied = []
+            for offset, row in enumerate(rows):
+                row = (list(row) + [''] * KEY_COLUMN)[:KEY_COLUMN]
+                if not is_data_row(row):
+                    continue
+                key = row[-1]
+                if not key:
+                    key = uuid.uuid4().hex
+                    cell = rowcol_to_a1(first + offset, KEY_COLUMN)
+                    new_keys.append({'range': a1_prefix(worksheet) + cell, 'values': [[key]]})
+                applied.append((key, row[:len(ROW_COLUMNS)]))
+            parsed.append((worksheet, kind, first, len(rows), applied))
+
+        # Ключи пишутся в таблицу до журнала: если запись не удалась, проход
+        # повторится целиком, и строка не попадёт в журнал второй раз под новым ключом
+        if new_keys:
+            await self._client.batch_update(new_keys)
+            logger.info(f"Строкам, добавленным вручную, записаны ключи: {len(new_keys)}")
+
+        more = False
+        # Листы, новые строки которых дочитаны не до конца
+        unfinished: Set[Optional[str]] = set()
+        changed: Set[Optional[int]] = set()
+        for worksheet, kind, first, count, applied in parsed:
+            changed |= self._journal.apply_sheet_rows(worksheet, applied)
+            metrics.inc('sheets_mirror_rows_read', count)
+            self._advance(worksheet, kind, first, count)
+            if kind == NEW and count == NEW_ROWS_BATCH:
+                more = True
+                unfinished.add(worksheet)
+
+        if self._on_changed is not None:
+            for chat_id in changed:
+                self._on_changed(chat_id)
+        self._catching_up = more
+        self._touched = unfinished
+        if not more:
+            with self.db:
+                self.db.execute(
+                    'INSERT OR REPLACE INTO sheet_mirror (id, modified) VALUES (0, ?)', (modified,)
+                )
+        return more
+
+    def _advance(self, worksheet: Optional[str], kind: str, first: int, count: int) -> None:
+        rows, scan_from = self._watermark(worksheet)
+        if kind == NEW:
+            rows = max(rows, first - 1 + count)
+        elif kind == SCAN:
+            scan_from = first + SCAN_BLOCK
+            if scan_from > max(1, rows - TAIL_ROWS):
+                scan_from = 1
+        with self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO sheet_watermarks (worksheet, rows, scan_from) VALUES (?, ?, ?)',
+                (worksheet or '', rows, scan_from)
+            )
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                with metrics.timer('sheets_mirror_sync'):
+                    while await self.sync():
+                        pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка синхронизации правок из таблицы: {e}")
+            await asyncio.sleep(self._interval)
+
+    def start(self) -> None:
+        """Запуск периодической синхронизации."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Остановка синхронизации."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+sheets_mirror = SheetsMirror(
+    activity_journal, sheets_client, write_queue,
+    on_changed=activity_stats.invalidate, include_shared=WORKER_INDEX == 0
+)
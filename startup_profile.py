@@ -0,0 +1,183 @@
+"""Профиль холодного старта бота.
+
+Отдельный процесс с python -X importtime импортирует bot, и время
+импорта раскладывается по пакетам. Другой процесс запускает бота на
+имитации Bot API и засекает время от запуска процесса до первого
+getUpdates. Оба замера повторяются --runs раз, в отчёт идёт медиана.
+Тяжёлые пакеты из DEFERRED должны импортироваться при первом
+использовании, а не при запуске; если какой-то из них попал в импорт
+bot или старт дольше --max-seconds, процесс завершается с кодом 1.
+
+    python startup_profile.py
+    python startup_profile.py --runs 5 --max-seconds 1.5 --output startup.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+# Пакеты, которые не должны загружаться при запуске бота
+DEFERRED = ('openai', 'gspread', 'google', 'google_auth_oauthlib', 'numpy', 'requests', 'tiktoken')
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def child_environment(workdir: str) -> Dict[str, str]:
+    """Окружение без доступа к настоящим таблице, OpenAI и базам."""
+    env = dict(os.environ)
+    for name in ('JOURNAL_PATH', 'PERSISTENCE_PATH', 'REMINDERS_PATH', 'ANALYSIS_CACHE_PATH'):
+        env[name] = os.path.join(workdir, name.lower().replace('_path', '.db'))
+    env.update({
+        'BOT_TOKEN': '123456:startup',
+        'BOT_MODE': 'polling',
+        'GOOGLE_CREDENTIALS': '',
+        'METRICS_PORT': '0',
+        'PYTHONPATH': ROOT,
+    })
+    return env
+
+
+def parse_importtime(output: str) -> Tuple[float, Dict[str, float], List[str]]:
+    """Время импорта bot, собственное время по корневым пакетам и все модули."""
+    total = 0.0
+    packages: Dict[str, float] = {}
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        module = name.strip()
+        modules.append(module)
+        root = module.split('.')[0]
+        packages[root] = packages.get(root, 0.0) + int(own) / 1e6
+        if module == 'bot':
+            total = int(cumulative) / 1e6
+    return total, packages, modules
+
+
+def profile_imports(env: Dict[str, str], workdir: str) -> Tuple[float, Dict[str, float], List[str]]:
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import bot'],
+        env=env, cwd=workdir, capture_output=True, text=True, check=True
+    )
+    return parse_importtime(result.stderr)
+
+
+def profile_first_poll(env: Dict[str, str], workdir: str) -> Dict[str, float]:
+    spawned = time.time()
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child', str(spawned)],
+        env=env, cwd=workdir, capture_output=True, text=True
+    )
+    if result.returncode:
+        raise RuntimeError(f"Бот не запустился:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+async def run_child(spawned: float) -> Dict[str, float]:
+    """Запуск бота до первого getUpdates; вызывается в дочернем процессе."""
+    import bot
+    imported = time.time()
+    from telegram.ext import Application
+    from loadgen import FAKE_TOKEN, FakeTelegramRequest
+
+    polled = asyncio.Event()
+
+    class PollingRequest(FakeTelegramRequest):
+        async def do_request(self, url, method, request_data=None, *args, **kwargs):
+            if url.endswith('/getUpdates'):
+                polled.set()
+                await asyncio.sleep(0.1)
+                return 200, b'{"ok": true, "result": []}'
+            return await super().do_request(url, method, request_data, *args, **kwargs)
+
+    bot.validate()
+    request = PollingRequest()
+    application = bot.build_application(
+        Application.builder().token(FAKE_TOKEN).request(request).get_updates_request(request)
+    )
+    # Тот же порядок, что в run_polling
+    await application.initialize()
+    await bot.post_init(application)
+    ready = time.time()
+    await application.updater.start_polling()
+    await application.start()
+    await polled.wait()
+    first_poll = time.time()
+
+    await application.updater.stop()
+    await application.stop()
+    await bot.post_shutdown(application)
+    await application.shutdown()
+    return {
+        'bot_import_seconds': imported - spawned,
+        'ready_seconds': ready - spawned,
+        'first_poll_seconds': first_poll - spawned,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--top', type=int, default=15, help='сколько пакетов показывать')
+    parser.add_argument('--max-seconds', type=float, help='бюджет времени до первого getUpdates')
+    parser.add_argument('--output', help='куда сохранить JSON с результатом')
+    parser.add_argument('--child', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        print(json.dumps(asyncio.run(run_child(args.child))))
+        return
+
+    imports, polls, package_runs = [], [], []
+    modules: List[str] = []
+    with tempfile.TemporaryDirectory() as workdir:
+        env = child_environment(workdir)
+        for _ in range(args.runs):
+            total, packages, modules = profile_imports(env, workdir)
+            imports.append(total)
+            package_runs.append(packages)
+            polls.append(profile_first_poll(env, workdir))
+
+    packages = {
+        name: statistics.median(run.get(name, 0.0) for run in package_runs)
+        for name in package_runs[-1]
+    }
+    slowest = sorted(packages.items(), key=lambda item: -item[1])[:args.top]
+    eager = sorted({module.split('.')[0] for module in modules} & set(DEFERRED))
+    result = {
+        'python': sys.version.split()[0],
+        'runs': args.runs,
+        'import_bot_seconds': round(statistics.median(imports), 3),
+        'packages_ms': {name: round(seconds * 1000, 1) for name, seconds in slowest},
+        'eager_heavy_imports': eager,
+    }
+    for name in ('bot_import_seconds', 'ready_seconds', 'first_poll_seconds'):
+        result[name] = round(statistics.median(poll[name] for poll in polls), 3)
+
+    failures = []
+    if eager:
+        failures.append(f"при запуске импортируются {', '.join(eager)}")
+    if args.max_seconds is not None and result['first_poll_seconds'] > args.max_seconds:
+        failures.append(
+            f"первый getUpdates через {result['first_poll_seconds']} с, бюджет {args.max_seconds} с"
+        )
+    result['failures'] = failures
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(output)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
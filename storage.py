@@ -0,0 +1,11 @@
+"""Общие настройки локальных баз SQLite."""
+import sqlite3
+
+
+def connect(path: str) -> sqlite3.Connection:
+    """Открытие базы SQLite в режиме WAL."""
+    db = sqlite3.connect(path)
+    db.execute('PRAGMA journal_mode=WAL')
+    # В режиме WAL fsync выполняется на checkpoint, а не на каждую запись
+    db.execute('PRAGMA synchronous=NORMAL')
+    return db
@@ -0,0 +1,195 @@
+"""Локальная разметка коротких активностей тегами из справочника."""
+import logging
+import re
+from typing import Dict, List, Optional, Set, Tuple
+
+import metrics
+from analysis import TAG_FIELDS, known_tags, tag_with_chatgpt
+from prompts import get_categories
+
+logger = logging.getLogger(__name__)
+
+# Ниже этой уверенности активность размечается через ChatGPT
+MIN_CONFIDENCE = 0.3
+
+WORD = re.compile(r'[a-zа-я0-9]+')
+
+# Окончания по группам, как в стеммере Snowball для русского языка: сначала
+# отрезается возвратное окончание, затем первое найденное окончание
+# прилагательного, глагола или существительного и, наконец, конечное -и,
+# так что все падежи одного слова (планирование, планированию,
+# планированием) сводятся к одной основе
+REFLEXIVE = ('ся', 'сь')
+ADJECTIVE = (
+    'ими', 'ыми', 'его', 'ого', 'ему', 'ому', 'ее', 'ие', 'ые', 'ое', 'ей', 'ий',
+    'ый', 'ой', 'ем', 'им', 'ым', 'ом', 'их', 'ых', 'ую', 'юю', 'ая', 'яя', 'ою', 'ею',
+)
+# Окончания глагола, которые отрезаются только после а или я
+VERB_AFTER_A = (
+    'ете', 'йте', 'ешь', 'нно', 'ла', 'на', 'ли', 'ем', 'ло', 'но', 'ет', 'ют',
+    'ны', 'ть', 'й', 'л', 'н',
+)
+VERB = (
+    'ейте', 'уйте', 'ила', 'ыла', 'ена', 'ите', 'или', 'ыли', 'ило', 'ыло', 'ено',
+    'ует', 'уют', 'ены', 'ить', 'ыть', 'ишь', 'ей', 'уй', 'ил', 'ыл', 'им', 'ым',
+    'ен', 'ят', 'ит', 'ыт', 'ую', 'ю',
+)
+NOUN = (
+    'иями', 'ями', 'ами', 'ией', 'иям', 'ием', 'иях', 'ев', 'ов', 'ие', 'ье', 'еи',
+    'ии', 'ей', 'ой', 'ий', 'ям', 'ем', 'ам', 'ом', 'ах', 'ях', 'ию', 'ью', 'ия',
+    'ья', 'а', 'е', 'и', 'й', 'о', 'у', 'ы', 'ь', 'ю', 'я',
+)
+MIN_STEM = 3
+
+
+def _strip(word: str, endings: Tuple[str, ...], after: str = '') -> Optional[str]:
+    """Слово без самого длинного из окончаний или None, если ни одно не подошло."""
+    for ending in sorted(endings, key=len, reverse=True):
+        base = word[:-len(ending)]
+        if word.endswith(ending) and len(base) >= MIN_STEM and (not after or base[-1] in after):
+            return base
+    return None
+
+
+def stem(word: str) -> str:
+    """Стемминг русского слова отрезанием окончаний."""
+    word = _strip(word, REFLEXIVE) or word
+    for endings, after in ((ADJECTIVE, ''), (VERB_AFTER_A, 'ая'), (VERB, ''), (NOUN, '')):
+        base = _strip(word, endings, after)
+        if base is not None:
+            word = base
+            break
+    return _strip(word, ('и',)) or word
+
+
+def normalize(text: str) -> List[str]:
+    """Текст в виде последовательности основ слов."""
+    return [stem(word) for word in WORD.findall(text.lower().replace('ё', 'е'))]
+
+
+class TagIndex:
+    """Префиксное дерево по основам слов из справочника.
+
+    Значения справочника добавляются и удаляются по одному, поэтому при
+    изменении справочника перестраивается только разница.
+    """
+
+    def __init__(self):
+        self._root: Dict = {}
+        self._terms: Set[Tuple[str, str]] = set()
+        self._version = None
+
+    def add(self, field: str, name: str) -> None:
+        node = self._root
+        for token in normalize(name):
+            node = node.setdefault(token, {})
+        node.setdefault(None, set()).add((field, name))
+        self._terms.add((field, name))
+
+    def remove(self, field: str, name: str) -> None:
+        path = [self._root]
+        for token in normalize(name):
+            node = path[-1].get(token)
+            if node is None:
+                return
+            path.append(node)
+        terms = path[-1].get(None, set())
+        terms.discard((field, name))
+        if not terms:
+            path[-1].pop(None, None)
+        # Удаляем опустевшие ветки
+        for token, parent, node in reversed(list(zip(normalize(name), path, path[1:]))):
+            if node:
+                break
+            del parent[token]
+        self._terms.discard((field, name))
+
+    def sync(self) -> None:
+        """Приведение индекса к текущей версии справочника."""
+        categories = get_categories()
+        if self._version == categories.version:
+            return
+        terms = {
+            (field, name)
+            for field, names in known_tags().items()
+            for name in names.values()
+        }
+        for term in self._terms - terms:
+            self.remove(*term)
+        for term in terms - self._terms:
+            self.add(*term)
+        self._version = categories.version
+
+    def match(self, text: str) -> Dict[str, List[str]]:
+        """Найденные в тексте значения справочника по полям."""
+        tokens = normalize(text)
+        found: Dict[str, List[str]] = {field: [] for field in TAG_FIELDS}
+        position = 0
+        while position < len(tokens):
+            node = self._root
+            longest: Optional[Tuple[int, Set]] = None
+            for index in range(position, len(tokens)):
+                node = node.get(tokens[index])
+                if node is None:
+                    break
+                if None in node:
+                    longest = (index, node[None])
+            if longest is None:
+                position += 1
+                continue
+            end, terms = longest
+            for field, name in sorted(terms):
+                if name not in found[field]:
+                    found[field].append(name)
+            position = end + 1
+        return found
+
+
+tag_index = TagIndex()
+
+
+def tag_activity(activity: Dict) -> float:
+    """Разметка активности по справочнику, возвращает уверенность от 0 до 1.
+
+    Уверенность - доля полей (контексты, роли, навыки), для которых
+    нашлось хотя бы одно значение, среди полей, в которых справочник не
+    пуст. Теги не из справочника ChatGPT тоже отбрасываются, так что
+    при пустом справочнике доразмечать нечем и уверенность равна 1.
+    """
+    with metrics.timer('local_tagging'):
+        tag_index.sync()
+        found = tag_index.match(activity['text'])
+    activity['tags'] = []
+    for field, names in found.items():
+        activity[field] = ', '.join(names)
+        activity['tags'].extend(names)
+    known = known_tags()
+    fields = [field for field in found if known.get(field)]
+    if fields:
+        confidence = sum(1 for field in fields if found[field]) / len(fields)
+    else:
+        confidence = 1.0
+    activity['confidence'] = confidence
+    return confidence
+
+
+def needs_llm(activity: Dict) -> bool:
+    """Локальной разметки недостаточно."""
+    return activity.get('confidence', 0) < MIN_CONFIDENCE
+
+
+async def tag_activities(activities: List[Dict]) -> None:
+    """Доразметка через ChatGPT одним запросом активностей с низкой уверенностью."""
+    uncertain = [activity for activity in activities if needs_llm(activity)]
+    if not uncertain:
+        return
+    metrics.inc('llm_tagging_activities', len(uncertain))
+    try:
+        tagged = await tag_with_chatgpt([activity['text'] for activity in uncertain])
+    except Exception as e:
+        logger.error(f"Ошибка при разметке активностей через ChatGPT: {e}")
+        return
+    for activity, result in zip(uncertain, tagged):
+        if result is not None:
+            for field in (*TAG_FIELDS, 'tags'):
+                activity[field] = result[field]
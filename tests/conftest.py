@@ -0,0 +1,17 @@
+"""Общие настройки тестов: модули бота из корня репозитория, базы во временном каталоге.
+
+config читает окружение один раз при импорте, поэтому пути задаются
+здесь, до импорта модулей бота.
+"""
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_workdir = tempfile.mkdtemp(prefix='bot-tests-')
+for _name in ('JOURNAL_PATH', 'PERSISTENCE_PATH', 'REMINDERS_PATH', 'ANALYSIS_CACHE_PATH'):
+    os.environ[_name] = os.path.join(_workdir, _name.lower().replace('_path', '.db'))
+os.environ['GOOGLE_CREDENTIALS'] = ''
+os.environ['METRICS_ENABLED'] = 'false'
@@ -0,0 +1,14 @@
+import json
+
+from analysis import merge_structured_analyses
+
+
+def test_merge_skips_malformed_parts():
+    merged = json.loads(merge_structured_analyses([
+        json.dumps([{'text': 'список вместо объекта'}]),
+        json.dumps({'activities': ['строка', None, {'text': 'Созвон с командой'}],
+                    'chronology': 'Утро'}),
+        json.dumps({'activities': 'не список'}),
+    ]))
+    assert merged['activities'] == [{'text': 'Созвон с командой'}]
+    assert merged['chronology'] == ['Утро']
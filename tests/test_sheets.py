@@ -0,0 +1,31 @@
+import asyncio
+
+import gspread
+import pytest
+
+from benchmark import FakeSpreadsheet
+from sheets import HEADER, SheetsClient
+
+
+@pytest.fixture
+def client():
+    client = SheetsClient('fake')
+    client._spreadsheet = FakeSpreadsheet(latency=0, error_rate=0)
+    return client
+
+
+def test_batch_update_writes_cells(client):
+    fake = client._spreadsheet
+
+    async def main():
+        await client.append_rows([['2024-03-05', 'созвон']], 'u7')
+        await client.batch_update([{'range': "'u7'!G2", 'values': [['key']]}])
+
+    asyncio.run(main())
+    assert fake.sheets['u7'] == [HEADER, ['2024-03-05', 'созвон', '', '', '', '', 'key']]
+
+
+def test_fake_rejects_batch_update_without_body():
+    fake = FakeSpreadsheet(latency=0, error_rate=0)
+    with pytest.raises(gspread.exceptions.APIError):
+        fake.values_batch_update({'valueInputOption': 'RAW', 'data': []})
@@ -0,0 +1,76 @@
+import asyncio
+
+from gspread.utils import a1_to_rowcol
+
+from journal import ActivityJournal
+from sheets_sync import SheetsMirror
+
+ROW = ['2024-03-05', 'созвон', '1', '', '', '']
+
+
+class FlakySheets:
+    """Листы в памяти; первые failures вызовов batch_update падают."""
+
+    def __init__(self, sheets, failures=0):
+        self.sheets = sheets
+        self.failures = failures
+        self.modified = 0
+
+    async def last_update_time(self):
+        return str(self.modified)
+
+    @staticmethod
+    def _locate(a1):
+        title, cells = a1.split('!')
+        first, _, last = cells.partition(':')
+        return title.strip("'"), a1_to_rowcol(first)[0], a1_to_rowcol(last or first)[0]
+
+    async def batch_get(self, ranges):
+        result = []
+        for a1 in ranges:
+            title, first, last = self._locate(a1)
+            result.append(self.sheets[title][first - 1:last])
+        return result
+
+    async def batch_update(self, data):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError('quota exceeded')
+        for item in data:
+            title, row, _ = self._locate(item['range'])
+            self.sheets[title][row - 1][6:] = item['values'][0]
+        self.modified += 1
+
+
+def journal_rows(journal, worksheet):
+    return journal.db.execute(
+        'SELECT key, chat_id FROM activities WHERE worksheet = ?', (worksheet,)
+    ).fetchall()
+
+
+def test_hand_added_row_is_journaled_once_when_key_write_fails(tmp_path):
+    journal = ActivityJournal(str(tmp_path / 'journal.db'))
+    [key] = journal.record(7, [ROW], worksheet='u7')
+    journal.mark_synced([key])
+    sheets = FlakySheets({'u7': [list(ROW) + [key], ['2024-03-06', 'вручную', '0', '', '', '']]},
+                         failures=2)
+    mirror = SheetsMirror(journal, sheets, include_shared=False)
+
+    for _ in range(2):
+        sheets.modified += 1
+        try:
+            asyncio.run(mirror.sync())
+        except RuntimeError:
+            pass
+        assert len(journal_rows(journal, 'u7')) == 1
+
+    sheets.modified += 1
+    asyncio.run(mirror.sync())
+    written = sheets.sheets['u7'][1][6]
+    assert written
+    assert sorted(journal_rows(journal, 'u7')) == sorted([(key, 7), (written, 7)])
+
+    # Следующий проход видит ключ в таблице и строку не дублирует
+    sheets.modified += 1
+    asyncio.run(mirror.sync())
+    assert len(journal_rows(journal, 'u7')) == 2
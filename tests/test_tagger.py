@@ -0,0 +1,74 @@
+import pytest
+
+from tagger import normalize, stem
+
+
+@pytest.mark.parametrize('words', [
+    'планирование планированию планирования планированием планировании планированиями',
+    'встреча встречи встрече встречу встречей встречами',
+    'созвон созвона созвону созвоном созвоне',
+    'рабочий рабочего рабочему рабочим рабочая рабочую рабочей рабочие',
+    'английский английского английскому английским',
+])
+def test_oblique_cases_share_stem(words):
+    assert len({stem(word) for word in words.split()}) == 1
+
+
+def test_reflexive_verb_matches_noun():
+    assert stem('созвонились') == stem('созвон')
+
+
+def test_short_words_are_kept():
+    assert stem('код') == 'код'
+    assert stem('ия') == 'ия'
+
+
+def test_normalize_lowercases_and_replaces_yo():
+    assert normalize('Ещё ПЛАНИРОВАНИЮ') == [stem('еще'), stem('планированию')]
+
+
+@pytest.fixture
+def dictionary(tmp_path, monkeypatch):
+    """Справочник во временном файле вместо categories.json в рабочем каталоге."""
+    import json
+
+    import analysis
+    import prompts
+    import tagger
+
+    def load(data):
+        path = tmp_path / 'categories.json'
+        path.write_text(json.dumps(data, ensure_ascii=False), encoding='utf-8')
+        monkeypatch.setattr(prompts, '_categories', prompts.Categories(str(path)))
+        monkeypatch.setattr(analysis, '_known_tags_version', None)
+        monkeypatch.setattr(tagger, 'tag_index', tagger.TagIndex())
+    return load
+
+
+def test_index_matches_oblique_case(dictionary):
+    from tagger import tag_activity
+    dictionary({'КОНТЕКСТЫ': ['Планирование'], 'РОЛИ': {}, 'СКИЛЫ': {}})
+    activity = {'text': 'Готовился к планированию спринта'}
+    tag_activity(activity)
+    assert activity['contexts'] == 'Планирование'
+
+
+def test_confidence_counts_only_fields_with_values(dictionary):
+    from tagger import needs_llm, tag_activity
+    dictionary({'КОНТЕКСТЫ': ['Планирование'], 'РОЛИ': {}, 'СКИЛЫ': {}})
+    activity = {'text': 'Планирование спринта'}
+    assert tag_activity(activity) == 1.0
+    assert not needs_llm(activity)
+
+    activity = {'text': 'Обед'}
+    assert tag_activity(activity) == 0.0
+    assert needs_llm(activity)
+
+
+def test_empty_dictionary_skips_llm(dictionary):
+    from tagger import needs_llm, tag_activity
+    dictionary({'КОНТЕКСТЫ': [], 'РОЛИ': {'Экспертные': {}}, 'СКИЛЫ': {}})
+    activity = {'text': 'Планирование спринта'}
+    tag_activity(activity)
+    assert activity['tags'] == []
+    assert not needs_llm(activity)
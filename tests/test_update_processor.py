@@ -0,0 +1,30 @@
+import asyncio
+
+import update_processor
+from update_processor import PerChatUpdateProcessor
+
+
+def test_queued_updates_of_one_chat_do_not_take_slots(monkeypatch):
+    monkeypatch.setattr(update_processor, 'update_key', lambda update: update[0])
+    done = []
+
+    async def handle(update, release=None):
+        if release is not None:
+            await release.wait()
+        done.append(update)
+
+    async def main():
+        processor = PerChatUpdateProcessor(2)
+        release = asyncio.Event()
+        tasks = [
+            asyncio.create_task(processor.process_update(update, handle(update, event)))
+            for update, event in (((1, 'a'), release), ((1, 'b'), None), ((2, 'c'), None))
+        ]
+        await asyncio.sleep(0.01)
+        # Второе обновление чата 1 ждёт первое, но слот чату 2 оставляет
+        assert done == [(2, 'c')]
+        release.set()
+        await asyncio.gather(*tasks)
+        assert done == [(2, 'c'), (1, 'a'), (1, 'b')]
+
+    asyncio.run(main())
@@ -0,0 +1,38 @@
+import asyncio
+
+from write_queue import SheetsWriteQueue
+
+
+class BrokenSheet:
+    """Запись в лист broken падает, в остальные проходит."""
+
+    def __init__(self, broken):
+        self.broken = broken
+        self.calls = []
+
+    async def append_rows(self, rows, title=None):
+        self.calls.append(title)
+        if title == self.broken:
+            raise RuntimeError('Unable to parse range')
+
+
+def test_failing_worksheet_does_not_block_others():
+    client = BrokenSheet('u1')
+    queue = SheetsWriteQueue(client)
+    queue.put([['a']], 'u1')
+    queue.put([['b']], 'u2')
+
+    asyncio.run(queue.flush())
+    assert client.calls == ['u1', 'u2']
+    assert queue.size == 1
+    assert queue.take_flushed_titles() == {'u2'}
+
+    # Лист с ошибкой ждёт своей паузы, новые строки других листов пишутся сразу
+    queue.put([['c']], 'u3')
+    asyncio.run(queue.flush())
+    assert client.calls == ['u1', 'u2', 'u3']
+
+    client.broken = None
+    asyncio.run(queue.flush(force=True))
+    assert client.calls[-1] == 'u1'
+    assert queue.size == 0
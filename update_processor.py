@@ -0,0 +1,73 @@
+"""Параллельная обработка обновлений с сохранением порядка внутри чата."""
+import asyncio
+import time
+from typing import Any, Awaitable, Dict, List, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+
+
+def update_key(update: object) -> Optional[int]:
+    """Чат, к которому относится обновление."""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return None
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Обновления разных чатов обрабатываются параллельно, одного чата - по очереди.
+
+    Общее число одновременно обрабатываемых обновлений ограничено
+    max_concurrent_updates. Слот занимается только после блокировки
+    чата, так что обновления, ждущие своей очереди в чате, не отнимают
+    слоты у других чатов. Блокировки чатов живут, пока у чата есть
+    обновления в работе, поэтому память не растёт с числом пользователей.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # Чат -> [блокировка, число обновлений в работе]
+        self._chats: Dict[int, List[Any]] = {}
+        # Обновления в работе или в ожидании своего чата
+        self._pending = 0
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        # Базовый класс занимает слот до do_process_update, то есть до блокировки чата
+        await self.do_process_update(update, coroutine)
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = update_key(update)
+        if key is None:
+            async with self._semaphore:
+                await coroutine
+            return
+
+        entry = self._chats.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        self._pending += 1
+        metrics.gauge('updates_pending', self._pending)
+        queued_at = time.perf_counter()
+        try:
+            async with entry[0]:
+                metrics.observe('update_chat_wait', time.perf_counter() - queued_at)
+                async with self._semaphore:
+                    with metrics.timer('update_processing'):
+                        await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[key]
+            self._pending -= 1
+            metrics.gauge('updates_pending', self._pending)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
@@ -0,0 +1,197 @@
+"""Очередь отложенной записи строк в Google Sheets."""
+import asyncio
+import logging
+import random
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import metrics
+from sheets import SheetsClient, sheets_client
+
+logger = logging.getLogger(__name__)
+
+# Сбрасываем очередь, когда набралось столько строк или прошло столько секунд
+MAX_BATCH_ROWS = 200
+FLUSH_INTERVAL = 2.0
+
+# Пауза после ошибки растёт от BACKOFF_BASE до BACKOFF_MAX секунд
+BACKOFF_BASE = 2.0
+BACKOFF_MAX = 120.0
+# Квота Sheets считается поминутно, поэтому после 429 ждём не меньше
+QUOTA_BACKOFF_MIN = 15.0
+
+
+def is_quota_error(error: Exception) -> bool:
+    """Превышена квота Google Sheets API."""
+    import gspread
+    return (
+        isinstance(error, gspread.exceptions.APIError)
+        and error.response.status_code == 429
+    )
+
+
+class SheetsWriteQueue:
+    """Собирает строки от всех пользователей и пишет их пачками.
+
+    На каждый лист за один сброс уходит один вызов append_rows. При
+    ошибках строки остаются в очереди и запись повторяется с
+    экспоненциальной паузой: после ошибки листа пауза выдерживается
+    только для него, после превышения квоты - для всей очереди.
+    """
+
+    def __init__(self, client: SheetsClient, max_batch_rows: int = MAX_BATCH_ROWS,
+                 flush_interval: float = FLUSH_INTERVAL,
+                 on_flushed: Optional[Callable[[List[str]], None]] = None):
+        self._client = client
+        self.on_flushed = on_flushed
+        self._max_batch_rows = max_batch_rows
+        self._flush_interval = flush_interval
+        # Лист -> список (время постановки, ключ строки, строка)
+        self._pending: Dict[Optional[str], List[Tuple[float, Optional[str], List]]] = {}
+        self._size = 0
+        # Листы, в которые записаны строки с прошлого take_flushed_titles
+        self._flushed_titles: Set[Optional[str]] = set()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._stopping: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._failures = 0
+        # Лист -> (ошибок подряд, время следующей попытки)
+        self._retries: Dict[Optional[str], Tuple[int, float]] = {}
+
+    @property
+    def size(self) -> int:
+        """Количество строк, ожидающих записи."""
+        return self._size
+
+    def put(self, rows: List[List], title: Optional[str] = None,
+            keys: Optional[List[str]] = None) -> None:
+        """Постановка строк в очередь без ожидания записи.
+
+        Ключи строк, если переданы, после записи уходят в on_flushed.
+        """
+        now = time.monotonic()
+        keys = keys or [None] * len(rows)
+        self._pending.setdefault(title, []).extend(
+            (now, key, row) for key, row in zip(keys, rows)
+        )
+        self._size += len(rows)
+        metrics.inc('sheets_rows_queued', len(rows))
+        metrics.gauge('sheets_queue_depth', self._size)
+        if self._size >= self._max_batch_rows and self._wakeup is not None:
+            self._wakeup.set()
+
+    async def flush(self, force: bool = False) -> None:
+        """Запись накопленных строк, по одному запросу на лист.
+
+        Ошибка одного листа не мешает записи остальных: его строки
+        остаются в очереди, а сам лист пропускается до конца паузы, если
+        не задан force. Превышение квоты общее для таблицы и прерывает сброс.
+        """
+        for title in list(self._pending):
+            if not force and self._retries.get(title, (0, 0.0))[1] > time.monotonic():
+                continue
+            try:
+                await self._flush_title(title)
+            except Exception as e:
+                if is_quota_error(e):
+                    raise
+                failures = self._retries.get(title, (0, 0.0))[0] + 1
+                delay = self._backoff(failures)
+                self._retries[title] = (failures, time.monotonic() + delay)
+                metrics.inc('sheets_write_errors')
+                logger.error(
+                    f"Ошибка при записи в лист {title or 'sheet1'} "
+                    f"({len(self._pending.get(title, []))} строк), повтор через {delay:.1f} с: {e}"
+                )
+            else:
+                self._retries.pop(title, None)
+
+    async def _flush_title(self, title: Optional[str]) -> None:
+        while self._pending.get(title):
+            batch = self._pending[title][:self._max_batch_rows]
+            start = time.monotonic()
+            await self._client.append_rows([row for _, _, row in batch], title)
+            now = time.monotonic()
+            metrics.observe('sheets_flush', now - start)
+            for queued_at, _, _ in batch:
+                metrics.observe('sheets_queue_wait', now - queued_at)
+            del self._pending[title][:len(batch)]
+            self._flushed_titles.add(title)
+            self._size -= len(batch)
+            metrics.gauge('sheets_queue_depth', self._size)
+            keys = [key for _, key, _ in batch if key is not None]
+            if keys and self.on_flushed is not None:
+                self.on_flushed(keys)
+        self._pending.pop(title, None)
+
+    def take_flushed_titles(self) -> Set[Optional[str]]:
+        """Листы, в которые были записаны строки с прошлого вызова."""
+        titles, self._flushed_titles = self._flushed_titles, set()
+        return titles
+
+    @staticmethod
+    def _backoff(failures: int) -> float:
+        delay = min(BACKOFF_BASE * 2 ** (failures - 1), BACKOFF_MAX)
+        return delay * random.uniform(0.5, 1.0)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._stopping.is_set():
+                return
+            if not self._size:
+                continue
+            try:
+                await self.flush()
+                self._failures = 0
+            except Exception as e:
+                self._failures += 1
+                delay = self._backoff(self._failures)
+                if is_quota_error(e):
+                    metrics.inc('sheets_quota_errors')
+                    delay = max(delay, QUOTA_BACKOFF_MIN)
+                else:
+                    metrics.inc('sheets_write_errors')
+                logger.error(
+                    f"Ошибка при записи данных ({self._size} строк в очереди), "
+                    f"повтор через {delay:.1f} с: {e}"
+                )
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+
+    def start(self) -> None:
+        """Запуск фоновой записи."""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._stopping = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Остановка фоновой записи с попыткой сбросить остаток.
+
+        Начатый сброс не отменяется, а дожидается: append_rows всё равно
+        доработает в своём потоке, и без отметки о записи строки ушли бы
+        в таблицу второй раз.
+        """
+        if self._task is None:
+            return
+        self._stopping.set()
+        self._wakeup.set()
+        await self._task
+        self._task = None
+        if self._size:
+            try:
+                await self.flush(force=True)
+            except Exception as e:
+                logger.error(f"Ошибка при записи данных при остановке: {e}")
+            if self._size:
+                logger.error(f"Не удалось записать {self._size} строк при остановке")
+
+
+write_queue = SheetsWriteQueue(sheets_client)